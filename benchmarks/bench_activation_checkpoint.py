@@ -0,0 +1,56 @@
+#-*- coding:utf-8 -*-
+"""
+Peak memory and step time of a training step (forward, DetCon loss, backward)
+for several activation checkpointing settings of the online network.
+Every setting runs in a fresh process so the peak memory is not shared.
+
+    python benchmarks/bench_activation_checkpoint.py --pool-size 14 --batch-size 4
+"""
+import sys
+import argparse
+import subprocess
+
+import torch
+
+from bench_utils import load_config, get_device, random_batch, timeit, peak_memory_mb, train_step
+from model import BYOLModel
+from losses import DetconInfoNCECriterion
+
+parser = argparse.ArgumentParser(description='Activation checkpointing benchmark')
+parser.add_argument('--cfg', default='train_imagenet_300')
+parser.add_argument('--pool-size', type=int, default=7)
+parser.add_argument('--batch-size', type=int, default=4)
+parser.add_argument('--iters', type=int, default=3)
+parser.add_argument('--settings', default='none;C2,C3,C4;C1,C2,C3,C4,C5;C1,C2,C3,C4,C5,fpn',
+                    help='semicolon separated list of checkpoint_stages settings')
+parser.add_argument('--run', default=None, help=argparse.SUPPRESS)
+
+
+def run_setting(args, stages):
+    device = get_device()
+    config = load_config(args.cfg, train_batch_size=args.batch_size)
+    config['loss']['pool_size'] = args.pool_size
+    config['model']['checkpoint_stages'] = [] if stages == 'none' else stages.split(',')
+    model = BYOLModel(config).to(device).train()
+    criterion = DetconInfoNCECriterion(config)
+    images, masks = random_batch(args.batch_size, device=device)
+
+    step_time = timeit(lambda: train_step(model, criterion, images, masks), args.iters, device=device)
+    print(f"{peak_memory_mb(device):.1f} {step_time:.4f}")
+
+
+def main():
+    args = parser.parse_args()
+    if args.run is not None:
+        return run_setting(args, args.run)
+
+    print(f"pool_size {args.pool_size}, batch {args.batch_size} x 2 views, device {get_device()}")
+    print(f"{'checkpoint_stages':<28}{'peak MB':>10}{'step (s)':>10}")
+    for stages in args.settings.split(';'):
+        cmd = [sys.executable, __file__, '--run', stages] + sys.argv[1:]
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout.split()
+        print(f"{stages:<28}{float(out[-2]):>10.1f}{float(out[-1]):>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#-*- coding:utf-8 -*-
+"""
+Simulated page cache behaviour of DistributedSampler against BlockShuffleSampler
+on a multi-node job: the hit rate of one node's LRU page cache in the second
+epoch for several cache sizes (as a fraction of the dataset), how many
+distinct blocks of consecutive files the samples of a batch come from, and the
+fraction of the dataset no rank of any node reads in an epoch.
+
+    python benchmarks/bench_block_sampler.py --samples 128000 --nodes 4 --ranks-per-node 8
+"""
+import argparse
+
+import torch
+
+from bench_utils import ROOT  # noqa: F401, puts the repository on sys.path
+from data.samplers import BlockShuffleSampler, estimate_page_cache_hit_rate
+
+parser = argparse.ArgumentParser(description='Block shuffle sampler benchmark')
+parser.add_argument('--samples', type=int, default=128000)
+parser.add_argument('--nodes', type=int, default=4)
+parser.add_argument('--ranks-per-node', type=int, default=8)
+parser.add_argument('--batch-size', type=int, default=32)
+parser.add_argument('--block-size', type=int, default=256)
+parser.add_argument('--window', type=int, default=8)
+parser.add_argument('--cache-fractions', default='0.1,0.25,0.5')
+
+
+def node_reads(samplers, epoch):
+    """Reads of the ranks of one node in `epoch`, interleaved as they are consumed"""
+    streams = []
+    for sampler in samplers:
+        sampler.set_epoch(epoch)
+        streams.append(list(sampler))
+    return [i for step in zip(*streams) for i in step]
+
+
+def blocks_per_batch(sampler, args):
+    indices = torch.tensor(list(sampler))
+    batches = indices[:len(indices) // args.batch_size * args.batch_size].reshape(-1, args.batch_size)
+    return sum(len(set((batch // args.block_size).tolist())) for batch in batches) / len(batches)
+
+
+def unread(make_sampler, args, epoch=1):
+    """Fraction of the samples read by none of the nodes * ranks_per_node ranks"""
+    read = set()
+    for rank in range(args.nodes * args.ranks_per_node):
+        sampler = make_sampler(rank)
+        sampler.set_epoch(epoch)
+        read.update(sampler)
+    return 1 - len(read) / args.samples
+
+
+def main():
+    args = parser.parse_args()
+    dataset = range(args.samples)
+    world_size = args.nodes * args.ranks_per_node
+    make_samplers = {
+        'distributed': lambda r: torch.utils.data.distributed.DistributedSampler(dataset, num_replicas=world_size,
+                                                                                rank=r),
+        'block': lambda r: BlockShuffleSampler(dataset, args.block_size, args.window, num_replicas=world_size, rank=r,
+                                               local_world_size=args.ranks_per_node),
+    }
+    fractions = [float(f) for f in args.cache_fractions.split(',')]
+
+    print(f"{args.samples} samples, {args.nodes} nodes x {args.ranks_per_node} ranks, "
+          f"block {args.block_size}, window {args.window}, batch {args.batch_size}")
+    print(f"{'sampler':<13}" + ''.join(f"{f'hit@{f:g}':>10}" for f in fractions) + f"{'blocks/batch':>14}"
+          + f"{'unread':>8}")
+    for name, make_sampler in make_samplers.items():
+        node_samplers = [make_sampler(r) for r in range(args.ranks_per_node)]
+        previous, reads = node_reads(node_samplers, 1), node_reads(node_samplers, 2)
+        hit_rates = [estimate_page_cache_hit_rate(previous, reads, int(f * args.samples)) for f in fractions]
+        print(f"{name:<13}" + ''.join(f"{h:>10.3f}" for h in hit_rates)
+              + f"{blocks_per_batch(node_samplers[0], args):>14.1f}{unread(make_sampler, args):>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#-*- coding:utf-8 -*-
+"""
+Forward and training step time of BYOLModel with the default NCHW layout
+against model.channels_last (modules and input views converted once).
+
+    python benchmarks/bench_channels_last.py --pool-size 7 --batch-size 8
+"""
+import argparse
+
+import torch
+
+from bench_utils import load_config, get_device, random_batch, timeit, train_step
+from model import BYOLModel
+from losses import DetconInfoNCECriterion
+
+parser = argparse.ArgumentParser(description='Channels-last benchmark')
+parser.add_argument('--cfg', default='train_imagenet_300')
+parser.add_argument('--pool-size', type=int, default=7)
+parser.add_argument('--batch-size', type=int, default=8)
+parser.add_argument('--iters', type=int, default=3)
+
+
+def main():
+    args = parser.parse_args()
+    device = get_device()
+    config = load_config(args.cfg, train_batch_size=args.batch_size)
+    config['loss']['pool_size'] = args.pool_size
+    criterion = DetconInfoNCECriterion(config)
+    images, masks = random_batch(args.batch_size, device=device)
+
+    print(f"pool_size {args.pool_size}, batch {args.batch_size} x 2 views, device {device}")
+    print(f"{'layout':<16}{'forward (s)':>12}{'step (s)':>10}")
+    for channels_last in (False, True):
+        torch.manual_seed(0)
+        model = BYOLModel(config).train()
+        if channels_last:
+            model = model.to(memory_format=torch.channels_last)
+            views = images.contiguous(memory_format=torch.channels_last)
+        else:
+            views = images
+        model = model.to(device)
+
+        def forward():
+            with torch.no_grad():
+                model(views, 0.99, masks, None)
+
+        forward_time = timeit(forward, args.iters, device=device)
+        step_time = timeit(lambda: train_step(model, criterion, views, masks), args.iters, device=device)
+        layout = 'channels_last' if channels_last else 'nchw'
+        print(f"{layout:<16}{forward_time:>12.3f}{step_time:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
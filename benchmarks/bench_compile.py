@@ -0,0 +1,46 @@
+#-*- coding:utf-8 -*-
+"""
+Compile time and steady-state training step time of BYOLModel for each
+model.compile mode (eager, TorchScript trace, torch.compile/inductor).
+
+    python benchmarks/bench_compile.py --batch-size 4 --modes eager,script,inductor
+"""
+import argparse
+
+import torch
+
+from bench_utils import load_config, get_device, timeit, train_step
+from model import BYOLModel
+from losses import DetconInfoNCECriterion
+from utils.compile_util import compile_model, example_inputs
+
+parser = argparse.ArgumentParser(description='Compiled model benchmark')
+parser.add_argument('--cfg', default='train_imagenet_300')
+parser.add_argument('--pool-size', type=int, default=7)
+parser.add_argument('--batch-size', type=int, default=4)
+parser.add_argument('--iters', type=int, default=3)
+parser.add_argument('--modes', default='eager,script,inductor')
+
+
+def main():
+    args = parser.parse_args()
+    device = get_device()
+    config = load_config(args.cfg, train_batch_size=args.batch_size)
+    config['loss']['pool_size'] = args.pool_size
+    criterion = DetconInfoNCECriterion(config)
+    images, masks = example_inputs(config, device)
+
+    print(f"pool_size {args.pool_size}, batch {args.batch_size} x 2 views, device {device}")
+    print(f"{'mode':<10}{'backend':<10}{'compile (s)':>12}{'step (s)':>10}")
+    for mode in args.modes.split(','):
+        torch.manual_seed(0)
+        config['model']['compile'] = None if mode == 'eager' else mode
+        model = BYOLModel(config).to(device).train()
+        backend, compile_time = compile_model(model, config, device)
+
+        step_time = timeit(lambda: train_step(model, criterion, images, masks), args.iters, device=device)
+        print(f"{mode:<10}{backend:<10}{compile_time:>12.1f}{step_time:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
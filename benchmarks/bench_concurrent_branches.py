@@ -0,0 +1,49 @@
+#-*- coding:utf-8 -*-
+"""
+Training step time with the online and target branches run sequentially or
+concurrently (model.concurrent_branches). On CPU the target branch runs on a
+worker thread, so give each branch enough intra-op threads with --threads.
+
+    python benchmarks/bench_concurrent_branches.py --batch-size 8 --threads 16
+"""
+import os
+import argparse
+
+import torch
+
+from bench_utils import load_config, get_device, random_batch, timeit, train_step
+from model import BYOLModel
+from losses import DetconInfoNCECriterion
+
+parser = argparse.ArgumentParser(description='Concurrent branches benchmark')
+parser.add_argument('--cfg', default='train_imagenet_300')
+parser.add_argument('--pool-size', type=int, default=7)
+parser.add_argument('--batch-size', type=int, default=8)
+parser.add_argument('--iters', type=int, default=3)
+parser.add_argument('--threads', type=int, default=os.cpu_count())
+
+
+def main():
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+    device = get_device()
+    config = load_config(args.cfg, train_batch_size=args.batch_size)
+    config['loss']['pool_size'] = args.pool_size
+    criterion = DetconInfoNCECriterion(config)
+    images, masks = random_batch(args.batch_size, device=device)
+
+    print(f"pool_size {args.pool_size}, batch {args.batch_size} x 2 views, device {device}, threads {args.threads}")
+    print(f"{'branches':<14}{'step (s)':>10}")
+    times = {}
+    for concurrent in (False, True):
+        config['model']['concurrent_branches'] = concurrent
+        model = BYOLModel(config).to(device).train()
+
+        name = 'concurrent' if concurrent else 'sequential'
+        times[name] = timeit(lambda: train_step(model, criterion, images, masks), args.iters, device=device)
+        print(f"{name:<14}{times[name]:>10.3f}")
+    print(f"speedup {times['sequential'] / times['concurrent']:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
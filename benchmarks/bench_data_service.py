@@ -0,0 +1,110 @@
+#-*- coding:utf-8 -*-
+"""
+Node-level data service (data.data_service) on one machine with several CPU ranks
+(gloo). First checks that every rank receives exactly the indices its
+DistributedSampler yields each epoch, with a dataset whose samples carry their
+index. Then compares view pairs per second per rank of the per-rank DataLoaders
+(data_workers each) against one service of service_workers producers, on a
+synthetic dataset read through ImageLoader.
+
+    python benchmarks/bench_data_service.py --ranks 4 --images 512 --workers 2 --service-workers 8
+"""
+import os
+import time
+import argparse
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import Dataset, DistributedSampler
+
+from bench_utils import load_config, make_dataset
+from data import ImageLoader
+from data.data_service import DataService
+
+parser = argparse.ArgumentParser(description='Data service benchmark')
+parser.add_argument('--ranks', type=int, default=4)
+parser.add_argument('--images', type=int, default=512)
+parser.add_argument('--batch-size', type=int, default=16)
+parser.add_argument('--epochs', type=int, default=2)
+parser.add_argument('--workers', type=int, default=2, help='data_workers of each per-rank DataLoader')
+parser.add_argument('--service-workers', type=int, default=8)
+parser.add_argument('--slots', type=int, default=4)
+
+
+class IndexDataset(Dataset):
+    """(views, masks) samples holding their own index"""
+
+    def __init__(self, size):
+        self.size = size
+
+    def __getitem__(self, index):
+        return torch.full((2, 1), index), torch.full((2, 1), index)
+
+    def __len__(self):
+        return self.size
+
+
+def check(rank, args, service_dir):
+    dataset = IndexDataset(103)
+    samplers = [DistributedSampler(dataset, num_replicas=args.ranks, rank=r) for r in range(args.ranks)]
+    service = DataService(dataset, samplers, 4, rank, service_dir, num_workers=3, num_slots=2)
+    expected = DistributedSampler(dataset, num_replicas=args.ranks, rank=rank)
+    for epoch in range(1, 4):
+        service.set_epoch(epoch)
+        expected.set_epoch(epoch)
+        # view-major batches: the first half are the first views
+        indices = [i for images, masks in service for i in images[:len(images) // 2].flatten().tolist()]
+        assert indices == list(expected)[:len(service) * 4], f'rank {rank} epoch {epoch}: {indices}'
+    service.close()
+
+
+def throughput(rank, args, root, data_service, service_dir):
+    config = load_config(image_dir=root, data_workers=args.workers, data_service=data_service,
+                         service_dir=service_dir, service_workers=args.service_workers, service_slots=args.slots)
+    config.update({'world_size': args.ranks, 'rank': rank, 'local_rank': rank,
+                   'local_world_size': args.ranks, 'distributed': True})
+    data_ins = ImageLoader(config)
+    loader = data_ins.get_loader('train', args.batch_size)
+    rates = []
+    for epoch in range(1, args.epochs + 1):
+        data_ins.set_epoch(epoch)
+        dist.barrier()
+        start = time.time()
+        pairs = sum(images.shape[0] // 2 for images, *_ in loader)
+        rates.append(pairs / (time.time() - start))
+    if data_ins.service is not None:
+        data_ins.service.close()
+    return rates
+
+
+def run(rank, args, root, service_dir):
+    torch.set_num_threads(1)
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:29533', world_size=args.ranks, rank=rank)
+    check(rank, args, os.path.join(service_dir, 'check'))
+    if rank == 0:
+        print(f"partitioning matches DistributedSampler on {args.ranks} ranks")
+        print(f"{args.images} images, batch {args.batch_size} per rank, {args.ranks} ranks")
+        print(f"{'mode':<28}{'processes':>11}" + ''.join(f"{f'epoch {e} pairs/s':>19}"
+                                                       for e in range(1, args.epochs + 1)))
+    for data_service in (False, True):
+        rates = throughput(rank, args, root, data_service, os.path.join(service_dir, 'bench'))
+        rates = torch.tensor(rates)
+        dist.all_reduce(rates)
+        if rank == 0:
+            name, processes = (('data service', args.service_workers) if data_service
+                               else ('per-rank DataLoaders', args.workers * args.ranks))
+            print(f"{name:<28}{processes:>11}" + ''.join(f"{r / args.ranks:>19.1f}" for r in rates.tolist()))
+    dist.destroy_process_group()
+
+
+def main():
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as service_dir:
+        make_dataset(root, args.images)
+        mp.spawn(run, args=(args, root, service_dir), nprocs=args.ranks)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#-*- coding:utf-8 -*-
+"""
+Epoch time and memory of data.in_memory against reading from disk: ImageLoader
+on a synthetic dataset (JPEGs and FH mask pickles) with a simulated storage latency
+on every disk read during the epochs. Reports the one-off decode time, the size of the decoded
+arrays next to the size of the files on disk, and the time of each epoch.
+
+    python benchmarks/bench_in_memory.py --images 512 --io-latency 5 --workers 4 --max-sizes 256,160
+"""
+import os
+import time
+import argparse
+import tempfile
+
+from bench_utils import load_config, make_dataset, SlowLoader
+from data import ImageLoader
+
+parser = argparse.ArgumentParser(description='In-memory dataset benchmark')
+parser.add_argument('--images', type=int, default=512)
+parser.add_argument('--batch-size', type=int, default=32)
+parser.add_argument('--workers', type=int, default=4)
+parser.add_argument('--epochs', type=int, default=2)
+parser.add_argument('--io-latency', type=float, default=5., help='simulated ms per disk image read')
+parser.add_argument('--max-sizes', default='256,160', help='in_memory_max_size values')
+
+
+def dataset_bytes(root):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(root) for f in files)
+
+
+def run(root, args, **data):
+    config = load_config(image_dir=root, data_workers=args.workers, **data)
+    data_ins = ImageLoader(config)
+    start = time.time()
+    loader = data_ins.get_loader('train', args.batch_size)
+    build_time = time.time() - start
+    # only epochs reading from disk pay the latency, the build time above is without it
+    loader.dataset.loader = SlowLoader(args.io_latency / 1000)
+    epoch_times = []
+    for epoch in range(1, args.epochs + 1):
+        data_ins.set_epoch(epoch)
+        start = time.time()
+        for _ in loader:
+            pass
+        epoch_times.append(time.time() - start)
+    return build_time, getattr(loader.dataset, 'nbytes', None), epoch_times
+
+
+def main():
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as shm:
+        make_dataset(root, args.images)
+        print(f"{args.images} images ({dataset_bytes(root) / 2**20:.1f} MB on disk), batch {args.batch_size}, "
+              f"{args.workers} workers, {args.io_latency:.0f} ms per disk read")
+        print(f"{'mode':<16}{'build (s)':>11}{'memory (MB)':>13}" + ''.join(f"{f'epoch {e} (s)':>13}"
+                                                                       for e in range(1, args.epochs + 1)))
+
+        build_time, nbytes, epoch_times = run(root, args)
+        print(f"{'disk':<16}{'-':>11}{'-':>13}" + ''.join(f"{t:>13.2f}" for t in epoch_times))
+        for max_size in (int(s) for s in args.max_sizes.split(',')):
+            build_time, nbytes, epoch_times = run(root, args, in_memory=True, in_memory_dir=shm,
+                                                  in_memory_max_size=max_size)
+            print(f"{f'memory {max_size}':<16}{build_time:>11.2f}{nbytes / 2**20:>13.1f}"
+                  + ''.join(f"{t:>13.2f}" for t in epoch_times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#-*- coding:utf-8 -*-
+"""
+data.fh_lazy against masks precomputed by gen_masks.py: ImageLoader epochs on a
+synthetic dataset with the mask files of make_dataset, then with FH masks made on first
+access at fh_max_size and cached. Reports the epoch times, the extra cost of the first
+lazy epoch with the segmenting time the workers reported, and the full-resolution
+gen_masks.py run it replaces, estimated from a few images.
+
+    python benchmarks/bench_lazy_fh_masks.py --images 256 --workers 2 --max-sizes 64,128
+"""
+import time
+import argparse
+import tempfile
+
+import numpy as np
+from PIL import Image
+from skimage.segmentation import felzenszwalb
+
+from bench_utils import load_config, make_dataset
+from data import ImageLoader
+
+parser = argparse.ArgumentParser(description='Lazy FH masks benchmark')
+parser.add_argument('--images', type=int, default=256)
+parser.add_argument('--batch-size', type=int, default=32)
+parser.add_argument('--workers', type=int, default=2)
+parser.add_argument('--epochs', type=int, default=2)
+parser.add_argument('--max-sizes', default='64,128', help='fh_max_size values')
+parser.add_argument('--full-res-images', type=int, default=4, help='images segmented at full resolution for the estimate')
+
+
+def run(root, args, **data):
+    config = load_config(image_dir=root, data_workers=args.workers, **data)
+    data_ins = ImageLoader(config)
+    loader = data_ins.get_loader('train', args.batch_size)
+    epoch_times = []
+    for epoch in range(1, args.epochs + 1):
+        data_ins.set_epoch(epoch)
+        start = time.time()
+        for _ in loader:
+            pass
+        epoch_times.append(time.time() - start)
+    return epoch_times, data_ins.fh_masks
+
+
+def full_res_time(dataset, num_images):
+    """Seconds per image of gen_masks.py: FH on the full-resolution ToTensor() image"""
+    start = time.time()
+    for index in range(num_images):
+        image = np.asarray(dataset.load(index)[0], dtype=np.float32) / 255.
+        felzenszwalb(image, scale=1000, min_size=1000)
+    return (time.time() - start) / num_images
+
+
+def main():
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as cache_dir:
+        make_dataset(root, args.images)
+        print(f"{args.images} images, batch {args.batch_size}, {args.workers} workers")
+        print(f"{'masks':<20}" + ''.join(f"{f'epoch {e} (s)':>13}" for e in range(1, args.epochs + 1))
+              + f"{'extra (s)':>11}{'segmenting (s)':>16}{'per mask (ms)':>15}")
+
+        base, _ = run(root, args)
+        print(f"{'gen_masks.py files':<20}" + ''.join(f"{t:>13.2f}" for t in base))
+        for max_size in (int(s) for s in args.max_sizes.split(',')):
+            epoch_times, fh_masks = run(root, args, fh_lazy=True, fh_cache_dir=cache_dir, fh_max_size=max_size)
+            stats = fh_masks.stats()
+            print(f"{f'lazy {max_size}':<20}" + ''.join(f"{t:>13.2f}" for t in epoch_times)
+                  + f"{epoch_times[0] - base[0]:>11.2f}{stats['compute_time']:>16.2f}"
+                  + f"{stats['compute_time'] / max(stats['misses'], 1) * 1e3:>15.1f}")
+
+        dataset = ImageLoader(load_config(image_dir=root)).get_dataset('train')
+        per_image = full_res_time(dataset, args.full_res_images)
+        print(f"\ngen_masks.py at full resolution: {per_image * 1e3:.0f} ms/image, "
+              f"{per_image * args.images:.1f} s for the dataset before training can start")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#-*- coding:utf-8 -*-
+"""
+Epoch start cost of the train DataLoader and data.autotune on a synthetic dataset
+read through ImageLoader. For workers started every epoch, persistent workers, and
+persistent workers whose next-epoch iterator is started before a simulated
+checkpoint save (BYOLTrainer.prepare_epoch), reports the wait for the first batch
+of epoch 2 and the epoch time. Then runs the autotune grid and prints its choice.
+
+    python benchmarks/bench_loader_workers.py --images 512 --workers 4 --save-time 2
+"""
+import time
+import argparse
+import tempfile
+
+from bench_utils import load_config, make_dataset
+from data import ImageLoader
+
+parser = argparse.ArgumentParser(description='Loader workers benchmark')
+parser.add_argument('--images', type=int, default=512)
+parser.add_argument('--batch-size', type=int, default=32)
+parser.add_argument('--workers', type=int, default=4)
+parser.add_argument('--save-time', type=float, default=2., help='simulated checkpoint save in seconds')
+parser.add_argument('--autotune-workers', default='1,2,4')
+parser.add_argument('--autotune-prefetch', default='2,4')
+parser.add_argument('--autotune-batches', type=int, default=5)
+
+
+def epoch_start(root, args, persistent_workers, prepare):
+    """(first batch wait, epoch time) of epoch 2, after an epoch 1 and a checkpoint save"""
+    config = load_config(image_dir=root, data_workers=args.workers, persistent_workers=persistent_workers)
+    data_ins = ImageLoader(config)
+    loader = data_ins.get_loader('train', args.batch_size)
+    data_ins.set_epoch(1)
+    for _ in loader:
+        pass
+
+    loader_iter = None
+    if prepare:
+        data_ins.set_epoch(2)
+        loader_iter = iter(loader)
+    time.sleep(args.save_time)
+    data_ins.set_epoch(2)
+    loader_iter = loader_iter or iter(loader)
+    start = time.time()
+    next(loader_iter)
+    first_batch = time.time() - start
+    for _ in loader_iter:
+        pass
+    return first_batch, time.time() - start
+
+
+def main():
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as root:
+        make_dataset(root, args.images)
+        print(f"{args.images} images, batch {args.batch_size}, {args.workers} workers, "
+              f"{args.save_time:.1f} s checkpoint save")
+        print(f"{'workers':<34}{'first batch (s)':>17}{'epoch 2 (s)':>13}")
+        for name, persistent_workers, prepare in (('started every epoch', False, False),
+                                                  ('persistent', True, False),
+                                                  ('persistent, started before save', True, True)):
+            first_batch, epoch_time = epoch_start(root, args, persistent_workers, prepare)
+            print(f"{name:<34}{first_batch:>17.3f}{epoch_time:>13.2f}")
+
+        config = load_config(image_dir=root, data_workers=args.workers, autotune=True,
+                             autotune_workers=[int(w) for w in args.autotune_workers.split(',')],
+                             autotune_prefetch=[int(p) for p in args.autotune_prefetch.split(',')],
+                             autotune_batches=args.autotune_batches)
+        data_ins = ImageLoader(config)
+        data_ins.get_loader('train', args.batch_size)
+        print(f"\n{'workers':>8}{'prefetch':>10}{'samples/s':>11}")
+        for num_workers, prefetch_factor, rate in data_ins.autotune_results:
+            print(f"{num_workers:>8}{str(prefetch_factor):>10}{rate:>11.1f}")
+        print(f"autotune picks {data_ins.data_workers} workers, prefetch {data_ins.prefetch_factor}")
+
+
+if __name__ == '__main__':
+    main()
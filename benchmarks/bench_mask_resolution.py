@@ -0,0 +1,102 @@
+#-*- coding:utf-8 -*-
+"""
+Masks stored downsampled (gen_masks.py downsample) and cropped straight to
+crop_size // mask_stride (data.mask_stride) against full-resolution masks cropped to
+the full crop. FH masks of the skimage sample images (as gen_masks.py makes them) go
+through the same random crops on both paths, then convert_binary_mask at pool_size.
+Reports the pickled mask size, the unpickle time, the crop time and the fraction of
+pooled cells whose mask id matches the full-resolution path.
+
+    python benchmarks/bench_mask_resolution.py --crops 200 --downsamples 1,2,4,8 --strides 1,4,8
+"""
+import io
+import time
+import pickle
+import argparse
+
+import torch
+import skimage.data
+from PIL import Image
+from skimage.segmentation import felzenszwalb
+from torchvision import transforms
+
+from bench_utils import timeit
+from data.byol_transform import MaskRandomResizedCrop
+from utils.mask_utils import convert_binary_mask, downsample_mask
+
+parser = argparse.ArgumentParser(description='Mask resolution benchmark')
+parser.add_argument('--crops', type=int, default=200, help='random crops per image')
+parser.add_argument('--crop-size', type=int, default=224)
+parser.add_argument('--pool-size', type=int, default=7)
+parser.add_argument('--downsamples', default='1,2,4,8')
+parser.add_argument('--strides', default='1,4,8')
+parser.add_argument('--min-agreement', type=float, default=0.9)
+
+IMAGES = ('astronaut', 'coffee', 'chelsea', 'rocket', 'immunohistochemistry')
+
+
+def fh_mask(image):
+    return torch.tensor(felzenszwalb(image, scale=1000, min_size=1000)).to(torch.int16)
+
+
+def unpickle_time(mask, iters=20):
+    data = pickle.dumps(mask, protocol=pickle.HIGHEST_PROTOCOL)
+    return len(data), timeit(lambda: pickle.load(io.BytesIO(data)), iters)
+
+
+def crop(mask, image_size, params, size, stride):
+    """The mask path of MaskRandomResizedCrop"""
+    if stride == 1 and mask.shape[-2:] == image_size:
+        return transforms.functional.resize(transforms.functional.crop(mask, *params), (size, size),
+                                            interpolation=transforms.functional.InterpolationMode.NEAREST)
+    return MaskRandomResizedCrop.crop_mask(mask, image_size, *params, size // stride)
+
+
+def pooled_ids(crops, pool_size, chunk=8):
+    """Mask id of each pooled cell, (N, pool_size * pool_size)"""
+    return torch.cat([convert_binary_mask(torch.stack(crops[i:i + chunk]), pool_size=pool_size).argmax(1)
+                      for i in range(0, len(crops), chunk)])
+
+
+def main():
+    args = parser.parse_args()
+    rng = torch.Generator().manual_seed(0)
+    samples = []
+    for name in IMAGES:
+        image = getattr(skimage.data, name)()
+        mask = fh_mask(image)
+        params = []
+        for _ in range(args.crops):
+            torch.manual_seed(int(torch.randint(2**31, (1,), generator=rng)))
+            params.append(transforms.RandomResizedCrop.get_params(Image.fromarray(image), scale=(0.08, 1.0),
+                                                                 ratio=(3.0/4.0, 4.0/3.0)))
+        samples.append((image.shape[:2], mask, params))
+
+    full = []
+    for image_size, mask, params in samples:
+        crops = [crop(mask[None], image_size, p, args.crop_size, 1) for p in params]
+        full.append(pooled_ids(crops, args.pool_size))
+
+    print(f"{len(IMAGES)} images x {args.crops} crops, {args.crop_size} crop, pool {args.pool_size}x{args.pool_size}")
+    print(f"{'downsample':>10}{'stride':>8}{'mask (KB)':>11}{'unpickle (us)':>15}{'crop (us)':>11}{'agreement':>11}")
+    for downsample in (int(d) for d in args.downsamples.split(',')):
+        for stride in (int(s) for s in args.strides.split(',')):
+            nbytes, load_time, crop_time, agree, cells = 0, 0., 0., 0, 0
+            for (image_size, mask, params), full_ids in zip(samples, full):
+                stored = downsample_mask(mask, downsample)
+                size, load = unpickle_time(stored)
+                nbytes, load_time = nbytes + size, load_time + load
+                start = time.time()
+                crops = [crop(stored[None], image_size, p, args.crop_size, stride) for p in params]
+                crop_time += time.time() - start
+                ids = pooled_ids(crops, args.pool_size)
+                agree, cells = agree + int((ids == full_ids).sum()), cells + ids.numel()
+            agreement = agree / cells
+            flag = '' if agreement >= args.min_agreement else '  < min agreement'
+            print(f"{downsample:>10}{stride:>8}{nbytes / len(samples) / 2**10:>11.1f}"
+                  f"{load_time / len(samples) * 1e6:>15.1f}{crop_time / len(samples) / args.crops * 1e6:>11.1f}"
+                  f"{agreement:>11.3f}{flag}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#-*- coding:utf-8 -*-
+"""
+Parameters, FLOPs and latency of Masknet for several model.masknet settings,
+and the resulting training step time of BYOLModel. FLOPs and latency are for
+one Masknet forward over the 2B views of one branch; every step runs it for
+the online and the target branch.
+
+    python benchmarks/bench_masknet.py --pool-size 28 --batch-size 4 --settings "2048,2048;1024,1024;512;;off"
+"""
+import argparse
+
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+
+from bench_utils import load_config, get_device, random_batch, timeit, train_step
+from model import BYOLModel
+from losses import DetconInfoNCECriterion
+
+parser = argparse.ArgumentParser(description='Masknet width benchmark')
+parser.add_argument('--cfg', default='train_imagenet_300')
+parser.add_argument('--pool-size', type=int, default=7)
+parser.add_argument('--batch-size', type=int, default=4)
+parser.add_argument('--iters', type=int, default=3)
+parser.add_argument('--settings', default='2048,2048;1024,1024;512;;off',
+                    help='semicolon separated hidden_dims settings, empty for no hidden layer, "off" to disable')
+
+
+def main():
+    args = parser.parse_args()
+    device = get_device()
+    config = load_config(args.cfg, train_batch_size=args.batch_size)
+    config['loss']['pool_size'] = args.pool_size
+    criterion = DetconInfoNCECriterion(config)
+    images, masks = random_batch(args.batch_size, device=device)
+    grid = args.pool_size
+    features = torch.randn(2 * args.batch_size, config['model']['projection']['input_dim'], grid, grid, device=device)
+    roi_masks = torch.rand(2 * args.batch_size, config['loss']['mask_rois'], grid * grid, device=device)
+
+    print(f"pool_size {args.pool_size}, batch {args.batch_size} x 2 views, device {device}")
+    print(f"{'hidden_dims':<14}{'params (M)':>11}{'GFLOPs':>9}{'masknet (ms)':>14}{'step (s)':>10}")
+    for setting in args.settings.split(';'):
+        torch.manual_seed(0)
+        enabled = setting != 'off'
+        hidden_dims = [int(d) for d in setting.split(',') if d] if enabled else []
+        config['model']['masknet'] = {'enabled': enabled, 'hidden_dims': hidden_dims}
+        model = BYOLModel(config).to(device).train()
+
+        params, gflops, latency = 0., 0., 0.
+        if model.masknet is not None:
+            params = sum(p.numel() for p in model.masknet.parameters()) / 1e6
+            with torch.no_grad():
+                with FlopCounterMode(display=False) as counter:
+                    model.masknet(features, roi_masks)
+                gflops = counter.get_total_flops() / 1e9
+                latency = timeit(lambda: model.masknet(features, roi_masks), args.iters, device=device) * 1000
+
+        step_time = timeit(lambda: train_step(model, criterion, images, masks), args.iters, device=device)
+        name = setting if enabled else 'disabled'
+        print(f"{name or '[]':<14}{params:>11.2f}{gflops:>9.2f}{latency:>14.1f}{step_time:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#-*- coding:utf-8 -*-
+"""
+Cost and learning signal of data.local_crops: per decoded image, the time to
+decode a JPEG and make the two global views plus the local crops, the training
+step time of BYOLModel with DetconInfoNCECriterion, and the number of
+online-to-target view pairs the loss gets from each image.
+
+    python benchmarks/bench_multi_crop.py --batch-size 8 --local-crops 0,2,4,6 --local-crop-size 96
+"""
+import io
+import argparse
+
+import numpy as np
+import torch
+from PIL import Image
+
+from bench_utils import load_config, get_device, random_batch, timeit, train_step
+from model import BYOLModel
+from losses import DetconInfoNCECriterion
+from data.byol_transform import MultiViewDataInjector, get_transform
+
+parser = argparse.ArgumentParser(description='Multi-crop benchmark')
+parser.add_argument('--cfg', default='train_imagenet_300')
+parser.add_argument('--pool-size', type=int, default=7)
+parser.add_argument('--batch-size', type=int, default=8)
+parser.add_argument('--iters', type=int, default=3)
+parser.add_argument('--local-crops', default='0,2,4,6')
+parser.add_argument('--local-crop-size', type=int, default=96)
+
+
+def load_time(num_local_crops, local_crop_size, iters):
+    """Seconds per image to decode a JPEG and make its global views and local crops"""
+    buffer = io.BytesIO()
+    Image.fromarray(np.random.randint(0, 256, (375, 500, 3), dtype=np.uint8)).save(buffer, format='JPEG')
+    mask = torch.randint(0, 8, (1, 375, 500))
+    transform = MultiViewDataInjector(
+        [get_transform('train'), get_transform('train', gb_prob=0.1, solarize_prob=0.2)],
+        get_transform('train', gb_prob=0.5, crop_size=local_crop_size, scale=(0.05, 0.4)), num_local_crops)
+
+    def load():
+        buffer.seek(0)
+        transform(Image.open(buffer).convert('RGB'), mask)
+
+    return timeit(load, 10 * iters)
+
+
+def main():
+    args = parser.parse_args()
+    device = get_device()
+    config = load_config(args.cfg, train_batch_size=args.batch_size)
+    config['loss']['pool_size'] = args.pool_size
+    criterion = DetconInfoNCECriterion(config)
+    torch.manual_seed(0)
+    model = BYOLModel(config).to(device).train()
+    images, masks = random_batch(args.batch_size, device=device)
+
+    print(f"pool_size {args.pool_size}, batch {args.batch_size} x 2 views, "
+          f"local crops of {args.local_crop_size} px, device {device}")
+    print(f"{'local crops':>12}{'load (ms/image)':>17}{'step (s)':>10}{'pairs/image':>13}{'step (ms/pair)':>15}")
+    for num_local_crops in (int(n) for n in args.local_crops.split(',')):
+        local_images, local_masks = random_batch(args.batch_size, crop_size=args.local_crop_size,
+                                                 device=device, num_views=num_local_crops)
+        local = {'local_images': local_images, 'local_masks': local_masks} if num_local_crops else {}
+
+        step_time = timeit(lambda: train_step(model, criterion, images, masks, **local), args.iters, device=device)
+        load = load_time(num_local_crops, args.local_crop_size, args.iters) * 1000
+        pairs = 2 + 2 * num_local_crops
+        print(f"{num_local_crops:>12}{load:>17.2f}{step_time:>10.3f}{pairs:>13}"
+              f"{step_time * 1000 / (args.batch_size * pairs):>15.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#-*- coding:utf-8 -*-
+"""
+Weak-scaling benchmark of DetconInfoNCECriterion on CPU processes (gloo).
+Simulates 1..N nodes of `--ranks-per-node` ranks each and times forward+backward
+of the loss for each negatives mode:
+    world:        gather negatives from the whole world (default)
+    node:         negatives_group_size = "node"
+    hierarchical: whole world, gathered intra-node first, then inter-node
+
+    python benchmarks/bench_negatives_scaling.py --max-nodes 4 --ranks-per-node 2
+"""
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from losses import DetconInfoNCECriterion
+
+parser = argparse.ArgumentParser(description='DetCon negatives scaling benchmark')
+parser.add_argument('--max-nodes', type=int, default=4)
+parser.add_argument('--ranks-per-node', type=int, default=2)
+parser.add_argument('--batch-size', type=int, default=16)
+parser.add_argument('--mask-rois', type=int, default=16)
+parser.add_argument('--dim', type=int, default=256)
+parser.add_argument('--iters', type=int, default=10)
+parser.add_argument('--modes', default='world,node,hierarchical')
+parser.add_argument('--port', type=int, default=29511)
+
+
+def make_config(args, mode, rank, world_size):
+    return {
+        'rank': rank,
+        'world_size': world_size,
+        'local_world_size': args.ranks_per_node,
+        'data': {'train_batch_size': args.batch_size},
+        'loss': {
+            'temperature': 0.1,
+            'mask_rois': args.mask_rois,
+            'negatives_group_size': 'node' if mode == 'node' else None,
+            'hierarchical_gather': mode == 'hierarchical',
+        },
+    }
+
+
+def worker(rank, world_size, args, mode, port, results):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.set_num_threads(1)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    criterion = DetconInfoNCECriterion(make_config(args, mode, rank, world_size))
+
+    n = 2 * args.batch_size
+    pred = torch.randn(n, args.mask_rois, args.dim, requires_grad=True)
+    target = torch.randn(n, args.mask_rois, args.dim)
+    pind = torch.randint(0, 8, (n, args.mask_rois))
+    tind = torch.randint(0, 8, (n, args.mask_rois))
+
+    times = []
+    for i in range(args.iters + 2):
+        dist.barrier()
+        start = time.time()
+        loss = criterion(target, pred, tind, pind)
+        loss.backward()
+        times.append(time.time() - start)
+    step_time = torch.tensor(sum(times[2:]) / args.iters)
+    dist.all_reduce(step_time, op=dist.ReduceOp.MAX)
+    if rank == 0:
+        results.put(step_time.item())
+    dist.destroy_process_group()
+
+
+def main():
+    args = parser.parse_args()
+    ctx = mp.get_context('spawn')
+    port = args.port
+    print(f"{'mode':<14}{'nodes':>6}{'ranks':>6}{'negatives':>11}{'step (ms)':>11}{'efficiency':>12}")
+    for mode in args.modes.split(','):
+        base = None
+        for nodes in range(1, args.max_nodes + 1):
+            world_size = nodes * args.ranks_per_node
+            results = ctx.SimpleQueue()
+            mp.spawn(worker, args=(world_size, args, mode, port, results), nprocs=world_size, join=True)
+            port += 1
+            step_time = results.get()
+            base = base or step_time
+            group = args.ranks_per_node if mode == 'node' else world_size
+            print(f"{mode:<14}{nodes:>6}{world_size:>6}{group * args.batch_size:>11}"
+                  f"{step_time * 1000:>11.2f}{base / step_time:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
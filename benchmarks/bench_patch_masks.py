@@ -0,0 +1,81 @@
+#-*- coding:utf-8 -*-
+"""
+mask_type "patch" with grid masks read from the pickles gen_masks.py writes against
+grid masks made at load time (SSLMaskDataset patch_segments). On a synthetic dataset,
+reports the mask bytes on disk, the mean SSLMaskDataset.load() time of each source
+and the time to make one mask with the former per-cell loops and the vectorized grid.
+
+    python benchmarks/bench_patch_masks.py --images 256 --segments 3,3
+"""
+import os
+import time
+import pickle
+import argparse
+import tempfile
+
+import torch
+
+from bench_utils import make_dataset, timeit
+from data.byol_transform import SSLMaskDataset
+from utils.mask_utils import patch_mask
+
+parser = argparse.ArgumentParser(description='Patch masks benchmark')
+parser.add_argument('--images', type=int, default=256)
+parser.add_argument('--segments', default='3,3')
+
+
+def loop_patch_mask(height, width, segments):
+    """create_patch_mask before the vectorized grid"""
+    dims = [height // segments[0], width // segments[1]]
+    mask = torch.hstack([torch.cat([torch.zeros(dims[0], dims[1]) + i + (j * (segments[0]))
+                                    for i in range(segments[0])]) for j in range(segments[1])])
+    if height % segments[0]:
+        mask = torch.cat([mask, torch.stack([mask[-1, :] for i in range(height % segments[0])])])
+    if width % segments[1]:
+        mask = torch.hstack([mask, torch.stack([mask[:, -1] for i in range(width % segments[1])]).T])
+    return mask.int()
+
+
+def write_patch_masks(root, segments):
+    """Patch mask pickles and train_tf_img_to_patch.pkl, as gen_masks_tf.py writes them"""
+    dataset = SSLMaskDataset(os.path.join(root, 'images', 'train'), None, patch_segments=segments)
+    mask_files = []
+    for index in range(len(dataset)):
+        mask = dataset.load(index)[1]
+        mask_files.append(os.path.join(root, 'masks', 'train_tf', f'{index:05d}_patch.pkl'))
+        with open(mask_files[-1], 'wb') as f:
+            pickle.dump(mask.clone(), f, protocol=pickle.HIGHEST_PROTOCOL)
+    mask_file = os.path.join(root, 'masks', 'train_tf_img_to_patch.pkl')
+    with open(mask_file, 'wb') as f:
+        pickle.dump(mask_files, f)
+    return mask_file, sum(os.path.getsize(f) for f in mask_files)
+
+
+def load_time(dataset):
+    start = time.time()
+    for index in range(len(dataset)):
+        dataset.load(index)
+    return (time.time() - start) / len(dataset)
+
+
+def main():
+    args = parser.parse_args()
+    segments = tuple(int(s) for s in args.segments.split(','))
+    with tempfile.TemporaryDirectory() as root:
+        make_dataset(root, args.images)
+        mask_file, nbytes = write_patch_masks(root, segments)
+        image_dir = os.path.join(root, 'images', 'train')
+        print(f"{args.images} images, {segments[0]}x{segments[1]} patches, "
+              f"{nbytes / 2**20:.1f} MB of mask files")
+        files = SSLMaskDataset(image_dir, mask_file)
+        procedural = SSLMaskDataset(image_dir, None, patch_segments=segments)
+        assert all(torch.equal(files.load(i)[1], procedural.load(i)[1]) for i in range(len(files)))
+        print(f"load() from mask files   {load_time(files) * 1e3:.2f} ms/sample")
+        print(f"load() with procedural   {load_time(procedural) * 1e3:.2f} ms/sample")
+        patch_mask.cache_clear()
+        print(f"per-cell loops           {timeit(lambda: loop_patch_mask(375, 500, segments), 20) * 1e3:.3f} ms/mask")
+        print(f"vectorized, uncached     {timeit(lambda: patch_mask.__wrapped__(375, 500, segments), 20) * 1e3:.3f} ms/mask")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#-*- coding:utf-8 -*-
+"""
+Batch allocation of the default collate against data.pinned_ring: ImageLoader on a
+synthetic dataset, read through utils.data_prefetcher for a few epochs. Reports the
+epoch time and the allocator counters of each path: shared-memory batch tensors
+allocated by the workers' collate_views, pinned host allocations of the CUDA caching
+host allocator (pin_memory copies), and the ring's slot claims, waits and reclaims.
+
+    python benchmarks/bench_pinned_ring.py --images 256 --batch-size 32 --workers 2 --epochs 2
+"""
+import time
+import argparse
+import tempfile
+
+import torch
+
+from bench_utils import load_config, make_dataset, get_device
+from data import ImageLoader
+from data.byol_transform import collate_views
+from utils.data_prefetcher import data_prefetcher
+
+parser = argparse.ArgumentParser(description='Pinned batch ring benchmark')
+parser.add_argument('--images', type=int, default=256)
+parser.add_argument('--batch-size', type=int, default=32)
+parser.add_argument('--workers', type=int, default=2)
+parser.add_argument('--epochs', type=int, default=2)
+
+
+class CountingCollate():
+    """collate_views counting the batch tensors it allocates, from every worker"""
+
+    def __init__(self):
+        self.counts = torch.zeros(2, dtype=torch.int64).share_memory_()
+
+    def __call__(self, batch):
+        batch = collate_views(batch)
+        self.counts[0] += len(batch)
+        self.counts[1] += sum(t.numel() * t.element_size() for t in batch)
+        return batch
+
+
+def host_allocations():
+    if not torch.cuda.is_available():
+        return None
+    return torch.cuda.host_memory_stats().get('num_host_alloc', 0)
+
+
+def run(root, args, pinned_ring):
+    config = load_config(image_dir=root, data_workers=args.workers, pinned_ring=pinned_ring, persistent_workers=True)
+    data_ins = ImageLoader(config)
+    loader = data_ins.get_loader('train', args.batch_size)
+    collate = None
+    if not pinned_ring:
+        collate = loader.collate_fn = CountingCollate()
+    host_before = host_allocations()
+    start = time.time()
+    for epoch in range(1, args.epochs + 1):
+        data_ins.set_epoch(epoch)
+        prefetcher = data_prefetcher(loader)
+        images, *_ = prefetcher.next()
+        while images is not None:
+            images, *_ = prefetcher.next()
+        prefetcher.close()
+    epoch_time = (time.time() - start) / args.epochs
+    host = host_allocations() - host_before if host_before is not None else None
+    return epoch_time, collate, data_ins.ring, host
+
+
+def main():
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as root:
+        make_dataset(root, args.images)
+        print(f"{args.images} images, batch {args.batch_size}, {args.workers} workers, "
+              f"{args.epochs} epochs, device {get_device()}")
+        for pinned_ring in (False, True):
+            epoch_time, collate, ring, host = run(root, args, pinned_ring)
+            print(f"\n{'pinned ring' if pinned_ring else 'default collate + pin_memory'}: {epoch_time:.2f} s/epoch")
+            if collate is not None:
+                tensors, nbytes = collate.counts.tolist()
+                print(f"  shared-memory batch tensors allocated {tensors} ({nbytes / 2**20:.1f} MB)")
+            if ring is not None:
+                stats = ring.stats()
+                print(f"  ring {stats['slots']} slots x {stats['slot_bytes'] / 2**20:.1f} MB, pinned {stats['pinned']}: "
+                      f"claims {stats['claims']} waits {stats['waits']} reclaims {stats['reclaims']}")
+            if host is not None:
+                print(f"  pinned host allocations {host}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#-*- coding:utf-8 -*-
+"""
+Training-loop waits on utils.data_prefetcher for several queue depths, with and
+without the background thread and on-device uint8 normalization: ImageLoader on a
+synthetic dataset, consumed by a loop that sleeps for a fixed step time per batch.
+Reports the epoch time, how many batches the loop waited for and the total wait.
+
+    python benchmarks/bench_prefetcher.py --images 256 --workers 2 --step-time 50 --depths 1,2,4
+"""
+import time
+import argparse
+import tempfile
+
+from bench_utils import load_config, make_dataset, get_device
+from data import ImageLoader
+from utils.data_prefetcher import data_prefetcher
+
+parser = argparse.ArgumentParser(description='Prefetcher benchmark')
+parser.add_argument('--images', type=int, default=256)
+parser.add_argument('--batch-size', type=int, default=16)
+parser.add_argument('--workers', type=int, default=2)
+parser.add_argument('--step-time', type=float, default=50., help='simulated training step in ms')
+parser.add_argument('--depths', default='1,2,4')
+
+
+def run(root, args, depth, background, normalize):
+    config = load_config(image_dir=root, data_workers=args.workers, normalize_on_device=normalize)
+    data_ins = ImageLoader(config)
+    loader = data_ins.get_loader('train', args.batch_size)
+    data_ins.set_epoch(1)
+    start = time.time()
+    prefetcher = data_prefetcher(loader, depth=depth, normalize=normalize, background=background)
+    images, *_ = prefetcher.next()
+    while images is not None:
+        time.sleep(args.step_time / 1000)
+        images, *_ = prefetcher.next()
+    prefetcher.close()
+    return time.time() - start, prefetcher
+
+
+def main():
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as root:
+        make_dataset(root, args.images)
+        device = get_device()
+        print(f"{args.images} images, batch {args.batch_size}, {args.workers} workers, "
+              f"{args.step_time:.0f} ms per step, device {device}")
+        print(f"{'depth':>6}{'thread':>8}{'uint8':>7}{'epoch (s)':>11}{'waits':>9}{'wait (s)':>10}")
+        for depth in (int(d) for d in args.depths.split(',')):
+            # CPU runs always prefetch from the thread
+            for background in ((False, True) if device.type == 'cuda' else (True,)):
+                for normalize in (False, True):
+                    epoch_time, prefetcher = run(root, args, depth, background, normalize)
+                    print(f"{depth:>6}{str(background):>8}{str(normalize):>7}{epoch_time:>11.2f}"
+                          f"{f'{prefetcher.waits}/{prefetcher.batches}':>9}{prefetcher.wait_time:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#-*- coding:utf-8 -*-
+"""
+Throughput of each crop size of a data.resolution_schedule: augmentation time
+per sample (two views of a synthetic image) and training step time of
+BYOLModel, then the wall-clock of the whole schedule relative to training
+every epoch at resize_size.
+
+    python benchmarks/bench_progressive_resolution.py --pool-size 7 --batch-size 8 \
+        --schedule 1:128,101:160,201:224 --epochs 300
+"""
+import argparse
+
+import numpy as np
+import torch
+from PIL import Image
+
+from bench_utils import load_config, get_device, random_batch, timeit, train_step
+from model import BYOLModel
+from losses import DetconInfoNCECriterion
+from data.byol_transform import MultiViewDataInjector, get_transform
+from data.image_loader import scheduled_crop_size
+
+parser = argparse.ArgumentParser(description='Progressive resolution benchmark')
+parser.add_argument('--cfg', default='train_imagenet_300')
+parser.add_argument('--pool-size', type=int, default=7)
+parser.add_argument('--batch-size', type=int, default=8)
+parser.add_argument('--iters', type=int, default=3)
+parser.add_argument('--schedule', default='1:128,101:160,201:224', help='start_epoch:crop_size pairs')
+parser.add_argument('--epochs', type=int, default=300)
+
+
+def augment_time(crop_size, iters):
+    """Seconds per sample of the two-view mask-aware augmentation at crop_size"""
+    image = Image.fromarray(np.random.randint(0, 256, (375, 500, 3), dtype=np.uint8))
+    mask = torch.randint(0, 8, (1, 375, 500))
+    transform = MultiViewDataInjector([get_transform('train', crop_size=crop_size),
+                                       get_transform('train', gb_prob=0.1, solarize_prob=0.2, crop_size=crop_size)])
+    return timeit(lambda: transform(image, mask), 10 * iters)
+
+
+def main():
+    args = parser.parse_args()
+    device = get_device()
+    config = load_config(args.cfg, train_batch_size=args.batch_size)
+    config['loss']['pool_size'] = args.pool_size
+    schedule = {int(k): int(v) for k, v in (pair.split(':') for pair in args.schedule.split(','))}
+    default = config['data']['resize_size']
+    criterion = DetconInfoNCECriterion(config)
+    torch.manual_seed(0)
+    model = BYOLModel(config).to(device).train()
+
+    print(f"pool_size {args.pool_size}, batch {args.batch_size} x 2 views, device {device}")
+    print(f"{'crop':>6}{'grid':>6}{'augment (ms)':>14}{'step (s)':>10}{'images/s':>10}")
+    step_times = {}
+    for crop_size in sorted(set(schedule.values()) | {default}):
+        images, masks = random_batch(args.batch_size, crop_size=crop_size, device=device)
+
+        step_times[crop_size] = timeit(lambda: train_step(model, criterion, images, masks), args.iters, device=device)
+        augment = augment_time(crop_size, args.iters) * 1000
+        print(f"{crop_size:>6}{crop_size // model.feature_stride:>6}{augment:>14.2f}"
+              f"{step_times[crop_size]:>10.3f}{args.batch_size / step_times[crop_size]:>10.1f}")
+
+    total = sum(step_times[scheduled_crop_size(schedule, epoch, default)] for epoch in range(1, args.epochs + 1))
+    print(f"schedule {args.schedule} over {args.epochs} epochs: "
+          f"{total / (args.epochs * step_times[default]):.2f}x the step time of {default} px every epoch")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#-*- coding:utf-8 -*-
+"""
+Loader throughput of data.repeated_augmentation on an I/O-limited setup: a
+synthetic ImageNet-style dataset (JPEGs and FH mask pickles) read through
+ImageLoader with a simulated storage latency added to every image read.
+Reports image reads and view pairs per epoch and view pairs per second.
+
+    python benchmarks/bench_repeated_augmentation.py --images 512 --io-latency 20 --workers 4 --repeats 1,2,4
+"""
+import time
+import argparse
+import tempfile
+
+from bench_utils import load_config, make_dataset, SlowLoader
+from data import ImageLoader
+
+parser = argparse.ArgumentParser(description='Repeated augmentation benchmark')
+parser.add_argument('--images', type=int, default=512)
+parser.add_argument('--batch-size', type=int, default=32)
+parser.add_argument('--workers', type=int, default=4)
+parser.add_argument('--io-latency', type=float, default=20., help='simulated ms per image read')
+parser.add_argument('--repeats', default='1,2,4')
+
+
+def main():
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as root:
+        make_dataset(root, args.images)
+        print(f"{args.images} images, batch {args.batch_size}, {args.workers} workers, "
+              f"{args.io_latency:.0f} ms per read")
+        print(f"{'K':>3}{'reads/epoch':>13}{'pairs/epoch':>13}{'epoch (s)':>11}{'pairs/s':>10}")
+        for repeats in (int(k) for k in args.repeats.split(',')):
+            config = load_config(image_dir=root, data_workers=args.workers, repeated_augmentation=repeats)
+            data_ins = ImageLoader(config)
+            loader = data_ins.get_loader('train', args.batch_size)
+            loader.dataset.loader = SlowLoader(args.io_latency / 1000)
+            data_ins.set_epoch(1)
+            reads = len(data_ins.train_sampler) if data_ins.train_sampler is not None else len(loader.dataset)
+
+            start = time.time()
+            pairs = sum(images.shape[0] // 2 for images, masks in loader)
+            epoch_time = time.time() - start
+            print(f"{repeats:>3}{reads:>13}{pairs:>13}{epoch_time:>11.2f}{pairs / epoch_time:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#-*- coding:utf-8 -*-
+"""
+Epoch time and hit rate of the node-local StagingCache (data.staging_dir) over
+several epochs of ImageLoader on a synthetic dataset whose "remote" image reads
+have a simulated latency: reading in place against staging with an unlimited
+budget and with budgets smaller than the dataset (LRU eviction).
+
+    python benchmarks/bench_staging_cache.py --images 512 --io-latency 20 --workers 4 --budgets 1,0.5
+"""
+import os
+import time
+import argparse
+import tempfile
+
+from bench_utils import load_config, make_dataset, SlowLoader
+from data import ImageLoader
+from data.staging_cache import StagingCache
+
+parser = argparse.ArgumentParser(description='Staging cache benchmark')
+parser.add_argument('--images', type=int, default=512)
+parser.add_argument('--batch-size', type=int, default=32)
+parser.add_argument('--workers', type=int, default=4)
+parser.add_argument('--epochs', type=int, default=3)
+parser.add_argument('--io-latency', type=float, default=20., help='simulated ms per remote image read')
+parser.add_argument('--budgets', default='1,0.5', help='staging budgets as fractions of the dataset size')
+
+
+class RemoteStagingCache(StagingCache):
+    """StagingCache whose image copies pay the simulated remote read latency"""
+
+    def __init__(self, cache_dir, budget_bytes, latency):
+        super().__init__(cache_dir, budget_bytes, min_age=0.)
+        self.latency = latency
+
+    def _copy(self, path, tmp_path):
+        if not path.endswith('.pkl'):
+            time.sleep(self.latency)
+        super()._copy(path, tmp_path)
+
+
+def dataset_bytes(root):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(root) for f in files)
+
+
+def run(root, args, cache=None):
+    config = load_config(image_dir=root, data_workers=args.workers)
+    data_ins = ImageLoader(config)
+    loader = data_ins.get_loader('train', args.batch_size)
+    if cache is None:
+        loader.dataset.loader = SlowLoader(args.io_latency / 1000)
+    else:
+        loader.dataset.cache = cache
+    results = []
+    for epoch in range(1, args.epochs + 1):
+        data_ins.set_epoch(epoch)
+        before = cache.stats() if cache is not None else None
+        start = time.time()
+        for _ in loader:
+            pass
+        epoch_time = time.time() - start
+        if cache is None:
+            results.append((epoch_time, None))
+        else:
+            stats = cache.stats()
+            hits, misses = stats['hits'] - before['hits'], stats['misses'] - before['misses']
+            results.append((epoch_time, hits / max(hits + misses, 1)))
+    return results
+
+
+def main():
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as staging_root:
+        make_dataset(root, args.images)
+        size = dataset_bytes(root)
+        print(f"{args.images} images ({size / 2**20:.1f} MB), batch {args.batch_size}, {args.workers} workers, "
+              f"{args.io_latency:.0f} ms per remote image read")
+        print(f"{'mode':<16}" + ''.join(f"{f'epoch {e} (s)':>13}{'hits':>6}" for e in range(1, args.epochs + 1)))
+
+        settings = [('in place', None)] + [(f'staged {b}x', float(b)) for b in args.budgets.split(',')]
+        for name, budget in settings:
+            cache = None
+            if budget is not None:
+                cache = RemoteStagingCache(os.path.join(staging_root, name.replace(' ', '_')),
+                                           int(budget * size), args.io_latency / 1000)
+            row = run(root, args, cache)
+            print(f"{name:<16}" + ''.join(f"{t:>13.2f}" + (f"{h:>6.2f}" if h is not None else f"{'-':>6}")
+                                          for t, h in row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#-*- coding:utf-8 -*-
+"""
+Target branch cost (EMA update + no_grad forward) and target weight memory
+for each model.target_dtype.
+
+    python benchmarks/bench_target_precision.py --batch-size 8 --dtypes float32,bfloat16
+"""
+import argparse
+
+import torch
+
+from bench_utils import load_config, get_device, random_batch, timeit
+from model import BYOLModel
+from utils.mask_utils import convert_binary_mask
+
+parser = argparse.ArgumentParser(description='Target network precision benchmark')
+parser.add_argument('--cfg', default='train_imagenet_300')
+parser.add_argument('--pool-size', type=int, default=7)
+parser.add_argument('--batch-size', type=int, default=8)
+parser.add_argument('--iters', type=int, default=3)
+parser.add_argument('--dtypes', default='float32,bfloat16')
+
+
+def main():
+    args = parser.parse_args()
+    device = get_device()
+    config = load_config(args.cfg, train_batch_size=args.batch_size)
+    config['loss']['pool_size'] = args.pool_size
+    images, masks = random_batch(args.batch_size, device=device)
+    masks = convert_binary_mask(masks, pool_size=args.pool_size)
+
+    print(f"pool_size {args.pool_size}, batch {args.batch_size} x 2 views, device {device}")
+    print(f"{'target_dtype':<14}{'weights MB':>12}{'master MB':>11}{'EMA (s)':>9}{'forward (s)':>13}")
+    for dtype in args.dtypes.split(','):
+        config['model']['target_dtype'] = dtype
+        model = BYOLModel(config).to(device).train()
+        target_dtype = getattr(torch, dtype)
+        weights = sum(p.numel() * p.element_size() for p in model.target_network.parameters()) / 2**20
+        master = 0. if model.target_master is None else model.target_master.numel() * 4 / 2**20
+
+        def ema():
+            model._update_target_network(0.99)
+
+        @torch.no_grad()
+        def forward():
+            with torch.autocast(device_type=device.type, dtype=target_dtype, enabled=dtype != 'float32'):
+                model.target_network(images, masks, model.masknet)
+
+        ema_time = timeit(ema, args.iters, device=device)
+        forward_time = timeit(forward, args.iters, device=device)
+        print(f"{dtype:<14}{weights:>12.1f}{master:>11.1f}{ema_time:>9.3f}{forward_time:>13.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#-*- coding:utf-8 -*-
+"""
+Throughput of the two data.transform_backend pipelines, torchvision/PIL ('pil') and
+OpenCV ('albumentations'), on a synthetic dataset. Reports the samples/s of the
+two-view transform alone, on images decoded once up front, then of the ImageLoader
+train loader reading and decoding the files, with float and uint8 (normalize_on_device) outputs.
+
+    python benchmarks/bench_transform_backend.py --images 256 --workers 2 --local-crops 0
+"""
+import time
+import argparse
+import tempfile
+
+from bench_utils import load_config, make_dataset
+from data import ImageLoader
+
+parser = argparse.ArgumentParser(description='Transform backend benchmark')
+parser.add_argument('--images', type=int, default=256)
+parser.add_argument('--batch-size', type=int, default=32)
+parser.add_argument('--workers', type=int, default=2)
+parser.add_argument('--local-crops', type=int, default=0)
+parser.add_argument('--backends', default='pil,albumentations')
+
+
+def transform_rate(root, args, **data):
+    """samples/s of the dataset transform on decoded images, in this process"""
+    config = load_config(image_dir=root, local_crops=args.local_crops, **data)
+    dataset = ImageLoader(config).get_dataset('train')
+    decoded = [dataset.load(i) for i in range(len(dataset))]
+    dataset.transform(decoded[0][0], decoded[0][1].unsqueeze(0))
+    start = time.time()
+    for image, mask in decoded:
+        dataset.transform(image, mask.unsqueeze(0))
+    return len(decoded) / (time.time() - start)
+
+
+def loader_rate(root, args, **data):
+    """samples/s of an epoch of the train loader"""
+    config = load_config(image_dir=root, data_workers=args.workers, local_crops=args.local_crops, **data)
+    data_ins = ImageLoader(config)
+    loader = data_ins.get_loader('train', args.batch_size)
+    data_ins.set_epoch(1)
+    start = time.time()
+    samples = sum(len(batch[0]) // 2 for batch in loader)
+    return samples / (time.time() - start)
+
+
+def main():
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as root:
+        make_dataset(root, args.images)
+        print(f"{args.images} images, batch {args.batch_size}, {args.workers} workers, "
+              f"{args.local_crops} local crops")
+        print(f"{'backend':<16}{'uint8':>7}{'transform (samples/s)':>23}{'loader (samples/s)':>20}")
+        for backend in args.backends.split(','):
+            for uint8 in (False, True):
+                data = dict(transform_backend=backend, normalize_on_device=uint8)
+                print(f"{backend:<16}{str(uint8):>7}{transform_rate(root, args, **data):>23.1f}"
+                      f"{loader_rate(root, args, **data):>20.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#-*- coding:utf-8 -*-
+"""Shared helpers of the benchmark scripts (single process, CPU or one GPU)"""
+import os
+import sys
+import time
+import pickle
+import resource
+
+import yaml
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.datasets.folder import default_loader
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def load_config(cfg='train_imagenet_300', **data_overrides):
+    """Load a training config set up for a single non-distributed process"""
+    cfg = cfg if cfg.endswith('.yaml') else cfg + '.yaml'
+    with open(os.path.join(ROOT, 'config', cfg), 'r') as f:
+        config = yaml.safe_load(f)
+    config.update({'world_size': 1, 'rank': 0, 'local_rank': 0, 'local_world_size': 1, 'distributed': False})
+    config['log']['wandb_enable'] = False
+    config['data'].update(data_overrides)
+    return config
+
+
+def get_device():
+    return torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+
+def random_batch(batch_size, crop_size=224, num_segments=8, device='cpu', num_views=2):
+    """Random view-major views (VB, 3, H, W) and blocky segment masks (VB, 1, H, W), as from collate_views"""
+    images = torch.randn(num_views * batch_size, 3, crop_size, crop_size, device=device)
+    cells = torch.randint(0, num_segments, (num_views * batch_size, 1, crop_size // 16, crop_size // 16), device=device)
+    masks = cells.repeat_interleave(16, dim=2).repeat_interleave(16, dim=3)
+    return images, masks
+
+
+def train_step(model, criterion, images, masks, **model_kwargs):
+    """One BYOLModel training step: forward at momentum 0.99, DetconInfoNCECriterion, backward"""
+    q, target_z, pinds, tinds = model(images, 0.99, masks, None, **model_kwargs)
+    loss = criterion(target_z, q, tinds, pinds)
+    model.zero_grad(set_to_none=True)
+    loss.backward()
+    return loss
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def timeit(fn, iters, warmup=1, device='cpu'):
+    """Average wall time of fn() over `iters` calls after `warmup` calls"""
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    start = time.time()
+    for _ in range(iters):
+        fn()
+    synchronize(device)
+    return (time.time() - start) / iters
+
+
+def peak_memory_mb(device='cpu'):
+    """Peak allocated CUDA memory, or peak resident set size of this process on CPU"""
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated() / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def make_dataset(root, num_images):
+    """images/train/<class>/*.JPEG and masks/train_tf_img_to_fh.pkl as read by SSLMaskDataset"""
+    os.makedirs(os.path.join(root, 'images', 'train', 'n00'))
+    os.makedirs(os.path.join(root, 'masks', 'train_tf'))
+    rng = np.random.RandomState(0)
+    mask_files = []
+    for i in range(num_images):
+        Image.fromarray(rng.randint(0, 256, (375, 500, 3), dtype=np.uint8)).save(
+            os.path.join(root, 'images', 'train', 'n00', f'{i:05d}.JPEG'))
+        mask = torch.from_numpy(rng.randint(0, 8, (375 // 25 + 1, 500 // 25 + 1)))
+        mask = mask.repeat_interleave(25, 0).repeat_interleave(25, 1)[:375, :500].to(torch.int16)
+        mask_files.append(os.path.join(root, 'masks', 'train_tf', f'{i:05d}_fh.pkl'))
+        with open(mask_files[-1], 'wb') as f:
+            pickle.dump(mask, f)
+    with open(os.path.join(root, 'masks', 'train_tf_img_to_fh.pkl'), 'wb') as f:
+        pickle.dump(mask_files, f)
+
+
+class SlowLoader():
+    """default_loader behind a fixed per-read latency"""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def __call__(self, path):
+        time.sleep(self.latency)
+        return default_loader(path)
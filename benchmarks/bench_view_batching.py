@@ -0,0 +1,98 @@
+#-*- coding:utf-8 -*-
+"""
+Bytes allocated per step to batch the two views, from collate to the model
+inputs, with the former sample-major layout (default_collate to (B, 2, C, H, W),
+per-view .contiguous() in the trainer, torch.cat of [v1, v2], [v2, v1] and of
+the masks in the model) against the view-major collate_views layout.
+Also times a DataLoader with workers for each collate.
+
+    python benchmarks/bench_view_batching.py --batch-size 64 --workers 4
+"""
+import time
+import argparse
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+from torch.utils.data import DataLoader, Dataset
+from torch.utils.data._utils.collate import default_collate
+
+from bench_utils import get_device, synchronize
+from data.byol_transform import collate_views
+
+parser = argparse.ArgumentParser(description='View batching benchmark')
+parser.add_argument('--batch-size', type=int, default=64)
+parser.add_argument('--crop-size', type=int, default=224)
+parser.add_argument('--workers', type=int, default=4)
+parser.add_argument('--batches', type=int, default=20)
+
+
+class RandomViews(Dataset):
+    """Pre-generated (2, 3, H, W) views and (2, 1, H, W) masks, as returned by MultiViewDataInjector"""
+
+    def __init__(self, size, crop_size):
+        self.views = torch.randn(8, 2, 3, crop_size, crop_size)
+        self.masks = torch.randint(0, 8, (8, 2, 1, crop_size, crop_size))
+        self.size = size
+
+    def __getitem__(self, index):
+        return self.views[index % 8], self.masks[index % 8]
+
+    def __len__(self):
+        return self.size
+
+
+def sample_major(batch, device):
+    images, masks = default_collate(batch)
+    images, masks = images.to(device), masks.to(device)
+    view1, view2 = images[:, 0].contiguous(), images[:, 1].contiguous()
+    masks = torch.cat([masks[:, i] for i in range(masks.shape[1])])
+    return torch.cat([view1, view2]), torch.cat([view2, view1]), masks
+
+
+def view_major(batch, device):
+    images, masks = collate_views(batch)
+    return images.to(device), masks.to(device)
+
+
+def allocated_bytes(fn, batch, device):
+    """Bytes allocated by one call of fn: CUDA allocator counters, or the profiler's CPU allocations"""
+    if device.type == 'cuda':
+        synchronize(device)
+        before = torch.cuda.memory_stats()['allocated_bytes.all.allocated']
+        fn(batch, device)
+        synchronize(device)
+        return torch.cuda.memory_stats()['allocated_bytes.all.allocated'] - before
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn(batch, device)
+    return sum(max(e.self_cpu_memory_usage, 0) for e in prof.key_averages())
+
+
+def loader_time(collate_fn, args):
+    dataset = RandomViews(args.batch_size * args.batches, args.crop_size)
+    loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.workers,
+                        collate_fn=collate_fn, drop_last=True)
+    start = time.time()
+    for _ in loader:
+        pass
+    return (time.time() - start) / args.batches
+
+
+def main():
+    args = parser.parse_args()
+    device = get_device()
+    dataset = RandomViews(args.batch_size, args.crop_size)
+    batch = [dataset[i] for i in range(args.batch_size)]
+    views_mb = sum(x.numel() * x.element_size() for sample in batch for x in sample) / 2**20
+
+    print(f"batch {args.batch_size} x 2 views, crop {args.crop_size}, device {device}, "
+          f"views + masks {views_mb:.1f} MB, {args.workers} workers")
+    print(f"{'layout':<14}{'allocated MB':>14}{'x batch':>9}{'loader (s/batch)':>18}")
+    for name, fn, collate_fn in (('sample-major', sample_major, default_collate),
+                                 ('view-major', view_major, collate_views)):
+        fn(batch, device)
+        allocated = allocated_bytes(fn, batch, device) / 2**20
+        print(f"{name:<14}{allocated:>14.1f}{allocated / views_mb:>9.2f}{loader_time(collate_fn, args):>18.4f}")
+
+
+if __name__ == '__main__':
+    main()
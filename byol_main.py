@@ -20,20 +20,27 @@ def run_task(config):
         world_size = int(os.environ['WORLD_SIZE'])
         rank = int(os.environ['RANK'])
         local_rank = int(os.environ.get('LOCAL_RANK', '0'))        
-        config.update({'world_size': world_size, 'rank': rank, 'local_rank': local_rank})
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', max(torch.cuda.device_count(), 1)))
+        config.update({'world_size': world_size, 'rank': rank, 'local_rank': local_rank,
+                       'local_world_size': local_world_size})
 
         dist.init_process_group(backend="nccl", world_size=world_size, rank=rank)
         logging.info(f'world_size {world_size}, gpu {local_rank}, rank {rank} init done.')
     else:
-        config.update({'world_size': 1, 'rank': 0, 'local_rank': 0})
+        config.update({'world_size': 1, 'rank': 0, 'local_rank': 0, 'local_world_size': 1})
 
     trainer = BYOLTrainer(config)
     trainer.resume_model()
     start_epoch = trainer.start_epoch
 
-    for epoch in range(start_epoch + 1, trainer.total_epochs + 1):
-        trainer.train_epoch(epoch, printer=logging.info)
-        trainer.save_checkpoint(epoch)
+    try:
+        for epoch in range(start_epoch + 1, trainer.total_epochs + 1):
+            trainer.train_epoch(epoch, printer=logging.info)
+            trainer.save_checkpoint(epoch)
+    except BaseException:
+        trainer.close(abort=True)
+        raise
+    trainer.close()
 
 def main():
     args = parser.parse_args()
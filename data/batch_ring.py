@@ -0,0 +1,195 @@
+#-*- coding:utf-8 -*-
+import time
+import multiprocessing as mp
+
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler, RandomSampler, SequentialSampler
+
+from .byol_transform import aligned_nbytes
+
+
+class SlotBatch(tuple):
+    """Batch fields viewing slot `slot` of a PinnedBatchRing, handed back with release(slot)"""
+
+    def __new__(cls, fields, slot):
+        batch = super().__new__(cls, fields)
+        batch.slot = slot
+        return batch
+
+
+class PinnedBatchRing():
+    """
+    num_slots preallocated batch buffers of slot_bytes each, in one shared-memory
+    tensor that the main process registers as pinned memory when CUDA is available.
+    Loader workers claim a free slot, collate a batch straight into it and send back
+    only the slot number and field layout. The main process views the slot as the
+    batch, and the prefetcher releases the slot once the batch is copied to the device
+    (or used, on CPU). No batch is allocated, shared or pinned per step.
+
+    owner[s] is the loader generation (one per epoch iterator) that claimed slot s, -1
+    if free. Slots claimed by batches the DataLoader discarded when an epoch was left
+    early are reclaimed when the next generation starts. Counters: slots claimed, claims
+    that waited for a free slot, slots reclaimed.
+    """
+    CLAIMS, WAITS, RECLAIMS = range(3)
+    POLL_INTERVAL = 0.001
+
+    def __init__(self, num_slots, slot_bytes):
+        self.num_slots = num_slots
+        self.slot_bytes = slot_bytes
+        self.buffer = torch.empty(num_slots * slot_bytes, dtype=torch.uint8).share_memory_()
+        self.owner = torch.full((num_slots,), -1, dtype=torch.int64).share_memory_()
+        self.counters = torch.zeros(3, dtype=torch.int64).share_memory_()
+        self.lock = mp.Lock()
+        # main process only
+        self.generation = 0
+        self.handed_out = set()
+        self.pinned = False
+        if torch.cuda.is_available():
+            self.pinned = torch.cuda.cudart().cudaHostRegister(self.buffer.data_ptr(), self.buffer.numel(), 0) == 0
+
+    def view(self, slot, offset, dtype, shape):
+        start = slot * self.slot_bytes + offset
+        numel = torch.Size(shape).numel()
+        return self.buffer[start:start + numel * dtype.itemsize].view(dtype).view(shape)
+
+    def claim(self, generation):
+        waited = False
+        while True:
+            with self.lock:
+                free = (self.owner < 0).nonzero()
+                if len(free):
+                    slot = int(free[0])
+                    self.owner[slot] = generation
+                    self.counters[self.CLAIMS] += 1
+                    self.counters[self.WAITS] += waited
+                    return slot
+            waited = True
+            time.sleep(self.POLL_INTERVAL)
+
+    def batch(self, slot, fields):
+        self.handed_out.add(slot)
+        return SlotBatch([self.view(slot, offset, dtype, shape) for dtype, shape, offset in fields], slot)
+
+    def release(self, slot):
+        self.handed_out.discard(slot)
+        with self.lock:
+            self.owner[slot] = -1
+
+    def reclaim(self, generation):
+        """Free the slots of earlier generations that never reached the main process"""
+        with self.lock:
+            for slot in range(self.num_slots):
+                if 0 <= self.owner[slot] < generation and slot not in self.handed_out:
+                    self.owner[slot] = -1
+                    self.counters[self.RECLAIMS] += 1
+
+    def stats(self):
+        claims, waits, reclaims = (int(v) for v in self.counters)
+        return {'slots': self.num_slots, 'slot_bytes': self.slot_bytes, 'pinned': self.pinned,
+                'claims': claims, 'waits': waits, 'reclaims': reclaims}
+
+
+class RingCollate():
+    """collate_views into a PinnedBatchRing slot, returns (slot, [(dtype, shape, offset), ...])"""
+
+    def __init__(self, ring):
+        self.ring = ring
+
+    def __call__(self, batch):
+        generation = batch[0][0]
+        batch = [sample for _, sample in batch]
+        if isinstance(batch[0], list):
+            # RepeatedAugmentation samples, the repeats of an image stay adjacent in the batch
+            batch = [views for repeats in batch for views in repeats]
+        slot = self.ring.claim(generation)
+        fields, offset = [], 0
+        for field in zip(*batch):
+            elem = field[0]
+            shape = (elem.shape[0] * len(field), *elem.shape[1:])
+            out = self.ring.view(slot, offset, elem.dtype, shape)
+            assert offset + aligned_nbytes(out) <= self.ring.slot_bytes, \
+                ValueError(f'batch field at {offset} bytes does not fit in a {self.ring.slot_bytes} byte slot')
+            # view-major, as stack_views
+            torch.stack(field, dim=1, out=out.view(elem.shape[0], len(field), *elem.shape[1:]))
+            fields.append((elem.dtype, shape, offset))
+            offset += aligned_nbytes(out)
+        return slot, fields
+
+
+class _GenerationDataset(Dataset):
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, key):
+        generation, index = key
+        return generation, self.dataset[index]
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getattr__(self, name):
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+
+class _GenerationSampler(Sampler):
+    """(generation, index) pairs of `sampler`, the generation read when an epoch iterator starts"""
+
+    def __init__(self, sampler, ring):
+        self.sampler = sampler
+        self.ring = ring
+
+    def __iter__(self):
+        generation = self.ring.generation
+        return ((generation, index) for index in self.sampler)
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+class RingDataLoader(DataLoader):
+    """
+    DataLoader collating into a PinnedBatchRing. Iterators yield SlotBatch views that
+    the prefetcher hands back through release(). Needs persistent workers (or none),
+    whose reset finishes the batches of a left epoch before the next one starts.
+    """
+
+    def __init__(self, dataset, batch_size, sampler, shuffle, num_workers, prefetch_factor, ring):
+        if sampler is None:
+            sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        super().__init__(
+            dataset=_GenerationDataset(dataset),
+            batch_size=batch_size,
+            num_workers=num_workers,
+            pin_memory=False,
+            sampler=_GenerationSampler(sampler, ring),
+            drop_last=True,
+            collate_fn=RingCollate(ring),
+            prefetch_factor=prefetch_factor if num_workers > 0 else None,
+            persistent_workers=num_workers > 0
+        )
+        self.ring = ring
+
+    def __iter__(self):
+        self.ring.generation += 1
+        iterator = super().__iter__()
+        self.ring.reclaim(self.ring.generation)
+        return _RingIterator(iterator, self.ring)
+
+
+class _RingIterator():
+    def __init__(self, iterator, ring):
+        self.iterator = iterator
+        self.ring = ring
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        slot, fields = next(self.iterator)
+        return self.ring.batch(slot, fields)
+
+    def release(self, slot):
+        self.ring.release(slot)
@@ -9,53 +9,144 @@ from torchvision.datasets import VisionDataset
 from torchvision.datasets.folder import default_loader,make_dataset,IMG_EXTENSIONS
 from pycocotools.coco import COCO
 import os
+import contextlib
+from utils.mask_utils import patch_mask
 
 class MultiViewDataInjector():
-    def __init__(self, transform_list):
+    def __init__(self, transform_list, local_transform=None, num_local_crops=0):
         self.transform_list = transform_list
+        # extra low-resolution crops of the same decoded image and mask, online branch only
+        self.local_transform = local_transform
+        self.num_local_crops = num_local_crops
 
     def __call__(self,sample,mask):
-        output,mask = zip(*[transform(sample,mask) for transform in self.transform_list])
+        output,masks = zip(*[transform(sample,mask) for transform in self.transform_list])
         output_cat = torch.stack(output, dim=0)
-        mask_cat = torch.stack(mask)
-        
-        return output_cat,mask_cat
+        mask_cat = torch.stack(masks)
+        if not self.num_local_crops:
+            return output_cat,mask_cat
+
+        local_output,local_masks = zip(*[self.local_transform(sample,mask) for _ in range(self.num_local_crops)])
+        return output_cat,mask_cat,torch.stack(local_output),torch.stack(local_masks)
+
+class RepeatedAugmentation():
+    """num_repeats independent augmentations of one decoded image and mask, collated as num_repeats samples"""
+    def __init__(self, transform, num_repeats):
+        self.transform = transform
+        self.num_repeats = num_repeats
+
+    def __call__(self,sample,mask):
+        return [self.transform(sample,mask) for _ in range(self.num_repeats)]
+
+def stack_views(tensors):
+    """
+    Stack per-sample (V, ...) tensors into a view-major (V*B, ...) batch: all first
+    views, then all second views. Inside a loader worker the batch is allocated in
+    shared memory directly, as default_collate does, so it reaches the main process without a copy
+    """
+    elem = tensors[0]
+    num_views, batch_size = elem.shape[0], len(tensors)
+    out = None
+    if torch.utils.data.get_worker_info() is not None:
+        storage = elem._typed_storage()._new_shared(batch_size * elem.numel(), device=elem.device)
+        out = elem.new(storage).resize_(num_views, batch_size, *elem.shape[1:])
+    return torch.stack(tensors, dim=1, out=out).view(num_views * batch_size, *elem.shape[1:])
+
+def collate_views(batch):
+    """
+    DataLoader collate_fn: (views, masks) samples to view-major (2B, C, H, W) images and
+    (2B, 1, H, W) masks, followed by (LB, C, h, w) local crops and their masks if any
+    """
+    if isinstance(batch[0], list):
+        # RepeatedAugmentation samples, the repeats of an image stay adjacent in the batch
+        batch = [views for repeats in batch for views in repeats]
+    return tuple(stack_views(list(field)) for field in zip(*batch))
+
+# byte alignment of the fields of a batch packed into a preallocated buffer
+BATCH_ALIGN = 64
+
+def aligned_nbytes(tensor):
+    return -(-tensor.numel() * tensor.element_size() // BATCH_ALIGN) * BATCH_ALIGN
+
+def max_batch_bytes(dataset, batch_size, probe_hook=None):
+    """
+    Bytes of a collated batch of batch_size samples like dataset[0], made inside
+    probe_hook() (e.g. at the largest crop size of the schedule), fields aligned to BATCH_ALIGN
+    """
+    with probe_hook() if probe_hook is not None else contextlib.nullcontext():
+        sample = dataset[0]
+    samples = sample if isinstance(sample, list) else [sample]
+    fields = [sum(s[f].numel() * s[f].element_size() for s in samples) * batch_size for f in range(len(samples[0]))]
+    return sum(-(-n // BATCH_ALIGN) * BATCH_ALIGN for n in fields)
 
 class SSLMaskDataset(VisionDataset):
-    def __init__(self, root: str, mask_file: str, extensions = IMG_EXTENSIONS, transform = None):
+    def __init__(self, root: str, mask_file: str, extensions = IMG_EXTENSIONS, transform = None, cache = None,
+                 patch_segments = None, fh_masks = None):
         self.root = root
+        self.mask_file = mask_file
         self.transform = transform
+        self.cache = cache # optional StagingCache the image and mask files are read through
         self.samples = make_dataset(self.root, extensions = extensions) #Pytorch 1.9+
         self.loader = default_loader
-        self.img_to_mask = self._get_masks(mask_file)
+        # patch masks depend only on the image size, made at load time instead of read from mask_file
+        self.patch_segments = tuple(patch_segments) if patch_segments is not None else None
+        # optional LazyFHMasks, FH masks made on first access instead of read from mask_file
+        self.fh_masks = fh_masks
+        self.img_to_mask = self._get_masks(mask_file) if self.patch_segments is None and fh_masks is None else None
 
     def _get_masks(self, mask_file):
         with open(mask_file, "rb") as file:
             return pickle.load(file)
+
+    def mask_source(self):
+        """Where the masks come from, part of the DecodedDataset key"""
+        if self.patch_segments is not None:
+            return f'patch:{self.patch_segments}'
+        if self.fh_masks is not None:
+            return f'fh:{self.fh_masks.cache_dir}'
+        # gen_masks.py rewrites the index file with the masks (other type, downsample or params)
+        return f'file:{os.path.abspath(self.mask_file)}:{os.stat(self.mask_file).st_mtime_ns}'
         
-    def __getitem__(self, index: int):
+    def load(self, index: int):
+        """Decoded image (PIL) and its (H, W) mask, before any transform"""
         path, _ = self.samples[index]
+        if self.cache is not None:
+            path = self.cache.fetch(path)
         
         # Load Image
         sample = self.loader(path)
+        if self.patch_segments is not None:
+            return sample,patch_mask(sample.height,sample.width,self.patch_segments)
+        if self.fh_masks is not None:
+            return sample,self.fh_masks(self.samples[index][0],sample)
         
         # Load Mask
-        with open(self.img_to_mask[index], "rb") as file:
+        mask_path = self.img_to_mask[index]
+        if self.cache is not None:
+            mask_path = self.cache.fetch(mask_path)
+        with open(mask_path, "rb") as file:
             mask = pickle.load(file)
+        return sample,mask
+
+    def __getitem__(self, index: int):
+        sample,mask = self.load(index)
 
         # Apply transforms
+        # views and masks, plus the local crops and their masks if the transform makes any
         if self.transform is not None:
-            sample,mask = self.transform(sample,mask.unsqueeze(0))
+            return self.transform(sample,mask.unsqueeze(0))
         return sample,mask
 
     def __len__(self) -> int:
         return len(self.samples)
 
 class COCOMaskDataset(VisionDataset):
-    def __init__(self, root: str,annFile: str, transform = None):
+    def __init__(self, root: str,annFile: str, transform = None, cache = None):
         self.root = root
+        self.ann_file = annFile
         self.coco = COCO(annFile)
         self.transform = transform
+        self.cache = cache # optional StagingCache the image files are read through
         #self.samples = make_dataset(self.root, extensions = extensions) #Pytorch 1.9+
         self.loader = default_loader
         ids = []
@@ -67,26 +158,37 @@ class COCOMaskDataset(VisionDataset):
         self.ids = list(sorted(ids))
         #self.img_to_mask = self._get_masks(mask_file)
 
+    def mask_source(self):
+        """Where the masks come from, part of the DecodedDataset key"""
+        return f'coco:{os.path.abspath(self.ann_file)}:{os.stat(self.ann_file).st_mtime_ns}'
+
     def _get_masks(self, mask_file):
         with open(mask_file, "rb") as file:
             return pickle.load(file)
         
-    def __getitem__(self, index: int):
+    def load(self, index: int):
+        """Decoded image (PIL) and its (H, W) mask, before any transform"""
         id = self.ids[index]
         filename = self.coco.loadImgs(id)[0]["file_name"]
         path = os.path.join(self.root, filename)
+        if self.cache is not None:
+            path = self.cache.fetch(path)
         # Load Image
         sample = self.loader(path)
         anns = self.coco.loadAnns(self.coco.getAnnIds(id))
         mask = np.max(np.stack([self.coco.annToMask(ann) * ann["category_id"] 
                                                  for ann in anns]), axis=0)
+        return sample,torch.LongTensor(mask)
+
+    def __getitem__(self, index: int):
+        sample,mask = self.load(index)
 
         # print(np.unique(mask))
         # return sample,mask
         # Apply transforms
-        mask = torch.LongTensor(mask)
+        # views and masks, plus the local crops and their masks if the transform makes any
         if self.transform is not None:
-            sample,mask = self.transform(sample,mask.unsqueeze(0))
+            return self.transform(sample,mask.unsqueeze(0))
         return sample,mask
 
     def __len__(self) -> int:
@@ -125,9 +227,15 @@ class CustomCompose:
         return format_string
     
 class MaskRandomResizedCrop():
-    def __init__(self, size):
+    def __init__(self, size, scale=(0.08, 1.0), mask_stride=1):
+        """
+        size: int, or a shared multiprocessing.Value read on every call so the loader can change it between epochs
+        mask_stride: the mask is resized to size // mask_stride, the grid convert_binary_mask pools it from
+        """
         super().__init__()
         self.size = size
+        self.scale = tuple(scale)
+        self.mask_stride = mask_stride
         self.totensor = transforms.ToTensor()
         self.topil = transforms.ToPILImage()
         
@@ -142,13 +250,31 @@ class MaskRandomResizedCrop():
             Mask Tensor: Randomly cropped/resized mask.
         """
         #import ipdb;ipdb.set_trace()
-        i, j, h, w = transforms.RandomResizedCrop.get_params(image,scale=(0.08, 1.0), ratio=(3.0/4.0,4.0/3.0))
-        image = transforms.functional.resize(transforms.functional.crop(image, i, j, h, w),(self.size,self.size),interpolation=transforms.functional.InterpolationMode.BICUBIC)
+        size = self.size.value if hasattr(self.size, 'value') else self.size
+        _, height, width = transforms.functional.get_dimensions(image)
+        i, j, h, w = transforms.RandomResizedCrop.get_params(image,scale=self.scale, ratio=(3.0/4.0,4.0/3.0))
+        image = transforms.functional.resize(transforms.functional.crop(image, i, j, h, w),(size,size),interpolation=transforms.functional.InterpolationMode.BICUBIC)
         
         image = self.topil(torch.clip(self.totensor(image),min=0, max=255))
-        mask = transforms.functional.resize(transforms.functional.crop(mask, i, j, h, w),(self.size,self.size),interpolation=transforms.functional.InterpolationMode.NEAREST)
+        if self.mask_stride == 1 and mask.shape[-2:] == (height, width):
+            mask = transforms.functional.resize(transforms.functional.crop(mask, i, j, h, w),(size,size),interpolation=transforms.functional.InterpolationMode.NEAREST)
+        else:
+            mask = self.crop_mask(mask, (height, width), i, j, h, w, size // self.mask_stride)
         
         return [image,mask]
+
+    @staticmethod
+    def crop_mask(mask, image_size, i, j, h, w, size):
+        """
+        Nearest-neighbor (size, size) resize of the crop (i, j, h, w) of an image of image_size,
+        read from a mask of any resolution (e.g. stored downsampled by gen_masks.py): the
+        centers of the output cells are mapped into mask coordinates and gathered.
+        """
+        (height, width), (mask_height, mask_width) = image_size, mask.shape[-2:]
+        centers = (torch.arange(size, dtype=torch.float64) + 0.5) / size
+        rows = ((i + centers * h) * mask_height / height).long().clamp_(max=mask_height - 1)
+        cols = ((j + centers * w) * mask_width / width).long().clamp_(max=mask_width - 1)
+        return mask[..., rows[:, None], cols]
     
 class MaskRandomHorizontalFlip():
     """
@@ -183,39 +309,39 @@ class Solarize():
     def __call__(self, sample):
         return ImageOps.solarize(sample, self.threshold)
 
-def get_transform(stage, gb_prob=1.0, solarize_prob=0., crop_size=224):
+def get_transform(stage, gb_prob=1.0, solarize_prob=0., crop_size=224, scale=(0.08, 1.0), uint8=False, mask_stride=1):
+    """
+    uint8: images stay uint8 tensors, normalized after the copy to the device by data_prefetcher
+    mask_stride: masks are cropped to crop_size // mask_stride instead of the full crop size
+    """
     t_list = []
     color_jitter = transforms.ColorJitter(0.4, 0.4, 0.2, 0.1)
     normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                      std=[0.229, 0.224, 0.225])
+    to_tensor = [transforms.PILToTensor()] if uint8 else [transforms.ToTensor(), normalize]
     if stage in ('train', 'val'):
         t_list = [
             transforms.RandomApply([color_jitter], p=0.8),
             transforms.RandomGrayscale(p=0.2),
             transforms.RandomApply([GaussianBlur(kernel_size=23)], p=gb_prob),
             transforms.RandomApply([Solarize()], p=solarize_prob),
-            transforms.ToTensor(),
-            normalize]
+            *to_tensor]
         
         p_list = [
-            MaskRandomResizedCrop(crop_size),
+            MaskRandomResizedCrop(crop_size, scale=scale, mask_stride=mask_stride),
             MaskRandomHorizontalFlip(),
         ]
         
     elif stage == 'ft':
-        t_list = [
-            transforms.ToTensor(),
-            normalize]
+        t_list = list(to_tensor)
         
         p_list = [
-            MaskRandomResizedCrop(crop_size),
+            MaskRandomResizedCrop(crop_size, scale=scale, mask_stride=mask_stride),
             MaskRandomHorizontalFlip(),
         ]
             
     elif stage == 'test':
-        t_list = [
-            transforms.ToTensor(),
-            normalize]
+        t_list = list(to_tensor)
         
         p_list = [
             transforms.Resize(256),
@@ -1,63 +1,115 @@
 #-*- coding:utf-8 -*-
 """
-To use this file, you have to install the latest version of albumentations (>0.4.6) from GitHub:
-    pip install -U git+https://github.com/albumentations-team/albumentations
+albumentations (OpenCV) backend of the training transforms, selected with data.transform_backend.
+Same interface and view probabilities as get_transform in byol_transform.py. Needs albumentations>=2.0:
+    pip install -U albumentations
 """
+import os
+from functools import partial
+
+import cv2
 import numpy as np
 import torch
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 
-class MultiViewDataInjectorA():
-    def __init__(self, transform_list):
-        self.transform_list = transform_list
+class MaskCompose():
+    """
+    Spatial transforms applied jointly to the image and the mask, then photometric
+    transforms and tensor conversion on the image only. Takes a PIL image (or HWC uint8
+    array) and a (1, H, W) mask tensor, like CustomCompose. Masks stored at a lower
+    resolution are upsampled to the image first, and with mask_stride the transformed
+    mask is resized to crop_size // mask_stride.
+
+    Every Compose keeps its own random generator, so the pipelines are built in the
+    process that runs them (loader worker, data service producer) and seeded from torch,
+    which the loader seeds per worker. The spatial pipeline is built per crop size, read on
+    every call when crop_size is a shared multiprocessing.Value.
+    """
+    def __init__(self, spatial, photometric, crop_size, mask_stride=1):
+        self.spatial = spatial # crop size -> list of spatial transforms
+        self.photometric = photometric # list of image transforms
+        self.crop_size = crop_size
+        self.mask_stride = mask_stride
+        self.pid = None
+
+    def _compose(self, t_list):
+        return A.Compose(t_list, seed=int(torch.randint(2**31, (1,))))
+
+    def __call__(self, img, mask):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.spatial_compose = {}
+            self.photometric_compose = self._compose(self.photometric)
+        size = self.crop_size.value if hasattr(self.crop_size, 'value') else self.crop_size
+        if size not in self.spatial_compose:
+            self.spatial_compose[size] = self._compose(self.spatial(size))
 
-    def __call__(self, sample):
-        image = np.array(sample)
-        output = [transform(image=image)['image'].unsqueeze(0) for transform in self.transform_list]
-        output_cat = torch.cat(output, dim=0)
-        return output_cat
+        # cv2 has no int64 resize
+        mask_np = mask[0].numpy()
+        if mask_np.dtype == np.int64:
+            mask_np = mask_np.astype(np.int32)
+        img = np.asarray(img)
+        if mask_np.shape != img.shape[:2]:
+            mask_np = cv2.resize(mask_np, img.shape[1::-1], interpolation=cv2.INTER_NEAREST)
+        out = self.spatial_compose[size](image=img, mask=mask_np)
+        img = self.photometric_compose(image=out['image'])['image']
+        mask_np = out['mask']
+        if self.mask_stride > 1:
+            mask_size = (mask_np.shape[1] // self.mask_stride, mask_np.shape[0] // self.mask_stride)
+            mask_np = cv2.resize(mask_np, mask_size, interpolation=cv2.INTER_NEAREST)
+        return img, torch.from_numpy(mask_np).to(mask.dtype).unsqueeze(0)
 
-class DataInjectorA():
-    def __init__(self, transform):
-        self.transform = transform
+    def __repr__(self) -> str:
+        format_string = self.__class__.__name__ + "("
+        size = self.crop_size.value if hasattr(self.crop_size, 'value') else self.crop_size
+        for t in self.spatial(size) + self.photometric:
+            format_string += "\n"
+            format_string += f"    {t}"
+        format_string += "\n)"
+        return format_string
 
-    def __call__(self, sample):
-        image = np.array(sample)
-        output = self.transform(image=image)['image']
-        return output
+def random_crop_flip(size, scale):
+    """MaskRandomResizedCrop and MaskRandomHorizontalFlip"""
+    return [
+        A.RandomResizedCrop(size=(size, size), scale=tuple(scale), ratio=(3.0/4.0, 4.0/3.0),
+                            interpolation=cv2.INTER_CUBIC, mask_interpolation=cv2.INTER_NEAREST),
+        A.HorizontalFlip(p=0.5),
+    ]
 
-def get_transform(stage, gb_prob=1.0, solarize_prob=0.):
-    t_list = []
+def resize_center_crop(size):
+    return [
+        A.SmallestMaxSize(max_size=256, interpolation=cv2.INTER_LINEAR, mask_interpolation=cv2.INTER_NEAREST),
+        A.CenterCrop(size, size),
+    ]
+
+def get_transform(stage, gb_prob=1.0, solarize_prob=0., crop_size=224, scale=(0.08, 1.0), uint8=False, mask_stride=1):
+    """
+    uint8: images stay uint8 tensors, normalized after the copy to the device by data_prefetcher
+    mask_stride: masks are resized to crop_size // mask_stride after the crop
+    """
     normalize = A.Normalize(mean=[0.485, 0.456, 0.406],
                             std=[0.229, 0.224, 0.225])
+    to_tensor = [ToTensorV2()] if uint8 else [normalize, ToTensorV2()]
     if stage in ('train', 'val'):
         t_list = [
-            A.RandomResizedCrop(224, 224),
-            A.HorizontalFlip(p=0.5),
-            A.RandomBrightnessContrast(brightness_limit=0.4, contrast_limit=0.4, p=0.8),
-            A.HueSaturationValue(hue_shift_limit=int(0.1 * 180),
-                                 sat_shift_limit=int(0.2 * 255),
-                                 val_shift_limit=0, p=0.8),
+            A.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.2, hue=0.1, p=0.8),
             A.ToGray(p=0.2),
-            A.GaussianBlur(blur_limit=[23, 23], sigma_limit=[0.1, 0.2], p=gb_prob),
-            A.Solarize(p=solarize_prob),
-            normalize,
-            ToTensorV2()
-        ]
+            A.GaussianBlur(blur_limit=(23, 23), sigma_limit=(0.1, 2.0), p=gb_prob),
+            A.Solarize(threshold_range=(0.5, 0.5), p=solarize_prob), # pixels >= 128, as ImageOps.solarize
+            *to_tensor]
+
+        p_list = partial(random_crop_flip, scale=scale)
+
     elif stage == 'ft':
-        t_list = [
-            A.RandomResizedCrop(224, 224),
-            A.HorizontalFlip(p=0.5),
-            normalize,
-            ToTensorV2()
-        ]
+        t_list = list(to_tensor)
+
+        p_list = partial(random_crop_flip, scale=scale)
+
     elif stage == 'test':
-        t_list = [
-            A.Resize(256, 256),
-            A.CenterCrop(224, 224),
-            normalize,
-            ToTensorV2()
-        ]
-    transform = A.Compose(t_list)
+        t_list = list(to_tensor)
+
+        p_list = resize_center_crop
+
+    transform = MaskCompose(p_list, t_list, crop_size, mask_stride if stage in ('train', 'val', 'ft') else 1)
     return transform
@@ -0,0 +1,254 @@
+#-*- coding:utf-8 -*-
+import os
+import time
+import random
+import shutil
+import contextlib
+import threading
+import traceback
+import multiprocessing as mp
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from .byol_transform import collate_views, max_batch_bytes, aligned_nbytes
+
+# numpy has no bfloat16, batches are moved as raw bytes with these dtype codes
+DTYPES = [torch.float32, torch.float16, torch.bfloat16, torch.int64, torch.int32, torch.int16, torch.uint8, torch.bool]
+MAX_FIELDS, MAX_DIMS = 4, 4
+
+
+class DataService():
+    """
+    Node-level replacement of the per-rank DataLoaders. Local rank 0 forks num_workers
+    producer processes that decode, augment and collate the batches of every local rank
+    and write them into one shared-memory ring of num_slots batches per rank, kept as
+    files in service_dir. Each rank reads its own ring in order, so a node runs
+    num_workers processes instead of data_workers per rank.
+
+    Batch j of epoch e for local rank r is made from the indices that samplers[r] (the
+    rank's own DistributedSampler, or the sampler the DataLoader would have used)
+    yields for epoch e, so partitioning matches the per-rank loaders. Producers take
+    (epoch, batch, rank) items from a shared counter in consumption order and write
+    batch g of a rank into slot g % num_slots once that rank has read batch g - num_slots
+    (backpressure). Producers stay at most num_slots batches ahead of each rank,
+    including across epoch boundaries, and epochs run back to back from the first
+    set_epoch(). Producer errors are raised in the ranks. A monitor thread of local rank 0
+    also reports producers that died without an error (killed, out of memory) and
+    writes a heartbeat, the other ranks raise if it stops (local rank 0 is gone).
+
+    Every local rank builds a DataService with the same arguments. Local rank 0 creates
+    the ring files, the other ranks map them after a barrier, so torch.distributed must
+    be initialized when local_world_size > 1. service_dir must not be shared by two jobs.
+    Every rank calls close() after training (or on error), local rank 0 then stops the
+    producers and removes service_dir.
+    """
+    POLL_INTERVAL = 0.0005
+    HEARTBEAT_INTERVAL = 1.
+    HEARTBEAT_TIMEOUT = 60.
+    READY, READ, CONTROL = 'ready', 'read', 'control'
+    ERROR, SLOT_BYTES, HEARTBEAT = range(3)
+
+    def __init__(self, dataset, samplers, batch_size, local_rank, service_dir, num_workers=32, num_slots=4,
+                 epoch_hook=None, probe_hook=None):
+        self.dataset = dataset
+        self.samplers = samplers
+        self.batch_size = batch_size
+        self.local_rank = local_rank
+        self.local_world_size = len(samplers)
+        self.service_dir = service_dir
+        self.num_workers = num_workers
+        self.num_slots = num_slots
+        self.epoch_hook = epoch_hook
+        self.num_batches = len(samplers[local_rank]) // batch_size
+        self.first_epoch, self.epoch, self.position = None, None, 0
+        self.workers = []
+        self.parent_pid = os.getpid()
+        self.stop = threading.Event()
+        self.monitor = None
+
+        if local_rank == 0:
+            shutil.rmtree(service_dir, ignore_errors=True)
+            os.makedirs(service_dir)
+            # largest batch, at the largest crop size
+            slot_bytes = max_batch_bytes(dataset, batch_size, probe_hook)
+            self._map('w+', slot_bytes)
+            self.state[self.READY][:] = -1
+            self.state[self.READ][:] = 0
+            self.state[self.CONTROL][self.SLOT_BYTES] = slot_bytes
+            self.state[self.CONTROL][self.HEARTBEAT] = time.time()
+            self.monitor = threading.Thread(target=self._monitor, daemon=True)
+            self.monitor.start()
+        if self.local_world_size > 1:
+            dist.barrier()
+        if local_rank != 0:
+            control = np.memmap(os.path.join(service_dir, f'{self.CONTROL}.i8'), dtype=np.int64, mode='r')
+            self._map('r+', int(control[self.SLOT_BYTES]))
+
+    def __len__(self):
+        return self.num_batches
+
+    def _map(self, mode, slot_bytes):
+        shapes = {self.READY: (self.local_world_size, self.num_slots), self.READ: (self.local_world_size,),
+                  self.CONTROL: (3,)}
+        self.state = {name: np.memmap(os.path.join(self.service_dir, f'{name}.i8'), dtype=np.int64, mode=mode,
+                                      shape=shape) for name, shape in shapes.items()}
+        # per slot and field: dtype code (-1 if unused), ndim, shape
+        self.meta = np.memmap(os.path.join(self.service_dir, 'meta.i8'), dtype=np.int64, mode=mode,
+                              shape=(self.local_world_size, self.num_slots, MAX_FIELDS, 2 + MAX_DIMS))
+        self.slots = np.memmap(os.path.join(self.service_dir, 'slots.u8'), dtype=np.uint8, mode=mode,
+                               shape=(self.local_world_size, self.num_slots, slot_bytes))
+
+    def _check_error(self):
+        if self.state[self.CONTROL][self.ERROR]:
+            message = 'local rank 0 closed the data service'
+            with contextlib.suppress(FileNotFoundError):
+                with open(os.path.join(self.service_dir, 'error.txt')) as f:
+                    message = f.read()
+            raise RuntimeError(f'data service producer failed:\n{message}')
+        if self.local_rank != 0 and time.time() - self.state[self.CONTROL][self.HEARTBEAT] > self.HEARTBEAT_TIMEOUT:
+            raise RuntimeError(f'data service of local rank 0 sent no heartbeat for {self.HEARTBEAT_TIMEOUT:.0f} s')
+
+    def _set_error(self, message):
+        with open(os.path.join(self.service_dir, 'error.txt'), 'w') as f:
+            f.write(message)
+        self.state[self.CONTROL][self.ERROR] = 1
+
+    def _monitor(self):
+        """Local rank 0: heartbeat, and report producers that exited without writing an error"""
+        while not self.stop.wait(self.HEARTBEAT_INTERVAL):
+            self.state[self.CONTROL][self.HEARTBEAT] = time.time()
+            dead = [(i, w) for i, w in enumerate(self.workers) if not w.is_alive()]
+            if dead and not self.state[self.CONTROL][self.ERROR]:
+                self._set_error(''.join(f'producer {i} (pid {w.pid}) exited with code {w.exitcode}\n' for i, w in dead))
+
+    # producers, local rank 0 only
+
+    def start(self, epoch):
+        ctx = mp.get_context('fork')
+        self.counter = ctx.Value('q', 0)
+        self.barrier = ctx.Barrier(self.num_workers)
+        # seeded per producer as DataLoader seeds its workers
+        base_seed = torch.empty((), dtype=torch.int64).random_().item()
+        for worker_id in range(self.num_workers):
+            worker = ctx.Process(target=self._produce, args=(worker_id, epoch, base_seed + worker_id), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def _produce(self, worker_id, epoch, seed):
+        torch.set_num_threads(1)
+        torch.manual_seed(seed)
+        random.seed(seed)
+        np.random.seed(seed % 2**32)
+        try:
+            while True:
+                for sampler in self.samplers:
+                    sampler.set_epoch(epoch)
+                if worker_id == 0:
+                    # shared with every producer, e.g. the crop size
+                    if self.epoch_hook is not None:
+                        self.epoch_hook(epoch)
+                    self.counter.value = 0
+                self.barrier.wait()
+                batches = [list(self.samplers[r]) for r in range(self.local_world_size)]
+                offset = (epoch - self.first_epoch) * self.num_batches
+                while True:
+                    with self.counter.get_lock():
+                        item = self.counter.value
+                        self.counter.value += 1
+                    if item >= self.num_batches * self.local_world_size:
+                        break
+                    j, r = divmod(item, self.local_world_size)
+                    indices = batches[r][j * self.batch_size:(j + 1) * self.batch_size]
+                    self._write(r, offset + j, collate_views([self.dataset[i] for i in indices]))
+                # every item of the epoch taken before worker 0 resets the counter
+                self.barrier.wait()
+                epoch += 1
+        except threading.BrokenBarrierError:
+            # another producer failed and reported it
+            return
+        except Exception:
+            self._set_error(traceback.format_exc())
+            self.barrier.abort()
+
+    def _write(self, rank, g, batch):
+        slot = g % self.num_slots
+        while g - self.num_slots >= self.state[self.READ][rank]:
+            if os.getppid() != self.parent_pid:
+                # local rank 0 is gone, nothing reads the ring any more
+                os._exit(1)
+            time.sleep(self.POLL_INTERVAL)
+        self.meta[rank, slot, :, 0] = -1
+        offset = 0
+        for f, tensor in enumerate(batch):
+            nbytes = tensor.numel() * tensor.element_size()
+            assert offset + nbytes <= self.slots.shape[-1], \
+                ValueError(f'batch of {offset + nbytes} bytes does not fit in a {self.slots.shape[-1]} byte slot')
+            dst = torch.from_numpy(self.slots[rank, slot, offset:offset + nbytes])
+            dst.view(tensor.dtype).view(tensor.shape).copy_(tensor)
+            self.meta[rank, slot, f, :2 + tensor.dim()] = DTYPES.index(tensor.dtype), tensor.dim(), *tensor.shape
+            offset += aligned_nbytes(tensor)
+        # published after the data, read in that order by the rank
+        self.state[self.READY][rank, slot] = g
+
+    def close(self, abort=False):
+        """
+        Stop the producers and remove service_dir, called by every local rank once it has
+        read its last batch. abort: on error, do not wait for the other local ranks, they
+        raise on their next read instead.
+        """
+        if self.stop.is_set():
+            return
+        if self.local_world_size > 1 and not abort:
+            dist.barrier()
+        self.stop.set()
+        if self.local_rank != 0:
+            return
+        if self.monitor is not None:
+            self.monitor.join()
+        if abort:
+            self._set_error('local rank 0 closed the data service after an error')
+        for worker in self.workers:
+            worker.terminate()
+            worker.join()
+        self.workers = []
+        shutil.rmtree(self.service_dir, ignore_errors=True)
+
+    # consumers, every local rank
+
+    def set_epoch(self, epoch):
+        if self.first_epoch is None:
+            self.first_epoch = epoch
+            if self.local_rank == 0:
+                self.start(epoch)
+        self.epoch = epoch
+
+    def _read(self, g):
+        slot = g % self.num_slots
+        while self.state[self.READY][self.local_rank, slot] != g:
+            self._check_error()
+            time.sleep(self.POLL_INTERVAL)
+        batch, offset = [], 0
+        for meta in self.meta[self.local_rank, slot]:
+            if meta[0] < 0:
+                break
+            dtype, shape = DTYPES[meta[0]], [int(d) for d in meta[2:2 + meta[1]]]
+            out = torch.empty(shape, dtype=dtype, pin_memory=torch.cuda.is_available())
+            nbytes = out.numel() * out.element_size()
+            out.copy_(torch.from_numpy(self.slots[self.local_rank, slot, offset:offset + nbytes]).view(dtype).view(shape))
+            batch.append(out)
+            offset += aligned_nbytes(out)
+        self.state[self.READ][self.local_rank] = g + 1
+        self.position = g + 1
+        return tuple(batch)
+
+    def __iter__(self):
+        assert self.epoch is not None, ValueError('call set_epoch() before iterating the data service')
+        start = (self.epoch - self.first_epoch) * self.num_batches
+        # batches of an epoch left early are still in the ring
+        while self.position < start:
+            self._read(self.position)
+        for g in range(start, start + self.num_batches):
+            yield self._read(g)
+
@@ -0,0 +1,126 @@
+#-*- coding:utf-8 -*-
+import os
+import time
+import hashlib
+import traceback
+import contextlib
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.datasets import VisionDataset
+
+
+class DecodedDataset(VisionDataset):
+    """
+    In-memory mode for datasets that fit in RAM: every image of `dataset` (an
+    SSLMaskDataset or COCOMaskDataset) is decoded once, resized so its shorter side
+    is at most max_size, and stored with its mask as uint8 in two flat files in
+    cache_dir (/dev/shm by default). The files are memory-mapped by every loader worker
+    and every local rank, so the node holds one decoded copy and no epoch reads or
+    decodes a JPEG again. Local rank 0 builds them while the other ranks wait for the
+    index file, which is written last. The files are kept and reused by later runs
+    with the same images, mask source (dataset.mask_source(): mask file and its mtime,
+    patch segments or FH parameters) and max_size; remove them from cache_dir to free
+    the memory. If the build fails, local rank 0 writes the error next to the files and
+    the waiting ranks raise it; they also raise after `timeout` seconds without an index.
+    """
+    POLL_INTERVAL = 1.
+
+    def __init__(self, dataset, cache_dir='/dev/shm', max_size=256, build=True, num_threads=8, timeout=3600.):
+        self.dataset = dataset
+        self.root = dataset.root
+        self.transform = dataset.transform
+        self.max_size = max_size
+        key = hashlib.sha1(f'{type(dataset).__name__}:{os.path.abspath(dataset.root)}:{len(dataset)}:'
+                           f'{dataset.mask_source()}:{max_size}'.encode()).hexdigest()[:16]
+        prefix = os.path.join(cache_dir, f'decoded_{key}_{max_size}')
+        self.image_file, self.mask_file, self.index_file = (f'{prefix}.{ext}' for ext in ('images.u8', 'masks.u8', 'index.npy'))
+        self.error_file = f'{prefix}.error.txt'
+        self._images, self._masks = None, None
+        if not os.path.exists(self.index_file):
+            if build:
+                os.makedirs(cache_dir, exist_ok=True)
+                try:
+                    self._build(num_threads)
+                except Exception:
+                    with open(self.error_file, 'w') as f:
+                        f.write(traceback.format_exc())
+                    raise
+            else:
+                self._wait(timeout)
+        # per sample: image offset, mask offset, height, width
+        self.index = np.load(self.index_file)
+
+    def __getstate__(self):
+        # the arrays are mapped again in every worker
+        state = self.__dict__.copy()
+        state['_images'], state['_masks'] = None, None
+        return state
+
+    def _wait(self, timeout):
+        """Wait for local rank 0 to write the index file, raise its build error or on timeout"""
+        start = time.time()
+        while not os.path.exists(self.index_file):
+            # an error file older than this wait is left by an earlier run
+            with contextlib.suppress(FileNotFoundError):
+                if os.stat(self.error_file).st_mtime >= start:
+                    with open(self.error_file) as f:
+                        raise RuntimeError(f'local rank 0 failed to build {self.index_file}:\n{f.read()}')
+            if time.time() - start > timeout:
+                raise TimeoutError(f'no {self.index_file} from local rank 0 after {timeout:.0f} s')
+            time.sleep(self.POLL_INTERVAL)
+
+    def _decode(self, index):
+        sample, mask = self.dataset.load(index)
+        mask = torch.as_tensor(mask)
+        if mask.min() < 0 or mask.max() > 255:
+            raise ValueError(f'mask ids of sample {index} do not fit in uint8 (convert_binary_mask keeps 256 ids)')
+        scale = self.max_size / min(sample.size)
+        if scale < 1:
+            size = (round(sample.size[0] * scale), round(sample.size[1] * scale))
+            sample = sample.resize(size, Image.BILINEAR)
+        mask = Image.fromarray(mask.numpy().astype(np.uint8)).resize(sample.size, Image.NEAREST)
+        return np.asarray(sample), np.asarray(mask)
+
+    def _build(self, num_threads):
+        index = np.zeros((len(self.dataset), 4), dtype=np.int64)
+        image_tmp, mask_tmp = f'{self.image_file}.{os.getpid()}.tmp', f'{self.mask_file}.{os.getpid()}.tmp'
+        offsets = [0, 0]
+        with open(image_tmp, 'wb') as images, open(mask_tmp, 'wb') as masks, ThreadPool(num_threads) as pool:
+            # PIL releases the GIL while decoding, samples are appended in order
+            for i, (image, mask) in enumerate(pool.imap(self._decode, range(len(self.dataset)), chunksize=16)):
+                index[i] = offsets[0], offsets[1], *mask.shape
+                images.write(image.tobytes())
+                masks.write(mask.tobytes())
+                offsets[0] += image.size
+                offsets[1] += mask.size
+        os.replace(image_tmp, self.image_file)
+        os.replace(mask_tmp, self.mask_file)
+        index_tmp = f'{self.index_file}.{os.getpid()}.tmp.npy'
+        np.save(index_tmp, index)
+        os.replace(index_tmp, self.index_file)
+
+    @property
+    def nbytes(self):
+        return os.path.getsize(self.image_file) + os.path.getsize(self.mask_file)
+
+    def load(self, index: int):
+        """Decoded image (PIL) and its (H, W) mask, as dataset.load() but from memory"""
+        if self._images is None:
+            self._images = np.memmap(self.image_file, dtype=np.uint8, mode='r')
+            self._masks = np.memmap(self.mask_file, dtype=np.uint8, mode='r')
+        image_offset, mask_offset, height, width = (int(v) for v in self.index[index])
+        image = self._images[image_offset:image_offset + height * width * 3].reshape(height, width, 3)
+        mask = self._masks[mask_offset:mask_offset + height * width].reshape(height, width)
+        return Image.fromarray(image), torch.from_numpy(mask.astype(np.int64))
+
+    def __getitem__(self, index: int):
+        sample,mask = self.load(index)
+        if self.transform is not None:
+            return self.transform(sample,mask.unsqueeze(0))
+        return sample,mask
+
+    def __len__(self) -> int:
+        return len(self.dataset)
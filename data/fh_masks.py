@@ -0,0 +1,73 @@
+#-*- coding:utf-8 -*-
+import os
+import time
+import pickle
+import contextlib
+
+import numpy as np
+import torch
+from PIL import Image
+from skimage.segmentation import felzenszwalb
+
+from .shared_counters import SharedCounters
+
+
+class LazyFHMasks():
+    """
+    Felzenszwalb masks made on first access instead of by gen_masks.py, so training on
+    a new scale/min_size starts right away. The image is resized so its shorter side is
+    at most max_size before segmenting (min_size, given at full resolution, is scaled by
+    the area ratio), and the low-resolution mask is cropped by MaskRandomResizedCrop in
+    image coordinates. Masks are pickled to cache_dir/fh_<scale>_<min_size>_<max_size>/
+    as gen_masks.py names them, written atomically, and read back by later epochs, runs,
+    ranks and workers. Two processes missing the same mask both compute it, the file is
+    replaced with identical content. Hits, misses and the microseconds spent segmenting
+    are counters in the .stats file of that directory, cumulative since it was created.
+    """
+    HITS, MISSES, COMPUTE_US = range(3)
+
+    def __init__(self, cache_dir, scale=1000, min_size=1000, max_size=128):
+        self.scale = scale
+        self.min_size = min_size
+        self.max_size = max_size
+        self.cache_dir = os.path.join(os.path.abspath(cache_dir), f'fh_{scale}_{min_size}_{max_size}')
+        self.stats_file = os.path.join(self.cache_dir, '.stats')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.counters = SharedCounters(self.stats_file, 3, os.path.join(self.cache_dir, '.lock'))
+
+    def mask_path(self, path):
+        return os.path.join(self.cache_dir, os.path.splitext('_'.join(path.split('/')[-2:]))[0] + '_fh.pkl')
+
+    def segment(self, sample):
+        """(h, w) int16 FH mask of a PIL image, h and w at most max_size on the shorter side"""
+        ratio = min(self.max_size / min(sample.size), 1.)
+        if ratio < 1:
+            sample = sample.resize((round(sample.size[0] * ratio), round(sample.size[1] * ratio)), Image.BILINEAR)
+        # float image in [0, 1], as gen_masks.py segments the ToTensor() output
+        image = np.asarray(sample, dtype=np.float32) / 255.
+        mask = felzenszwalb(image, scale=self.scale, min_size=max(int(self.min_size * ratio ** 2), 1))
+        return torch.from_numpy(mask).to(torch.int16)
+
+    def __call__(self, path, sample):
+        """Mask of the image file `path`, decoded as `sample`"""
+        mask_path = self.mask_path(path)
+        with contextlib.suppress(FileNotFoundError):
+            with open(mask_path, 'rb') as file:
+                mask = pickle.load(file)
+            self.counters.add(self.HITS)
+            return mask
+
+        start = time.time()
+        mask = self.segment(sample)
+        tmp_path = f'{mask_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(mask, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, mask_path)
+        with self.counters.lock():
+            self.counters.array[self.MISSES] += 1
+            self.counters.array[self.COMPUTE_US] += int((time.time() - start) * 1e6)
+        return mask
+
+    def stats(self):
+        hits, misses, compute_us = self.counters.values()
+        return {'hits': hits, 'misses': misses, 'compute_time': compute_us / 1e6}
@@ -1,11 +1,84 @@
 #-*- coding:utf-8 -*-
 import torch
 import os
+import time
+import contextlib
+import multiprocessing as mp
 from torchvision import datasets
-from .byol_transform import MultiViewDataInjector, get_transform, SSLMaskDataset,COCOMaskDataset
+from .byol_transform import MultiViewDataInjector, get_transform, SSLMaskDataset,COCOMaskDataset, collate_views, RepeatedAugmentation, max_batch_bytes
+from .samplers import RepeatedAugmentationSampler, BlockShuffleSampler
+from .staging_cache import StagingCache
+from .decoded_dataset import DecodedDataset
+from .fh_masks import LazyFHMasks
+from .data_service import DataService
+from .batch_ring import PinnedBatchRing, RingDataLoader
 
 
-class ImageLoader():
+def transform_backend(name):
+    """get_transform of the 'pil' (torchvision) or 'albumentations' (OpenCV) backend"""
+    assert name in ('pil', 'albumentations'), ValueError(f'Invalid transform_backend: {name}')
+    if name == 'albumentations':
+        # optional dependency, only imported when selected
+        from .byol_transform_a import get_transform as get_transform_a
+        return get_transform_a
+    return get_transform
+
+def scheduled_crop_size(schedule, epoch, default):
+    """Crop size of `epoch` from a {start_epoch: crop_size} schedule, `default` before its first entry"""
+    crop_size = default
+    for start in sorted(schedule or {}):
+        if epoch >= start:
+            crop_size = schedule[start]
+    return crop_size
+
+
+def build_loader(dataset, batch_size, sampler, shuffle, num_workers, prefetch_factor=2, persistent_workers=False,
+                 ring=None):
+    if ring is not None:
+        return RingDataLoader(dataset, batch_size, sampler, shuffle, num_workers, prefetch_factor, ring)
+    return torch.utils.data.DataLoader(
+        dataset=dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=num_workers,
+        pin_memory=True,
+        sampler=sampler,
+        drop_last=True,
+        collate_fn=collate_views,
+        # both only apply to worker processes
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        persistent_workers=persistent_workers and num_workers > 0
+    )
+
+
+def autotune_loader(dataset, batch_size, sampler, shuffle, workers, prefetch_factors, num_batches=20):
+    """
+    Loader throughput of every (num_workers, prefetch_factor) pair of the grid, as
+    (num_workers, prefetch_factor, samples/s) over num_batches batches, timed once the
+    batches prefetched while the workers started are used up
+    """
+    results = []
+    for num_workers in workers:
+        for prefetch_factor in (prefetch_factors if num_workers > 0 else [None]):
+            loader = build_loader(dataset, batch_size, sampler, shuffle, num_workers, prefetch_factor)
+            warmup = min(max(num_workers * (prefetch_factor or 1), 1), len(loader) - 1)
+            start, samples = time.time(), 0
+            for i, (images, *_) in enumerate(loader):
+                if i == warmup:
+                    start = time.time()
+                elif i > warmup:
+                    samples += images.shape[0] // 2
+                if i == warmup + num_batches:
+                    break
+            results.append((num_workers, prefetch_factor, samples / (time.time() - start)))
+    return results
+
+
+class BaseImageLoader():
+    """
+    Loader, sampler, crop size schedule and data service shared by the datasets,
+    subclasses only build their dataset in build_dataset()
+    """
     def __init__(self, config):
         self.image_dir = config['data']['image_dir']
         self.num_replicas = config['world_size']
@@ -13,87 +86,182 @@ class ImageLoader():
         self.distributed = config['distributed']
         self.resize_size = config['data']['resize_size']
         self.data_workers = config['data']['data_workers']
+        self.prefetch_factor = config['data'].get('prefetch_factor', 2)
+        self.persistent_workers = config['data'].get('persistent_workers', False)
+        # measure a grid of worker counts and prefetch depths on the train set and keep the fastest
+        self.autotune = config['data'].get('autotune', False)
+        self.autotune_workers = config['data'].get('autotune_workers', [4, 8, 16])
+        self.autotune_prefetch = config['data'].get('autotune_prefetch', [2, 4])
+        self.autotune_batches = config['data'].get('autotune_batches', 20)
+        self.autotune_results = None
+        # collate into a ring of preallocated pinned batches sized for the workers' and the prefetcher's queues
+        self.pinned_ring = config['data'].get('pinned_ring', False)
+        self.prefetch_depth = config['data'].get('prefetch_depth', 1)
+        self.ring = None
         self.dual_views = config['data']['dual_views']
         self.mask_type = config['data']['mask_type']
+        self.fh_masks = None # LazyFHMasks of ImageLoader
+        # train crop size shared with the loader workers, changed at epoch boundaries by resolution_schedule
+        self.resolution_schedule = config['data'].get('resolution_schedule') or {}
+        assert all(size % 32 == 0 for size in self.resolution_schedule.values()), \
+            ValueError(f'resolution_schedule crops must be multiples of the backbone stride 32: {self.resolution_schedule}')
+        self.crop_size = mp.Value('i', self.resize_size)
+        # uint8 images from the loader, normalized on the device by data_prefetcher
+        self.normalize_on_device = config['data'].get('normalize_on_device', False)
+        self.get_transform = transform_backend(config['data'].get('transform_backend', 'pil'))
+        # masks cropped to crop_size // mask_stride, at least the backbone's pooling grid
+        self.mask_stride = config['data'].get('mask_stride', 1)
+        assert (224 // config['loss']['pool_size']) % self.mask_stride == 0, \
+            ValueError(f"mask_stride {self.mask_stride} must divide the feature stride {224 // config['loss']['pool_size']}")
+        self.local_crops = config['data'].get('local_crops', 0)
+        self.local_crop_size = config['data'].get('local_crop_size', 96)
+        assert not self.local_crops or self.local_crop_size % 32 == 0, \
+            ValueError(f'local_crop_size must be a multiple of the backbone stride 32: {self.local_crop_size}')
+        self.local_crop_scale = config['data'].get('local_crop_scale', [0.05, 0.4])
+        # view pairs per decoded image and mask, the sampler draws len(dataset) // repeats images per epoch
+        self.repeats = config['data'].get('repeated_augmentation', 1)
+        self.sampler = config['data'].get('sampler', 'distributed')
+        self.sampler_block_size = config['data'].get('sampler_block_size', 256)
+        self.sampler_window = config['data'].get('sampler_window', 8)
+        self.local_world_size = config.get('local_world_size', 1)
+        assert self.sampler in ('distributed', 'block'), ValueError(f'Invalid sampler: {self.sampler}')
+        assert self.sampler == 'distributed' or self.repeats == 1, \
+            ValueError('repeated_augmentation uses its own sampler, set sampler: "distributed"')
+        # node-local copies of the image and mask files, shared by all ranks of the node
+        self.cache = None
+        if config['data'].get('staging_dir'):
+            self.cache = StagingCache(config['data']['staging_dir'], config['data']['staging_budget_gb'] * 2**30)
+        # decode the dataset once into shared memory, built by local rank 0 and mapped by every rank and worker
+        self.in_memory = config['data'].get('in_memory', False)
+        self.in_memory_dir = config['data'].get('in_memory_dir', '/dev/shm')
+        self.in_memory_max_size = config['data'].get('in_memory_max_size', 256)
+        self.in_memory_timeout = config['data'].get('in_memory_timeout', 3600)
+        self.local_rank = config.get('local_rank', 0)
+        # one node-level pool of producers writing every local rank's batches to shared memory, instead of a DataLoader per rank
+        self.data_service = config['data'].get('data_service', False)
+        self.service_dir = config['data'].get('service_dir', '/dev/shm/data_service')
+        self.service_workers = config['data'].get('service_workers', 32)
+        self.service_slots = config['data'].get('service_slots', 4)
+        self.service = None
 
     def get_loader(self, stage, batch_size):
         dataset = self.get_dataset(stage)
-        if self.distributed and stage in ('train', 'ft'):
-            self.train_sampler = torch.utils.data.distributed.DistributedSampler(
-                dataset, num_replicas=self.num_replicas, rank=self.rank)
-        else:
-            self.train_sampler = None
-
-        data_loader = torch.utils.data.DataLoader(
-            dataset=dataset,
-            batch_size=batch_size,
-            shuffle=(self.train_sampler is None and stage not in ('val', 'test')),
-            num_workers=self.data_workers,
-            pin_memory=True,
-            sampler=self.train_sampler,
-            drop_last=True
-        )
+        repeats = self.repeats if stage == 'train' else 1
+        if repeats > 1:
+            assert batch_size % repeats == 0, ValueError(f'batch size {batch_size} not divisible by {repeats} repeats')
+        self.train_sampler = self.get_sampler(stage, dataset, self.rank)
+        if self.data_service and stage in ('train', 'ft'):
+            # the samplers of every local rank of this node, ranks are numbered node by node
+            node_start = self.rank - self.local_rank
+            samplers = [self.get_sampler(stage, dataset, node_start + r, distributed=True)
+                        for r in range(self.local_world_size)]
+            self.train_sampler = samplers[self.local_rank]
+            self.service = DataService(dataset, samplers, batch_size // repeats, self.local_rank, self.service_dir,
+                                       self.service_workers, self.service_slots, self.set_crop_size, self.largest_crop)
+            return self.service
+
+        shuffle = self.train_sampler is None and stage not in ('val', 'test')
+        if self.autotune and stage in ('train', 'ft'):
+            self.autotune_results = autotune_loader(dataset, batch_size // repeats, self.train_sampler, shuffle,
+                                                    self.autotune_workers, self.autotune_prefetch, self.autotune_batches)
+            num_workers, prefetch_factor, rate = max(self.autotune_results, key=lambda r: r[2])
+            if rate > 0: # 0 if the train set has too few batches to time
+                self.data_workers, self.prefetch_factor = num_workers, prefetch_factor
+
+        if self.pinned_ring and stage in ('train', 'ft'):
+            num_slots = self.data_workers * (self.prefetch_factor or 0) + 2 * self.prefetch_depth + 2
+            self.ring = PinnedBatchRing(num_slots, max_batch_bytes(dataset, batch_size // repeats, self.largest_crop))
+
+        data_loader = build_loader(dataset, batch_size // repeats, self.train_sampler, shuffle, self.data_workers,
+                                   self.prefetch_factor, self.persistent_workers, self.ring)
         return data_loader
 
     def get_dataset(self, stage):
-        #import ipdb;ipdb.set_trace()
-        image_dir = os.path.join(self.image_dir,'images', f"{'train' if stage in ('train', 'ft') else 'val'}")
-        mask_file = os.path.join(self.image_dir,'masks',stage+'_tf_img_to_'+self.mask_type+'.pkl')
-        
-        transform1 = get_transform(stage)
-        transform2 = get_transform(stage, gb_prob=0.1, solarize_prob=0.2)
-        transform = MultiViewDataInjector([transform1, transform2])
-        
-        dataset = SSLMaskDataset(image_dir,mask_file,transform=transform)
+        crop_size = self.crop_size if stage in ('train', 'ft') else self.resize_size
+        transform1 = self.get_transform(stage, crop_size=crop_size, uint8=self.normalize_on_device,
+                                        mask_stride=self.mask_stride)
+        transform2 = self.get_transform(stage, gb_prob=0.1, solarize_prob=0.2, crop_size=crop_size,
+                                        uint8=self.normalize_on_device, mask_stride=self.mask_stride)
+        transform = MultiViewDataInjector([transform1, transform2], *self.get_local_transform(stage))
+        if stage == 'train' and self.repeats > 1:
+            transform = RepeatedAugmentation(transform, self.repeats)
+
+        dataset = self.build_dataset(stage, transform)
+        if self.in_memory:
+            dataset = DecodedDataset(dataset, self.in_memory_dir, self.in_memory_max_size, build=self.local_rank == 0,
+                                     timeout=self.in_memory_timeout)
         return dataset
 
+    def build_dataset(self, stage, transform):
+        """Dataset of `stage` with the view transform"""
+        raise NotImplementedError
+
+    def get_sampler(self, stage, dataset, rank, distributed=None):
+        """Sampler of `rank`, None to shuffle in the DataLoader"""
+        distributed = self.distributed if distributed is None else distributed
+        if self.repeats > 1 and stage == 'train':
+            return RepeatedAugmentationSampler(dataset, self.repeats, num_replicas=self.num_replicas, rank=rank)
+        if self.sampler == 'block' and stage in ('train', 'ft'):
+            return BlockShuffleSampler(
+                dataset, self.sampler_block_size, self.sampler_window, num_replicas=self.num_replicas,
+                rank=rank, local_world_size=self.local_world_size)
+        if distributed and stage in ('train', 'ft'):
+            return torch.utils.data.distributed.DistributedSampler(dataset, num_replicas=self.num_replicas, rank=rank)
+        return None
+
+    def get_local_transform(self, stage):
+        """(transform, number) of the low-resolution local crops, train stage only"""
+        if stage != 'train' or not self.local_crops:
+            return None, 0
+        return self.get_transform(stage, gb_prob=0.5, crop_size=self.local_crop_size, scale=self.local_crop_scale,
+                                  uint8=self.normalize_on_device, mask_stride=self.mask_stride), self.local_crops
+
     def set_epoch(self, epoch):
         if self.train_sampler is not None:
             self.train_sampler.set_epoch(epoch)
+        if self.service is not None:
+            # the producers share crop_size and follow the schedule themselves, ahead of the ranks
+            self.service.set_epoch(epoch)
+            return
+        self.set_crop_size(epoch)
+
+    def set_crop_size(self, epoch):
+        # set before the epoch's iterator starts its workers, so every batch of the epoch has one size
+        self.crop_size.value = scheduled_crop_size(self.resolution_schedule, epoch, self.resize_size)
 
+    @contextlib.contextmanager
+    def largest_crop(self):
+        """Train crops at the largest size of the schedule"""
+        crop_size = self.crop_size.value
+        self.crop_size.value = max([self.resize_size, *self.resolution_schedule.values()])
+        try:
+            yield
+        finally:
+            self.crop_size.value = crop_size
 
-class ImageLoadeCOCO():
+
+class ImageLoader(BaseImageLoader):
     def __init__(self, config):
-        self.image_dir = config['data']['image_dir']
-        self.num_replicas = config['world_size']
-        self.rank = config['rank']
-        self.distributed = config['distributed']
-        self.resize_size = config['data']['resize_size']
-        self.data_workers = config['data']['data_workers']
-        self.dual_views = config['data']['dual_views']
-        self.mask_type = config['data']['mask_type']
+        super().__init__(config)
+        # mask_type "patch": grid masks made at load time, no mask files
+        self.patch_segments = config['data'].get('patch_segments', [3, 3])
+        # mask_type "fh": segment each image on first access at a reduced resolution, no gen_masks.py run
+        if self.mask_type == 'fh' and config['data'].get('fh_lazy', False):
+            self.fh_masks = LazyFHMasks(config['data'].get('fh_cache_dir') or os.path.join(self.image_dir, 'masks'),
+                                        config['data'].get('fh_scale', 1000), config['data'].get('fh_min_size', 1000),
+                                        config['data'].get('fh_max_size', 128))
 
-    def get_loader(self, stage, batch_size):
-        dataset = self.get_dataset(stage)
-        if self.distributed and stage in ('train', 'ft'):
-            self.train_sampler = torch.utils.data.distributed.DistributedSampler(
-                dataset, num_replicas=self.num_replicas, rank=self.rank)
-        else:
-            self.train_sampler = None
-
-        data_loader = torch.utils.data.DataLoader(
-            dataset=dataset,
-            batch_size=batch_size,
-            shuffle=(self.train_sampler is None and stage not in ('val', 'test')),
-            num_workers=self.data_workers,
-            pin_memory=True,
-            sampler=self.train_sampler,
-            drop_last=True
-        )
-        return data_loader
+    def build_dataset(self, stage, transform):
+        image_dir = os.path.join(self.image_dir,'images', f"{'train' if stage in ('train', 'ft') else 'val'}")
+        mask_file = os.path.join(self.image_dir,'masks',stage+'_tf_img_to_'+self.mask_type+'.pkl')
+        return SSLMaskDataset(image_dir,mask_file,transform=transform,cache=self.cache,
+                              patch_segments=self.patch_segments if self.mask_type == 'patch' else None,
+                              fh_masks=self.fh_masks)
 
-    def get_dataset(self, stage):
-        #import ipdb;ipdb.set_trace()
+
+class ImageLoadeCOCO(BaseImageLoader):
+    def build_dataset(self, stage, transform):
+        # masks come from the annotations
         image_dir = os.path.join(self.image_dir, f"{'train2017' if stage in ('train', 'ft') else 'val2017'}")
-        #mask_file = os.path.join(self.image_dir,'masks',stage+'_tf_img_to_'+self.mask_type+'.pkl')
-        
-        transform1 = get_transform(stage)
-        transform2 = get_transform(stage, gb_prob=0.1, solarize_prob=0.2)
-        transform = MultiViewDataInjector([transform1, transform2])
         annoFile = os.path.join(self.image_dir,'annotations', f"{'instances_train2017.json' if stage in ('train', 'ft') else 'instances_val2017.json'}")
-        dataset = COCOMaskDataset(image_dir,annoFile,transform)
-        return dataset
-
-    def set_epoch(self, epoch):
-        if self.train_sampler is not None:
-            self.train_sampler.set_epoch(epoch)
+        return COCOMaskDataset(image_dir,annoFile,transform,cache=self.cache)
@@ -0,0 +1,187 @@
+#-*- coding:utf-8 -*-
+import os
+import math
+import warnings
+import contextlib
+from collections import OrderedDict
+
+import torch
+from torch.utils.data import Sampler
+
+
+class RepeatedAugmentationSampler(Sampler):
+    """
+    Sampler for RepeatedAugmentation: draws a new random len(dataset) // num_repeats
+    indices every epoch, split evenly over the replicas as DistributedSampler does.
+    Every index yields num_repeats view pairs, so an epoch still has about
+    len(dataset) pairs for num_repeats times fewer reads.
+    """
+
+    def __init__(self, dataset, num_repeats, num_replicas=1, rank=0, shuffle=True, seed=0):
+        self.dataset = dataset
+        self.num_repeats = num_repeats
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = math.ceil(len(dataset) / num_repeats / num_replicas)
+        self.total_size = self.num_samples * num_replicas
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+        indices = indices[:self.total_size]
+        indices += indices[:self.total_size - len(indices)]
+        return iter(indices[self.rank:self.total_size:self.num_replicas])
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+class BlockShuffleSampler(Sampler):
+    """
+    Locality-aware replacement of DistributedSampler. The dataset is cut into blocks
+    of block_size consecutive indices (neighbouring files), and block b is always read
+    by node b % num_nodes, so each node keeps reading the same files and its page cache
+    stays useful across epochs. Every epoch the node's blocks are shuffled, the samples
+    of every `window` consecutive blocks are shuffled together, and the resulting stream
+    is cut or wrapped to the node's share from a start that rotates by one block every
+    epoch, then split evenly over the local ranks. Only the uneven split of the blocks over
+    the nodes leaves samples unread (a warning is raised above 5% of the dataset).
+    """
+
+    def __init__(self, dataset, block_size=256, window=8, num_replicas=1, rank=0, local_world_size=1,
+                 shuffle=True, seed=0):
+        assert num_replicas % local_world_size == 0, \
+            ValueError(f'{num_replicas} replicas are not whole nodes of {local_world_size}')
+        self.dataset = dataset
+        self.block_size = block_size
+        self.window = window
+        self.local_world_size = local_world_size
+        self.local_rank = rank % local_world_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = math.ceil(len(dataset) / num_replicas)
+        num_nodes = num_replicas // local_world_size
+        num_blocks = math.ceil(len(dataset) / block_size)
+        self.node_blocks = list(range(rank // local_world_size, num_blocks, num_nodes))
+
+        node_share = self.num_samples * local_world_size
+        node_sizes = [sum(min(len(dataset), (b + 1) * block_size) - b * block_size
+                          for b in range(n, num_blocks, num_nodes)) for n in range(num_nodes)]
+        unread = sum(max(size - node_share, 0) for size in node_sizes)
+        if unread > 0.05 * len(dataset):
+            warnings.warn(f'BlockShuffleSampler: {unread / len(dataset):.1%} of the dataset is not read every epoch, '
+                          f'{num_blocks} blocks of {block_size} do not split evenly over {num_nodes} nodes, '
+                          f'use a smaller block_size')
+
+    def node_indices(self, epoch):
+        """Indices read by the local ranks of this node in `epoch`, rank after rank"""
+        g = torch.Generator()
+        g.manual_seed(self.seed + epoch)
+        blocks = torch.tensor(self.node_blocks)
+        if self.shuffle:
+            blocks = blocks[torch.randperm(len(blocks), generator=g)]
+        blocks = blocks.tolist()
+
+        indices = []
+        for start in range(0, len(blocks), self.window):
+            window = torch.cat([torch.arange(b * self.block_size, min((b + 1) * self.block_size, len(self.dataset)))
+                                for b in blocks[start:start + self.window]])
+            if self.shuffle:
+                window = window[torch.randperm(len(window), generator=g)]
+            indices += window.tolist()
+
+        node_share = self.num_samples * self.local_world_size
+        offset = epoch * self.block_size % max(len(indices), 1)
+        indices = indices[offset:] + indices[:offset]
+        indices *= math.ceil(node_share / max(len(indices), 1))
+        return indices[:node_share]
+
+    def rank_indices(self, epoch, local_rank):
+        """Indices read by `local_rank` of this node in `epoch`"""
+        return self.node_indices(epoch)[local_rank * self.num_samples:(local_rank + 1) * self.num_samples]
+
+    def node_reads(self, epoch):
+        """Indices read by the whole node in `epoch`, interleaved over its local ranks"""
+        indices = self.node_indices(epoch)
+        streams = [indices[r * self.num_samples:(r + 1) * self.num_samples] for r in range(self.local_world_size)]
+        return [i for step in zip(*streams) for i in step]
+
+    def estimated_page_cache_hit_rate(self, cache_size=None):
+        """
+        Simulated, not measured, hit rate of this node's page cache in the current epoch,
+        see estimate_page_cache_hit_rate(). cache_size defaults to the samples whose files
+        fit in the available RAM (default_cache_samples()).
+        """
+        if cache_size is None:
+            cache_size = default_cache_samples(self.dataset)
+        return estimate_page_cache_hit_rate(self.node_reads(self.epoch - 1), self.node_reads(self.epoch), cache_size)
+
+    def __iter__(self):
+        return iter(self.rank_indices(self.epoch, self.local_rank))
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+
+def available_memory():
+    """Bytes the kernel can give to the page cache: MemAvailable, or the free pages off Linux"""
+    with contextlib.suppress(OSError):
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def default_cache_samples(dataset, num_files=256):
+    """
+    Samples whose image files fit in the available RAM, from the mean size of num_files
+    files of dataset.samples. None (unlimited) for datasets without files.
+    """
+    samples = getattr(dataset, 'samples', None)
+    if not samples:
+        return None
+    step = max(len(samples) // num_files, 1)
+    sizes = [os.path.getsize(sample[0]) for sample in samples[::step]]
+    return max(int(available_memory() // max(sum(sizes) / len(sizes), 1)), 1)
+
+
+def estimate_page_cache_hit_rate(previous_reads, reads, cache_size=None):
+    """
+    Fraction of `reads` that a node page cache holding `previous_reads` would serve,
+    assuming it behaves as an LRU of cache_size samples (every sample read so far if
+    cache_size is None) used by nothing else. Mask files, readahead and other processes
+    are not modelled, the measured cost of misses is the loader wait time of the epoch.
+    """
+    if cache_size is None:
+        cached, hits = set(previous_reads), 0
+        for i in reads:
+            hits += i in cached
+            cached.add(i)
+        return hits / max(len(reads), 1)
+
+    cache, hits = OrderedDict(), 0
+    for epoch_reads, count in ((previous_reads, False), (reads, True)):
+        for i in epoch_reads:
+            if i in cache:
+                hits += count
+                cache.move_to_end(i)
+            else:
+                cache[i] = None
+                if len(cache) > cache_size:
+                    cache.popitem(last=False)
+    return hits / max(len(reads), 1)
@@ -0,0 +1,57 @@
+#-*- coding:utf-8 -*-
+import os
+import fcntl
+import contextlib
+
+import numpy as np
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Exclusive flock on `path`, created if missing, held by one process of the node at a time"""
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class SharedCounters():
+    """
+    int64 counters in `path`, shared by every rank and loader worker of a node: the file
+    is memory-mapped in each process and updated under the flock of lock_path. `initial`
+    (a callable returning the first values) is used when the file does not exist yet.
+    """
+
+    def __init__(self, path, num_counters, lock_path, initial=None):
+        self.path = path
+        self.num_counters = num_counters
+        self.lock_path = lock_path
+        self._array = None
+        with self.lock():
+            if not os.path.exists(path):
+                values = initial() if initial is not None else np.zeros(num_counters, dtype=np.int64)
+                np.asarray(values, dtype=np.int64).tofile(path)
+
+    def __getstate__(self):
+        # the counters are mapped again in every process
+        state = self.__dict__.copy()
+        state['_array'] = None
+        return state
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = np.memmap(self.path, dtype=np.int64, mode='r+', shape=(self.num_counters,))
+        return self._array
+
+    def lock(self):
+        return file_lock(self.lock_path)
+
+    def add(self, counter, value=1):
+        with self.lock():
+            self.array[counter] += value
+
+    def values(self):
+        return [int(v) for v in self.array]
@@ -0,0 +1,147 @@
+#-*- coding:utf-8 -*-
+import os
+import time
+import shutil
+import zlib
+import contextlib
+
+import numpy as np
+
+from .shared_counters import SharedCounters, file_lock
+
+class StagingCache():
+    """
+    Node-local copy of dataset files (images and masks) kept in cache_dir, e.g. an
+    NVMe or tmpfs directory. fetch() copies a file there on first access and returns
+    the local path. All ranks and loader workers of a node share the directory:
+    copies are serialized with striped file locks, recency is the file mtime, and the
+    least recently used files are evicted once the cache exceeds budget_bytes. Files
+    used in the last min_age seconds are never evicted, so a path returned by fetch()
+    stays valid while it is read (the budget is exceeded instead if every file is that recent).
+    evict() walks cache_dir at most once per rescan_interval seconds and otherwise evicts
+    from the oldest files of its last scan, skipping those used since.
+    Hits, misses, staged bytes and evictions are counters in cache_dir/.stats,
+    cumulative since the cache directory was created.
+    """
+    HITS, MISSES, BYTES, EVICTIONS = range(4)
+    NUM_LOCKS = 64
+
+    def __init__(self, cache_dir, budget_bytes, low_watermark=0.9, min_age=60., rescan_interval=600.):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.budget_bytes = budget_bytes
+        self.low_watermark = low_watermark
+        self.min_age = min_age
+        self.rescan_interval = rescan_interval
+        self._retry_evict = 0.
+        # (mtime, path, size) of the last scan, most recent first, and its time
+        self._entries = []
+        self._scan_time = 0.
+        self.lock_dir = os.path.join(self.cache_dir, '.locks')
+        self.stats_file = os.path.join(self.cache_dir, '.stats')
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self.counters = SharedCounters(self.stats_file, 4, os.path.join(self.lock_dir, 'stats.lock'),
+                                       initial=self._initial_stats)
+        # a cache left by an earlier job may exceed a smaller budget
+        if self.counters.array[self.BYTES] > self.budget_bytes:
+            self.evict()
+
+    def _initial_stats(self):
+        stats = np.zeros(4, dtype=np.int64)
+        stats[self.BYTES] = sum(size for _, _, size in self._scan())
+        return stats
+
+    def _lock(self, name):
+        return file_lock(os.path.join(self.lock_dir, f'{name}.lock'))
+
+    def _scan(self):
+        """(mtime, path, size) of every staged file"""
+        for root, dirs, files in os.walk(self.cache_dir):
+            if root == self.cache_dir:
+                dirs[:] = [d for d in dirs if d != '.locks']
+            for name in files:
+                path = os.path.join(root, name)
+                if path == self.stats_file or name.endswith('.tmp'):
+                    continue
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield st.st_mtime, path, st.st_size
+
+    def local_path(self, path):
+        return os.path.join(self.cache_dir, os.path.abspath(path).lstrip(os.sep))
+
+    def _copy(self, path, tmp_path):
+        shutil.copyfile(path, tmp_path)
+
+    def _hit(self, local_path):
+        """Touch a staged file, False if it is not staged (or was just evicted)"""
+        try:
+            os.utime(local_path)
+        except FileNotFoundError:
+            return False
+        self.counters.add(self.HITS)
+        return True
+
+    def fetch(self, path):
+        """Local path of `path`, staged on first access"""
+        local_path = self.local_path(path)
+        if self._hit(local_path):
+            return local_path
+
+        with self._lock(zlib.crc32(local_path.encode()) % self.NUM_LOCKS):
+            # staged by another process while waiting for the lock
+            if self._hit(local_path):
+                return local_path
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            tmp_path = f'{local_path}.{os.getpid()}.tmp'
+            self._copy(path, tmp_path)
+            os.replace(tmp_path, local_path)
+        self.counters.add(self.MISSES)
+        self.counters.add(self.BYTES, os.path.getsize(local_path))
+        if self.counters.array[self.BYTES] > self.budget_bytes and time.time() > self._retry_evict:
+            self.evict()
+        return local_path
+
+    def evict(self):
+        """Remove the least recently used files down to low_watermark * budget_bytes"""
+        with self._lock('evict'):
+            if self.counters.array[self.BYTES] <= self.budget_bytes:
+                return
+            rescan = not self._entries or time.time() - self._scan_time > self.rescan_interval
+            if rescan:
+                self._entries = sorted(self._scan(), reverse=True)
+                self._scan_time = time.time()
+                total = sum(size for _, _, size in self._entries)
+            else:
+                total = int(self.counters.array[self.BYTES])
+            freed, evicted = 0, 0
+            while self._entries and total - freed > self.low_watermark * self.budget_bytes:
+                mtime, path, size = self._entries.pop()
+                if mtime > time.time() - self.min_age:
+                    # the rest is more recent
+                    self._entries.append((mtime, path, size))
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    # fetch() touches a file before returning it, check again right before removing,
+                    # a file used since the scan is no longer among the oldest
+                    if os.stat(path).st_mtime != mtime:
+                        continue
+                    os.remove(path)
+                    freed += size
+                    evicted += 1
+            total -= freed
+            with self.counters.lock():
+                if rescan:
+                    self.counters.array[self.BYTES] = total
+                else:
+                    self.counters.array[self.BYTES] -= freed
+                self.counters.array[self.EVICTIONS] += evicted
+            if total > self.budget_bytes:
+                # only recent files left, do not scan again on every miss
+                self._retry_evict = time.time() + self.min_age
+
+    def stats(self):
+        hits, misses, staged_bytes, evictions = self.counters.values()
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / max(hits + misses, 1),
+                'bytes': staged_bytes, 'evictions': evictions}
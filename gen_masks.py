@@ -12,6 +12,7 @@ import matplotlib.image as mpimg
 import cv2 #For binanry mask edge detection
 import argparse
 from tqdm import tqdm
+from utils.mask_utils import downsample_mask, patch_mask
 
 class ImageFolderWithPaths(datasets.ImageFolder):
     """Custom dataset that includes image file paths. Extends
@@ -29,13 +30,14 @@ class ImageFolderWithPaths(datasets.ImageFolder):
     
 class Preload_Masks():
     def __init__(self,dataset_dir,output_dir,ground_mask_dir='',mask_type='fh',experiment_name='',
-                 num_threads=os.cpu_count(),scale=1000,min_size=1000,segments=[3,3]):
+                 num_threads=os.cpu_count(),scale=1000,min_size=1000,segments=[3,3],downsample=1):
         
         self.output_dir=output_dir
         self.mask_type=mask_type
         self.scale = scale
         self.min_size = min_size
         self.segments = segments
+        self.downsample = downsample # masks are stored at 1/downsample of the image resolution
         self.experiment_name = experiment_name
         self.num_threads = num_threads
         self.ground_mask_dir = ground_mask_dir
@@ -45,18 +47,7 @@ class Preload_Masks():
         self.save_path = os.path.join(self.output_dir,self.experiment_name)
         
     def create_patch_mask(self,image,segments):
-        dims=list(np.floor_divide(image.shape[1:],segments))
-
-        mask=torch.hstack([torch.cat([torch.zeros(dims[0],dims[1])+i+(j*(segments[0])) 
-                                      for i in range(segments[0])]) for j in range(segments[1])])
-
-        mods = list(np.mod(image.shape[1:],segments))
-        if mods[0]!=0:
-            mask = torch.cat([mask,torch.stack([mask[-1,:] for i in range(mods[0])])])
-        if mods[1]!=0:
-            mask = torch.hstack([mask,torch.stack([mask[:,-1] for i in range(mods[1])]).T])
-
-        return mask.int()
+        return patch_mask(*image.shape[1:],tuple(segments)).int()
 
     def create_fh_mask(self,image, scale, min_size):
         mask = felzenszwalb(image.permute(1,2,0), scale=scale, min_size=min_size)
@@ -79,6 +70,7 @@ class Preload_Masks():
             mask = self.create_patch_mask(image,segments=self.segments).to(dtype=torch.int16)
         if self.mask_type =='ground':
             mask = self.load_ground_mask(img_path).to(dtype=torch.int16)
+        mask = downsample_mask(mask, self.downsample)
         
         with open(name+suffix, 'wb') as handle:
             pickle.dump(mask, handle, protocol=pickle.HIGHEST_PROTOCOL)
@@ -1,2 +1,3 @@
 #-*- coding:utf-8 -*-
-from .detconb_loss import DetconInfoNCECriterion
\ No newline at end of file
+from .detconb_loss import DetconInfoNCECriterion
+from .memory_bank import RoiMemoryBank
@@ -1,7 +1,8 @@
 import numpy as np
 import torch
 from torch import nn
-from utils.distributed_utils import gather_from_all
+from utils.distributed_utils import gather_from_all, hierarchical_gather_from_all, new_subgroups, new_cross_subgroups
+from .memory_bank import RoiMemoryBank
 #from classy_vision.generic.distributed_util import gather_from_all
 
 class DetconInfoNCECriterion(nn.Module):
@@ -14,42 +15,131 @@ class DetconInfoNCECriterion(nn.Module):
         self.max_val = 1e9
         self.config = config
         self.rank = config['rank']
+        self.world_size = config['world_size']
+        # consecutive samples augmented from the same image (data.repeated_augmentation) are positives of each other
+        self.num_repeats = config['data'].get('repeated_augmentation', 1)
+
+        # negatives are drawn from the ranks of self.group only (None = whole world)
+        self.group = None
+        self.group_rank = self.rank
+        self.intra_group = None
+        self.inter_group = None
+        group_size = config['loss'].get('negatives_group_size')
+        if group_size == 'node':
+            group_size = config.get('local_world_size', self.world_size)
+        self.hierarchical_gather = config['loss'].get('hierarchical_gather', False)
+
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            if group_size and group_size < self.world_size:
+                self.group = new_subgroups(group_size)
+                self.group_rank = self.rank % group_size
+            elif self.hierarchical_gather:
+                local_world_size = config.get('local_world_size', self.world_size)
+                self.intra_group = new_subgroups(local_world_size)
+                self.inter_group = new_cross_subgroups(local_world_size)
+
+        # optional FIFO queue of past target embeddings used as extra negatives
+        self.memory_bank = None
+        queue_size = config['loss'].get('queue_size', 0)
+        if queue_size:
+            queue_device = config['loss'].get('queue_device', 'cuda')
+            if queue_device == 'cuda':
+                queue_device = f"cuda:{config.get('local_rank', 0)}" if torch.cuda.is_available() else 'cpu'
+            self.memory_bank = RoiMemoryBank(queue_size, self.num_rois,
+                                             config['model']['projection']['output_dim'], device=queue_device)
+
+    def gather_negatives(self, x):
+        if self.intra_group is not None:
+            return hierarchical_gather_from_all(x, self.intra_group, self.inter_group)
+        return gather_from_all(x, group=self.group)
+
     def make_same_obj(self,ind_0, ind_1):
         b = ind_0.shape[0]
         same_obj = torch.eq(ind_0.reshape([b, self.num_rois, 1]),
                              ind_1.reshape([b, 1, self.num_rois]))
         return same_obj.float().unsqueeze(2)
 
+    def make_same_obj_large(self, ind_0, ind_large):
+        """(B, R, B_large, R) same-object mask of the ROIs of ind_0 against those of every gathered sample"""
+        same_obj = torch.eq(ind_0.reshape([ind_0.shape[0], self.num_rois, 1, 1]),
+                            ind_large.reshape([1, 1, ind_large.shape[0], self.num_rois]))
+        return same_obj.float()
+
+    def same_obj_labels(self, pind, tind, tind_large):
+        """
+        Same-object mask broadcastable against the gathered samples: without repeats only the
+        sample itself is labelled, repeats of the image compare against their own target ids
+        """
+        if self.num_repeats > 1:
+            return self.make_same_obj_large(pind, tind_large)
+        return self.make_same_obj(pind, tind)
+
     def manual_cross_entropy(self,labels, logits, weight):
         ce = - weight * torch.sum(labels * torch.nn.functional.log_softmax(logits,dim = -1), dim=-1)
         return torch.mean(ce)
 
+    def local_crops_loss(self, local_pred, local_pind, targets_large, tinds, tinds_large, labels_local,
+                         queue=None, empty=None):
+        """
+        One term per local crop, like loss_a: the ROIs of the same object in both global
+        target views of the same image are positives, all other gathered (and queued) ROIs negatives
+        """
+        loss = 0.
+        for pred, pind in zip(local_pred.split(self.batch_size), local_pind.split(self.batch_size)):
+            pred = torch.nn.functional.normalize(pred,dim=-1)
+            logits = torch.cat([torch.einsum("abk,uvk->abuv", pred, target_large) for target_large in targets_large], axis=2)
+            labels = torch.cat([labels_local * self.same_obj_labels(pind, tind, tind_large)
+                                for tind, tind_large in zip(tinds, tinds_large)], axis=2)
+            logits = torch.reshape(logits / self.temperature, [self.batch_size, self.num_rois, -1])
+            labels = torch.reshape(labels, [self.batch_size, self.num_rois, -1])
+
+            num_positives = torch.sum(labels, axis=-1, keepdims=True)
+            labels = labels / torch.max(num_positives, torch.ones_like(num_positives))
+            obj_area = torch.sum(self.make_same_obj(pind, pind), axis=[2, 3])
+            weights = torch.greater(num_positives[..., 0], 1e-3).float() / obj_area
+
+            if queue is not None:
+                logits_q = torch.einsum("abk,uvk->abuv", pred, queue).reshape([self.batch_size, self.num_rois, -1])
+                logits = torch.cat([logits, logits_q / self.temperature - empty], axis=2)
+                labels = torch.cat([labels, torch.zeros_like(logits_q)], axis=2)
+            loss = loss + self.manual_cross_entropy(labels, logits, weights)
+        return loss
+
     def forward(self, target, pred, tind, pind):        
         #import ipdb;ipdb.set_trace()
+        # predictions of the online local crops, if any, follow the 2B global ones
+        local_pred, local_pind = pred[2 * self.batch_size:], pind[2 * self.batch_size:]
+        pred, pind = pred[:2 * self.batch_size], pind[:2 * self.batch_size]
         target1,target2 = target[:self.batch_size],target[self.batch_size:]
         pred1,pred2 = pred[:self.batch_size],pred[self.batch_size:]
         tind1,tind2 = tind[:self.batch_size],tind[self.batch_size:]
         pind1,pind2 = pind[:self.batch_size],pind[self.batch_size:]
         
-        same_obj_aa = self.make_same_obj(pind1, tind1)
-        same_obj_ab = self.make_same_obj(pind1, tind2)
-        same_obj_ba = self.make_same_obj(pind2, tind1)
-        same_obj_bb = self.make_same_obj(pind2, tind2)
-        
         pred1 = torch.nn.functional.normalize(pred1,dim=-1)
         pred2 = torch.nn.functional.normalize(pred2,dim=-1)
         target1 = torch.nn.functional.normalize(target1,dim=-1)
         target2 = torch.nn.functional.normalize(target2,dim=-1)
         
         if torch.distributed.is_available() and torch.distributed.is_initialized():
-            labels_idx = np.arange(self.batch_size) + self.rank * self.batch_size
-            
-            target1_large = gather_from_all(target1)
-            target2_large = gather_from_all(target2)
-            enlarged_batch_size = target1_large.shape[0]
-
-            labels_local = torch.nn.functional.one_hot(torch.tensor(labels_idx),
-                                                       enlarged_batch_size).unsqueeze(1).unsqueeze(3).to('cuda')
+            labels_idx = np.arange(self.batch_size) + self.group_rank * self.batch_size
+            target1_large = self.gather_negatives(target1)
+            target2_large = self.gather_negatives(target2)
+            tind1_large = self.gather_negatives(tind1)
+            tind2_large = self.gather_negatives(tind2)
+        else:
+            labels_idx = np.arange(self.batch_size)
+            target1_large, tind1_large = target1, tind1
+            target2_large, tind2_large = target2, tind2
+        enlarged_batch_size = target1_large.shape[0]
+
+        same_image = torch.eq(torch.tensor(labels_idx).unsqueeze(1) // self.num_repeats,
+                              torch.arange(enlarged_batch_size).unsqueeze(0) // self.num_repeats)
+        labels_local = same_image.float().unsqueeze(1).unsqueeze(3).to(pred.device)
+
+        same_obj_aa = self.same_obj_labels(pind1, tind1, tind1_large)
+        same_obj_ab = self.same_obj_labels(pind1, tind2, tind2_large)
+        same_obj_ba = self.same_obj_labels(pind2, tind1, tind1_large)
+        same_obj_bb = self.same_obj_labels(pind2, tind2, tind2_large)
 
         logits_aa = torch.einsum("abk,uvk->abuv", pred1, target1_large) / self.temperature
         logits_bb = torch.einsum("abk,uvk->abuv", pred2, target2_large) / self.temperature
@@ -75,8 +165,8 @@ class DetconInfoNCECriterion(nn.Module):
         num_positives_0 = torch.sum(labels_0, axis=-1, keepdims=True)
         num_positives_1 = torch.sum(labels_1, axis=-1, keepdims=True)
 
-        labels_0 = labels_0 / torch.max(num_positives_0, torch.ones(num_positives_0.shape).to('cuda'))
-        labels_1 = labels_1 / torch.max(num_positives_1, torch.ones(num_positives_1.shape).to('cuda'))
+        labels_0 = labels_0 / torch.max(num_positives_0, torch.ones_like(num_positives_0))
+        labels_1 = labels_1 / torch.max(num_positives_1, torch.ones_like(num_positives_1))
 
         obj_area_0 = torch.sum(self.make_same_obj(pind1, pind1), axis=[2, 3])
         obj_area_1 = torch.sum(self.make_same_obj(pind2, pind2), axis=[2, 3])
@@ -92,8 +182,26 @@ class DetconInfoNCECriterion(nn.Module):
         logits_abaa = torch.reshape(logits_abaa, [self.batch_size, self.num_rois, -1])
         logits_babb = torch.reshape(logits_babb, [self.batch_size, self.num_rois, -1])
 
+        queue, empty = None, None
+        if self.memory_bank is not None:
+            # queued embeddings come from other images, so they are negatives only
+            queue, empty = self.memory_bank.get(pred.device)
+            empty = self.max_val * empty.reshape([1, 1, -1]).float()
+            logits_aq = torch.einsum("abk,uvk->abuv", pred1, queue).reshape([self.batch_size, self.num_rois, -1])
+            logits_bq = torch.einsum("abk,uvk->abuv", pred2, queue).reshape([self.batch_size, self.num_rois, -1])
+            logits_abaa = torch.cat([logits_abaa, logits_aq / self.temperature - empty], axis=2)
+            logits_babb = torch.cat([logits_babb, logits_bq / self.temperature - empty], axis=2)
+            labels_0 = torch.cat([labels_0, torch.zeros_like(logits_aq)], axis=2)
+            labels_1 = torch.cat([labels_1, torch.zeros_like(logits_bq)], axis=2)
+            self.memory_bank.enqueue(torch.cat([target1_large, target2_large]),
+                                     torch.cat([tind1_large, tind2_large]))
+
         loss_a = self.manual_cross_entropy(labels_0, logits_abaa, weights_0)
         loss_b = self.manual_cross_entropy(labels_1, logits_babb, weights_1)
         loss = loss_a + loss_b
+        if local_pred.shape[0]:
+            loss = loss + self.local_crops_loss(local_pred, local_pind, [target1_large, target2_large],
+                                                [tind1, tind2], [tind1_large, tind2_large], labels_local,
+                                                queue, empty)
 
         return loss 
\ No newline at end of file
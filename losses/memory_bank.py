@@ -0,0 +1,39 @@
+import torch
+from torch import nn
+
+class RoiMemoryBank(nn.Module):
+    """
+    FIFO queue of past target ROI embeddings (and their mask ids), used as extra
+    negatives by DetconInfoNCECriterion. Empty slots hold mask id -1.
+    Enqueued entries are only written on the next get(), so the queue returned
+    for the current step is not modified before its backward pass.
+    """
+
+    def __init__(self, size, num_rois, dim, device='cpu'):
+        super(RoiMemoryBank, self).__init__()
+        self.size = size
+        self.register_buffer('embeddings', torch.zeros(size, num_rois, dim, device=device))
+        self.register_buffer('mask_ids', torch.full((size, num_rois), -1, dtype=torch.long, device=device))
+        self.ptr = 0
+        self.pending = None
+
+    def enqueue(self, embeddings, mask_ids):
+        self.pending = (embeddings.detach(), mask_ids.detach())
+
+    @torch.no_grad()
+    def _write(self, embeddings, mask_ids):
+        embeddings, mask_ids = embeddings[-self.size:], mask_ids[-self.size:]
+        n = embeddings.shape[0]
+        idx = (self.ptr + torch.arange(n, device=self.embeddings.device)) % self.size
+        self.embeddings[idx] = embeddings.to(self.embeddings.device, self.embeddings.dtype)
+        self.mask_ids[idx] = mask_ids.to(self.mask_ids.device, torch.long)
+        self.ptr = (self.ptr + n) % self.size
+
+    def get(self, device):
+        """Return (embeddings, empty-slot mask) on `device`"""
+        if self.pending is not None:
+            self._write(*self.pending)
+            self.pending = None
+        embeddings = self.embeddings.to(device, non_blocking=True)
+        empty = self.mask_ids.to(device, non_blocking=True) < 0
+        return embeddings, empty
@@ -2,16 +2,42 @@
 import torch
 import torch.nn as nn
 from torchvision import models
+from torch.utils.checkpoint import checkpoint
 from utils.mask_utils import sample_masks
 import torch.nn.functional as F
 from model.models import MLP,Masknet,FPN
 
+def checkpoint_module(module, *inputs):
+    """
+    Activation checkpointing of `module`. BatchNorm running statistics are only
+    updated by the original forward, not again by the recomputation in backward
+    """
+    state = {'recompute': False}
+
+    def run(*inputs):
+        if not state['recompute']:
+            state['recompute'] = True
+            return module(*inputs)
+        bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+        momenta = [bn.momentum for bn in bns]
+        for bn in bns:
+            bn.momentum = 0.
+        try:
+            return module(*inputs)
+        finally:
+            for bn, momentum in zip(bns, momenta):
+                bn.momentum = momentum
+
+    return checkpoint(run, *inputs, use_reentrant=False)
+
 class EncoderwithProjection(nn.Module):
     def __init__(self, config):
         super().__init__()
         self.mask_rois = config['loss']['mask_rois']
         self.pool_size = config['loss']['pool_size']
         self.train_batch_size = config['data']['train_batch_size']
+        # backbone stages ("C1".."C5", "fpn") recomputed in backward instead of keeping their activations
+        self.checkpoint_stages = set(config['model'].get('checkpoint_stages') or [])
         
         if config['log']['wandb_enable']:
             from utils.visualize_masks import wandb_sample
@@ -37,41 +63,51 @@ class EncoderwithProjection(nn.Module):
         output_dim = config['model']['projection']['output_dim']
         self.projetion = MLP(input_dim=input_dim, hidden_dim=hidden_dim, output_dim=output_dim,mask_roi=self.mask_rois)        
         
+    def run_stage(self, name, module, *inputs):
+        if name in self.checkpoint_stages and self.training and torch.is_grad_enabled():
+            return checkpoint_module(module, *inputs)
+        return module(*inputs)
+
     def forward(self, x, masks, mnet=None,wandb_id=None,net_type=None):
         #import ipdb;ipdb.set_trace()
         if self.pool_size==7:
-            x = self.encoder(x) #(B, 2048, pool_size, pool_size)
+            if self.checkpoint_stages:
+                stages = [self.encoder[:4]] + list(self.encoder[4:])
+                for name, stage in zip(['C1', 'C2', 'C3', 'C4', 'C5'], stages):
+                    x = self.run_stage(name, stage, x)
+            else:
+                x = self.encoder(x) #(B, 2048, pool_size, pool_size)
         else:
-            x = self.C1(x)
-            x = self.C2(x)
+            x = self.run_stage('C1', self.C1, x)
+            x = self.run_stage('C2', self.C2, x)
             c2_out = x
-            x = self.C3(x)
+            x = self.run_stage('C3', self.C3, x)
             c3_out = x
-            x = self.C4(x)
+            x = self.run_stage('C4', self.C4, x)
             c4_out = x
-            x = self.C5(x)     
-            x = self.fpn(x,c2_out,c3_out,c4_out)
+            x = self.run_stage('C5', self.C5, x)
+            x = self.run_stage('fpn', self.fpn, x, c2_out, c3_out, c4_out)
             
         masks,mask_ids = sample_masks(masks,self.mask_rois)
 
         # Wandb Logging
         if wandb_id!=None:
-            wandb_sample(self.mask_rois,self.pool_size,masks[wandb_id],masks[wandb_id+self.train_batch_size],'sample_masks_'+net_type)
+            wandb_sample(self.mask_rois,x.shape[-1],masks[wandb_id],masks[wandb_id+self.train_batch_size],'sample_masks_'+net_type)
         
         if mnet!= None:
-            masks = mnet(x.detach(),masks.to('cuda'))
+            masks = mnet(x.detach(),masks.to(x.device))
         
         # Wandb Logging
         if wandb_id!=None:
-            wandb_sample(self.mask_rois,self.pool_size,masks[wandb_id],masks[wandb_id+self.train_batch_size],'masknet_masks_'+net_type)
+            wandb_sample(self.mask_rois,x.shape[-1],masks[wandb_id],masks[wandb_id+self.train_batch_size],'masknet_masks_'+net_type)
         
         # Detcon mask multiply
         bs, emb, emb_x, emb_y  = x.shape
-        x = x.permute(0,2,3,1) #(B, pool_size, pool_size, 2048)
+        x = x.permute(0,2,3,1) #(B, pool_size, pool_size, 2048), a view without copy for channels-last features
         masks_area = masks.sum(axis=-1, keepdims=True)
         smpl_masks = masks / torch.maximum(masks_area, torch.ones_like(masks_area))
         embedding_local = torch.reshape(x,[bs, emb_x*emb_y, emb])
-        x = torch.matmul(smpl_masks.float().to('cuda'), embedding_local)
+        x = torch.matmul(smpl_masks.float().to(x.device), embedding_local)
         
         x = self.projetion(x)
         return x, mask_ids
@@ -1,4 +1,6 @@
 #-*- coding:utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 from .basic_modules import EncoderwithProjection, Predictor, Masknet
 from utils.mask_utils import convert_binary_mask
@@ -7,6 +9,8 @@ class BYOLModel(torch.nn.Module):
     def __init__(self, config):
         super().__init__()
         self.pool_size = config['loss']['pool_size']
+        # backbone/FPN output stride, the pooling grid is crop_size // feature_stride (pool_size at 224)
+        self.feature_stride = 224 // self.pool_size
         self.train_batch_size = config['data']['train_batch_size']
         
         if config['log']['wandb_enable']:
@@ -18,44 +22,137 @@ class BYOLModel(torch.nn.Module):
         # target network
         self.target_network = EncoderwithProjection(config)
         
-        #mask net
-        self.masknet = Masknet(config)
+        #mask net, model.masknet.enabled: False uses the sampled masks unrefined
+        masknet_enabled = config['model'].get('masknet', {}).get('enabled', True)
+        self.masknet = Masknet(config) if masknet_enabled else None
         
         # predictor
         self.predictor = Predictor(config)
 
+        # target network working precision, the EMA is accumulated in an fp32 master copy
+        self.target_dtype = getattr(torch, config['model'].get('target_dtype', 'float32'))
+        self.register_buffer('target_master', None)
+        # every rank applies the same EMA to the same weights, DDP must not broadcast the
+        # fp32 copy with the buffers every step (it is synced once when DDP is built)
+        self._ddp_params_and_buffers_to_ignore = ['target_master']
+
+        # run the target branch (EMA update + forward) alongside the online branch:
+        # on a side CUDA stream, or on a worker thread on CPU
+        self.concurrent_branches = config['model'].get('concurrent_branches', False)
+        self._target_stream = None
+        self._target_thread = None
+
         self._initializes_target_network()
+        self._register_load_state_dict_pre_hook(self._convert_target_state)
 
     @torch.no_grad()
     def _initializes_target_network(self):
         for param_q, param_k in zip(self.online_network.parameters(), self.target_network.parameters()):
             param_k.data.copy_(param_q.data)  # initialize
             param_k.requires_grad = False     # not update by gradient
+        if self.target_dtype != torch.float32:
+            self.target_master = torch.cat([p.reshape(-1) for p in self.target_network.parameters()])
+            self.target_network.to(self.target_dtype)
+
+    def _master_params(self):
+        """Views of the flat fp32 master copy shaped like the target parameters"""
+        params = list(self.target_network.parameters())
+        masters = self.target_master.split([p.numel() for p in params])
+        return [m.view_as(p) for m, p in zip(masters, params)]
+
+    def _convert_target_state(self, state_dict, prefix, *args):
+        """Load checkpoints saved with a different target_dtype"""
+        names = [prefix + 'target_network.' + name for name, _ in self.target_network.named_parameters()]
+        if self.target_master is not None and prefix + 'target_master' not in state_dict:
+            state_dict[prefix + 'target_master'] = torch.cat([state_dict[name].float().reshape(-1) for name in names])
+        elif self.target_master is None and prefix + 'target_master' in state_dict:
+            masters = state_dict.pop(prefix + 'target_master').split([state_dict[name].numel() for name in names])
+            for name, master in zip(names, masters):
+                state_dict[name] = master.view_as(state_dict[name])
 
     @torch.no_grad()
     def _update_target_network(self, mm):
         """Momentum update of target network"""
-        for param_q, param_k in zip(self.online_network.parameters(), self.target_network.parameters()):
-            param_k.data.mul_(mm).add_(1. - mm, param_q.data)
+        online = [param_q.data for param_q in self.online_network.parameters()]
+        if self.target_master is None:
+            for param_q, param_k in zip(online, self.target_network.parameters()):
+                param_k.data.mul_(mm).add_(param_q, alpha=1. - mm)
+            return
+        masters = self._master_params()
+        torch._foreach_mul_(masters, mm)
+        torch._foreach_add_(masters, online, alpha=1. - mm)
+        for master, param_k in zip(masters, self.target_network.parameters()):
+            param_k.data.copy_(master)
 
-    def forward(self, view1, view2, mm, masks, wandb_id):
-        # online network forward
+    def forward(self, images, mm, masks, wandb_id, update_target=True, local_images=None, local_masks=None):
+        # images (2B, C, H, W) and masks (2B, 1, H, W) are view-major: view1 of the batch, then view2
+        # optional local crops (LB, C, h, w) only go through the online branch, their predictions
+        # and mask ids are appended after the 2B global ones
         #import ipdb;ipdb.set_trace()
+        batch_size = images.shape[0] // 2
         
         # Wandb Logging
         if wandb_id!=None:  
-            wandb_set(view1[wandb_id].permute(1,2,0),view2[wandb_id].permute(1,2,0),'views')
-            wandb_set(masks[wandb_id][0].squeeze(),masks[wandb_id][1].squeeze(),'fh_masks')
-        
-        masks = torch.cat([ masks[:,i,:,:,:] for i in range(masks.shape[1])])
+            wandb_set(images[wandb_id].permute(1,2,0),images[wandb_id+batch_size].permute(1,2,0),'views')
+            wandb_set(masks[wandb_id].squeeze(),masks[wandb_id+batch_size].squeeze(),'fh_masks')
             
-        masks = convert_binary_mask(masks,pool_size = self.pool_size)
-        q,pinds = self.predictor(*self.online_network(torch.cat([view1, view2], dim=0),masks,self.masknet,wandb_id,'online'))
+        masks = convert_binary_mask(masks,pool_size = images.shape[-1] // self.feature_stride)
+        # both branches run on the same [view1, view2] order with the same masks,
+        # DetconInfoNCECriterion pairs pred1 with target2 and pred2 with target1 itself
+        online_views = images
+        target_args = (images, masks, mm, update_target, wandb_id)
 
-        # target network forward
-        with torch.no_grad():
-            self._update_target_network(mm)
-            target_z, tinds = self.target_network(torch.cat([view2, view1], dim=0),masks,self.masknet,wandb_id,'target')
-            target_z = target_z.detach().clone()
+        if not self.concurrent_branches:
+            q,pinds = self._online_forward(online_views, masks, local_images, local_masks, wandb_id)
+            target_z, tinds = self._target_forward(*target_args)
+
+        elif online_views.is_cuda:
+            if self._target_stream is None:
+                self._target_stream = torch.cuda.Stream()
+            current_stream = torch.cuda.current_stream()
+            self._target_stream.wait_stream(current_stream)
+            with torch.cuda.stream(self._target_stream):
+                target_z, tinds = self._target_forward(*target_args)
+            q,pinds = self._online_forward(online_views, masks, local_images, local_masks, wandb_id)
+            current_stream.wait_stream(self._target_stream)
+            target_z.record_stream(current_stream)
+            tinds.record_stream(current_stream)
+
+        else:
+            if self._target_thread is None:
+                self._target_thread = ThreadPoolExecutor(max_workers=1)
+            # autocast state is thread local, replicate it on the worker thread
+            autocast = (torch.is_autocast_enabled('cpu'), torch.get_autocast_dtype('cpu'))
+            future = self._target_thread.submit(self._target_forward_thread, autocast, *target_args)
+            q,pinds = self._online_forward(online_views, masks, local_images, local_masks, wandb_id)
+            target_z, tinds = future.result()
 
         return q, target_z, pinds, tinds
+
+    def _online_forward(self, views, masks, local_images, local_masks, wandb_id):
+        """Online branch on the global views, then on the local crops (a separate forward, as their size differs)"""
+        q,pinds = self.predictor(*self.online_network(views,masks,self.masknet,wandb_id,'online'))
+        if local_images is None:
+            return q, pinds
+        local_masks = convert_binary_mask(local_masks,pool_size = local_images.shape[-1] // self.feature_stride)
+        local_q,local_pinds = self.predictor(*self.online_network(local_images,local_masks,self.masknet))
+        return torch.cat([q, local_q]), torch.cat([pinds, local_pinds])
+
+    def _target_forward(self, views, masks, mm, update_target, wandb_id):
+        """Target branch: momentum update then forward without gradients"""
+        with torch.no_grad():
+            if update_target:
+                self._update_target_network(mm)
+            if self.target_master is None:
+                target_z, tinds = self.target_network(views,masks,self.masknet,wandb_id,'target')
+            else:
+                with torch.autocast(device_type=views.device.type, dtype=self.target_dtype):
+                    target_z, tinds = self.target_network(views,masks,self.masknet,wandb_id,'target')
+            target_z = target_z.detach().float().clone()
+        return target_z, tinds
+
+    def _target_forward_thread(self, autocast, *args):
+        """_target_forward on a worker thread, under the caller's (thread local) autocast state"""
+        enabled, dtype = autocast
+        with torch.autocast('cpu', enabled=enabled, dtype=dtype):
+            return self._target_forward(*args)
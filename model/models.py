@@ -26,16 +26,22 @@ class Masknet(nn.Module):
         super().__init__()
         self.mask_rois = config['loss']['mask_rois']
         self.pool_size = config['loss']['pool_size']
-        self.conv1 = nn.Conv2d(2048, 2048, 1)
-        self.conv2 = nn.Conv2d(2048, 2048, 1)
-        self.conv3 = nn.Conv2d(2048, self.mask_rois, 1)
+        # 1x1 convs conv1..convN: hidden widths from model.masknet, then mask_rois outputs
+        input_dim = config['model']['projection']['input_dim']
+        hidden_dims = config['model'].get('masknet', {}).get('hidden_dims', [2048, 2048])
+        dims = [input_dim] + list(hidden_dims) + [self.mask_rois]
+        self.num_convs = len(dims) - 1
+        for i in range(self.num_convs):
+            setattr(self, f'conv{i + 1}', nn.Conv2d(dims[i], dims[i + 1], 1))
         self.softmax = nn.Softmax(dim=-1)
         #self.norm = nn.BatchNorm2d(self.mask_rois, self.mask_rois)
 
     def forward(self, x, masks):
         #import ipdb;ipdb.set_trace()
-        x = self.conv3(F.relu(self.conv2(F.relu(self.conv1(x)))))
-        x = torch.reshape(x,(-1, self.mask_rois, self.pool_size*self.pool_size))
+        for i in range(1, self.num_convs):
+            x = F.relu(getattr(self, f'conv{i}')(x))
+        x = getattr(self, f'conv{self.num_convs}')(x)
+        x = torch.reshape(x,(-1, self.mask_rois, x.shape[-2]*x.shape[-1]))
         y = x+masks
         y = self.softmax(y)
         return y
@@ -85,6 +85,7 @@ class LARS(Optimizer):
 
                 d_p = p.grad
 
+                # norms are taken on the fp32 weights and (unscaled) fp32 gradients
                 if lars_exclude:
                     local_lr = 1.
                 else:
@@ -93,11 +94,12 @@ class LARS(Optimizer):
                     update_norm = (grad_norm + weight_decay * weight_norm)
                     # Compute local learning rate for this layer
                     #import ipdb;ipdb.set_trace()
+                    one = torch.tensor(1.0, dtype=torch.float32, device=p.device)
                     local_lr = torch.where(
                         weight_norm >0,
                         torch.where(
-                            update_norm >0, (eta * weight_norm /update_norm ), torch.tensor(1.0,dtype=torch.float32).to('cuda')
-                        ), torch.tensor(1.0,dtype=torch.float32).to('cuda')
+                            update_norm >0, (eta * weight_norm /update_norm ), one
+                        ), one
                     )
                     # Legacy version: NO check for denom==0
                     # local_lr = eta * weight_norm / \
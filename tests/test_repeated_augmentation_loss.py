@@ -0,0 +1,62 @@
+"""Repeats of one image are matched against their own target ROI ids"""
+import os
+
+import yaml
+import torch
+
+from losses.detconb_loss import DetconInfoNCECriterion
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BATCH_SIZE = 4
+REPEATS = 2
+
+
+def load_config():
+    with open(os.path.join(ROOT, 'config', 'train_sample_300.yaml'), 'r') as f:
+        config = yaml.safe_load(f)
+    config.update({'world_size': 1, 'rank': 0, 'local_rank': 0, 'local_world_size': 1, 'distributed': False})
+    config['data']['train_batch_size'] = BATCH_SIZE
+    config['data']['repeated_augmentation'] = REPEATS
+    config['loss']['queue_size'] = 0
+    return config
+
+
+def batch(criterion, num_ids=3, dim=8):
+    """Random view-major outputs, every sample (and so every repeat) with its own target ROI ids"""
+    torch.manual_seed(0)
+    rois = criterion.num_rois
+    target, pred = torch.randn(2 * BATCH_SIZE, rois, dim), torch.randn(2 * BATCH_SIZE, rois, dim)
+    tind = torch.randint(0, num_ids, (2 * BATCH_SIZE, rois))
+    pind = torch.randint(0, num_ids, (2 * BATCH_SIZE, rois))
+    return target, pred, tind, pind
+
+
+def permute_rois(x, rows, perm):
+    x = x.clone()
+    x[rows] = x[rows][:, perm]
+    return x
+
+
+def test_repeat_targets_keep_their_roi_ids():
+    """Reordering the target ROIs of one repeat together with their ids leaves the loss unchanged"""
+    criterion = DetconInfoNCECriterion(load_config())
+    target, pred, tind, pind = batch(criterion)
+    assert not torch.equal(tind[0], tind[1])
+    # sample 1 is the second repeat of the image of sample 0, in both views
+    rows, perm = [1, BATCH_SIZE + 1], torch.randperm(criterion.num_rois)
+    loss = criterion(target, pred, tind, pind)
+    permuted = criterion(permute_rois(target, rows, perm), pred, permute_rois(tind, rows, perm), pind)
+    torch.testing.assert_close(permuted, loss)
+
+
+def test_local_crops_use_repeat_roi_ids():
+    """Same for the local crop term, whose predictions follow the 2B global ones"""
+    criterion = DetconInfoNCECriterion(load_config())
+    target, pred, tind, pind = batch(criterion)
+    local_pred = torch.randn(BATCH_SIZE, criterion.num_rois, 8)
+    local_pind = torch.randint(0, 3, (BATCH_SIZE, criterion.num_rois))
+    pred, pind = torch.cat([pred, local_pred]), torch.cat([pind, local_pind])
+    rows, perm = [1, BATCH_SIZE + 1], torch.randperm(criterion.num_rois)
+    loss = criterion(target, pred, tind, pind)
+    permuted = criterion(permute_rois(target, rows, perm), pred, permute_rois(tind, rows, perm), pind)
+    torch.testing.assert_close(permuted, loss)
@@ -0,0 +1,62 @@
+"""The online predictions of one view are trained against the target outputs of the other view"""
+import os
+
+import yaml
+import pytest
+import torch
+
+from model.byol_model import BYOLModel
+from losses.detconb_loss import DetconInfoNCECriterion
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BATCH_SIZE = 2
+
+
+def load_config():
+    with open(os.path.join(ROOT, 'config', 'train_sample_300.yaml'), 'r') as f:
+        config = yaml.safe_load(f)
+    config.update({'world_size': 1, 'rank': 0, 'local_rank': 0, 'local_world_size': 1, 'distributed': False})
+    config['log']['wandb_enable'] = False
+    config['data']['train_batch_size'] = BATCH_SIZE
+    return config
+
+
+@pytest.fixture(scope='module')
+def model():
+    torch.manual_seed(0)
+    # eval: batch norm uses running statistics, so every output row depends on its own input only
+    return BYOLModel(load_config()).eval()
+
+
+def forward(model, images):
+    # one segment per view, the sampled mask ids do not depend on the random draw
+    masks = torch.zeros(images.shape[0], 1, *images.shape[2:], dtype=torch.int64)
+    with torch.no_grad():
+        return model(images, 0.99, masks, None, update_target=False)
+
+
+def test_outputs_follow_view_order(model):
+    """q[i], target_z[i] and their mask ids come from images[i] of the view-major [view1, view2] batch"""
+    images = torch.randn(2 * BATCH_SIZE, 3, 64, 64)
+    changed = images.clone()
+    changed[BATCH_SIZE:] = torch.randn(BATCH_SIZE, 3, 64, 64)
+    q, target_z, pinds, tinds = forward(model, images)
+    q_changed, target_changed, _, _ = forward(model, changed)
+    assert q.shape[0] == target_z.shape[0] == pinds.shape[0] == tinds.shape[0] == 2 * BATCH_SIZE
+    # only the rows of the changed view 2 move, in both branches
+    torch.testing.assert_close(q_changed[:BATCH_SIZE], q[:BATCH_SIZE])
+    torch.testing.assert_close(target_changed[:BATCH_SIZE], target_z[:BATCH_SIZE])
+    assert not torch.allclose(q_changed[BATCH_SIZE:], q[BATCH_SIZE:])
+    assert not torch.allclose(target_changed[BATCH_SIZE:], target_z[BATCH_SIZE:])
+
+
+def test_criterion_pairs_across_views():
+    """Predictions equal to the other view's targets minimize the loss, equal to their own view's do not"""
+    config = load_config()
+    criterion = DetconInfoNCECriterion(config)
+    num_rois, dim = config['loss']['mask_rois'], 8
+    torch.manual_seed(0)
+    target = torch.randn(2 * BATCH_SIZE, num_rois, dim)
+    inds = torch.arange(num_rois).repeat(2 * BATCH_SIZE, 1)
+    crossed = torch.cat([target[BATCH_SIZE:], target[:BATCH_SIZE]])
+    assert criterion(target, crossed, inds, inds) < criterion(target, target, inds, inds)
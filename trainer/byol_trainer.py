@@ -2,21 +2,28 @@
 import os
 import time
 import datetime
+import contextlib
 
 import numpy as np
 import torch
 import torch.nn.functional as F
+import torch.distributed as dist
 import torch.backends.cudnn as cudnn
 
 from tensorboardX import SummaryWriter
-import apex
-from apex.parallel import DistributedDataParallel as DDP
-from apex import amp
+try:
+    import apex
+    from apex.parallel import DistributedDataParallel as ApexDDP
+    from apex import amp
+except ImportError:
+    apex = None
 
 from model import BYOLModel
 from optimizer import LARS
 from data import ImageLoader,ImageLoadeCOCO
+from data.image_loader import scheduled_crop_size
 from utils import distributed_utils, params_util, logging_util, eval_util
+from utils.compile_util import compile_model
 from utils.data_prefetcher import data_prefetcher
 from losses import DetconInfoNCECriterion
 
@@ -39,7 +46,8 @@ class BYOLTrainer():
 
         self.train_batch_size = self.config['data']['train_batch_size']
         self.val_batch_size = self.config['data']['val_batch_size']
-        self.global_batch_size = self.world_size * self.train_batch_size
+        self.accumulation_steps = self.config['optimizer'].get('accumulation_steps', 1)
+        self.global_batch_size = self.world_size * self.train_batch_size * self.accumulation_steps
 
         self.num_examples = self.config['data']['num_examples']
         self.warmup_steps = self.warmup_epochs * self.num_examples // self.global_batch_size
@@ -103,37 +111,85 @@ class BYOLTrainer():
         else:
             self.data_ins = ImageLoader(self.config)
         self.train_loader = self.data_ins.get_loader(self.stage, self.train_batch_size)
+        # (epoch, iterator) started ahead of the epoch while the checkpoint is saved
+        self.next_loader_iter = None
+        # batches copied to the device ahead of the step, and a thread feeding them (always used on CPU)
+        self.prefetch_depth = self.config['data'].get('prefetch_depth', 1)
+        self.prefetch_thread = self.config['data'].get('prefetch_thread', False)
+        if self.gpu == 0 and self.data_ins.autotune_results:
+            for num_workers, prefetch_factor, rate in self.data_ins.autotune_results:
+                print(f'loader autotune: {num_workers} workers, prefetch {prefetch_factor}: {rate:.1f} samples/s')
+            best = max(rate for *_, rate in self.data_ins.autotune_results)
+            print(f'loader autotune: using {self.data_ins.data_workers} workers, '
+                  f'prefetch {self.data_ins.prefetch_factor} ({best:.1f} samples/s)')
+        if self.gpu == 0 and hasattr(self.train_loader.dataset, 'nbytes'):
+            print(f'in-memory dataset: {len(self.train_loader.dataset)} samples, '
+                  f'{self.train_loader.dataset.nbytes / 2**30:.2f} GB in {self.data_ins.in_memory_dir}')
+        # data.fh_lazy counters (node-wide, cumulative), each epoch reports its difference
+        self.fh_mask_stats = self.data_ins.fh_masks.stats() if self.data_ins.fh_masks is not None else None
 
         self.sync_bn = self.config['amp']['sync_bn']
         self.opt_level = self.config['amp']['opt_level']
+        self.amp_backend = self.config['amp'].get('backend', 'apex')
+        self.amp_dtype = getattr(torch, self.config['amp'].get('dtype', 'float32'))
+        assert self.amp_backend in ('apex', 'native'), ValueError(f'Invalid amp backend: {self.amp_backend}')
+        assert self.amp_backend == 'native' or apex is not None, \
+            ImportError('apex is not installed, set amp.backend to "native"')
+        # amp.initialize casts the target back to fp32, the fp32 master would only add memory
+        assert self.amp_backend == 'native' or self.config['model'].get('target_dtype', 'float32') == 'float32', \
+            ValueError('model.target_dtype other than "float32" needs amp.backend "native"')
+        self.use_autocast = self.amp_backend == 'native' and self.amp_dtype != torch.float32
         print(f"sync_bn: {self.sync_bn}")
 
         """build model"""
         print("init byol model!")
         net = BYOLModel(self.config)
-        if self.sync_bn:
+        self.channels_last = self.config['model'].get('channels_last', False)
+        if self.channels_last:
+            net = net.to(memory_format=torch.channels_last)
+        if self.sync_bn and self.amp_backend == 'apex':
             net = apex.parallel.convert_syncbn_model(net)
+        elif self.sync_bn and self.distributed and self.device.type == 'cuda':
+            net = torch.nn.SyncBatchNorm.convert_sync_batchnorm(net)
         self.model = net.to(self.device)
-        print("init byol model end!")
+        backend, compile_time = compile_model(self.model, self.config, self.device,
+                                              channels_last=self.channels_last, autocast=self.autocast)
+        print(f"init byol model end! (compile: {backend}, {compile_time:.1f}s)")
 
         """build optimizer"""
         print("get optimizer!")
         momentum = self.config['optimizer']['momentum']
         weight_decay = self.config['optimizer']['weight_decay']
         exclude_bias_and_bn = self.config['optimizer']['exclude_bias_and_bn']
-        params = params_util.collect_params([self.model.online_network,self.model.masknet, self.model.predictor],
+        modules = [self.model.online_network, self.model.masknet, self.model.predictor]  # masknet is None when disabled
+        params = params_util.collect_params([m for m in modules if m is not None],
                                             exclude_bias_and_bn=exclude_bias_and_bn)
         self.optimizer = LARS(params, lr=self.max_lr, momentum=momentum, weight_decay=weight_decay)
 
         """init amp"""
         print("amp init!")
-        self.model, self.optimizer = amp.initialize(
-            self.model, self.optimizer, opt_level=self.opt_level)
-
-        if self.distributed:
-            self.model = DDP(self.model, delay_allreduce=True)
+        if self.amp_backend == 'apex':
+            self.model, self.optimizer = amp.initialize(
+                self.model, self.optimizer, opt_level=self.opt_level)
+            if self.distributed:
+                self.model = ApexDDP(self.model, delay_allreduce=True)
+        else:
+            # autocast runs the model in fp16/bf16, weights, LARS and the loss stay in fp32
+            self.scaler = torch.amp.GradScaler(
+                'cuda', enabled=self.amp_dtype == torch.float16 and self.device.type == 'cuda')
+            if self.distributed:
+                device_ids = [self.gpu] if self.device.type == 'cuda' else None
+                self.model = torch.nn.parallel.DistributedDataParallel(self.model, device_ids=device_ids)
+                if self.model.module.target_master is not None:
+                    # ignored by DDP's buffer broadcast, start every rank from rank 0's copy
+                    dist.broadcast(self.model.module.target_master, 0)
         print("amp init end!")
 
+    def autocast(self):
+        if self.amp_backend != 'native':
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.use_autocast)
+
     # resume snapshots from pre-train
     def resume_model(self, model_path=None):
         if model_path is None and not self.resume_path:
@@ -147,21 +203,39 @@ class BYOLTrainer():
             self.steps = checkpoint['steps']
             self.model.load_state_dict(checkpoint['model'], strict=True)
             self.optimizer.load_state_dict(checkpoint['optimizer'])
-            amp.load_state_dict(checkpoint['amp'])
+            if self.amp_backend == 'apex' and 'amp' in checkpoint:
+                amp.load_state_dict(checkpoint['amp'])
+            elif self.amp_backend == 'native' and 'scaler' in checkpoint:
+                self.scaler.load_state_dict(checkpoint['scaler'])
             self.logging.info(f"--> Loaded checkpoint '{model_path}' (epoch {self.start_epoch})")
 
     # save snapshots
+    def prepare_epoch(self, epoch):
+        """Start the loader iterator of `epoch`, its workers fill their prefetch queues in the background"""
+        self.data_ins.set_epoch(epoch)
+        self.next_loader_iter = (epoch, iter(self.train_loader))
+
     def save_checkpoint(self, epoch):
+        if epoch < self.total_epochs:
+            self.prepare_epoch(epoch + 1)
         if epoch % self.save_epoch == 0 and self.rank == 0:
             state = {'config': self.config,
                      'epoch': epoch,
                      'steps': self.steps,
                      'model': self.model.state_dict(),
                      'optimizer': self.optimizer.state_dict(),
-                     'amp': amp.state_dict()
                     }
+            if self.amp_backend == 'apex':
+                state['amp'] = amp.state_dict()
+            else:
+                state['scaler'] = self.scaler.state_dict()
             torch.save(state, self.ckpt_path.format(epoch))
 
+    def close(self, abort=False):
+        """Stop the data service producers, after the last epoch or on error (abort)"""
+        if self.data_ins.service is not None:
+            self.data_ins.service.close(abort=abort)
+
     def adjust_learning_rate(self, step):
         """learning rate warm up and decay"""
         max_lr = self.max_lr
@@ -189,6 +263,21 @@ class BYOLTrainer():
 
     def adjust_mm(self, step):
         self.mm = 1 - (1 - self.base_mm) * (np.cos(np.pi * step / self.total_steps) + 1) / 2
+
+    @contextlib.contextmanager
+    def grad_sync(self, enabled):
+        """skip the DDP gradient allreduce for non-final accumulation micro-batches"""
+        if enabled or not self.distributed:
+            yield
+        elif hasattr(self.model, 'no_sync'):
+            with self.model.no_sync():
+                yield
+        else:
+            self.model.disable_allreduce()
+            try:
+                yield
+            finally:
+                self.model.enable_allreduce()
         
     def train_epoch(self, epoch, printer=print):
         batch_time = eval_util.AverageMeter()
@@ -202,19 +291,38 @@ class BYOLTrainer():
 
         end = time.time()
         self.data_ins.set_epoch(epoch)
-
-        prefetcher = data_prefetcher(self.train_loader)
-        images, masks = prefetcher.next()
+        if self.data_ins.resolution_schedule:
+            crop_size = scheduled_crop_size(self.data_ins.resolution_schedule, epoch, self.data_ins.resize_size)
+            printer(f'Epoch: [{epoch}] crop size {crop_size}')
+        if self.rank == 0 and epoch > 1 and hasattr(self.data_ins.train_sampler, 'estimated_page_cache_hit_rate'):
+            # simulated from the sampler order, the measured data wait is reported at the end of the epoch
+            hit_rate = self.data_ins.train_sampler.estimated_page_cache_hit_rate(
+                self.config['data'].get('page_cache_samples'))
+            printer(f'Epoch: [{epoch}] estimated (simulated LRU) page cache hit rate {hit_rate:.3f}')
+
+        loader = self.train_loader
+        if self.next_loader_iter is not None and self.next_loader_iter[0] == epoch:
+            loader = self.next_loader_iter[1]
+        self.next_loader_iter = None
+        prefetcher = data_prefetcher(loader, channels_last=self.channels_last, depth=self.prefetch_depth,
+                                     normalize=self.data_ins.normalize_on_device, background=self.prefetch_thread)
+        images, masks, *local_crops = prefetcher.next()
+        # one optimizer step per accumulation_steps micro-batches, trailing micro-batches are dropped
+        num_micro_batches = len(self.train_loader) // self.accumulation_steps * self.accumulation_steps
         i = 0
-        while images is not None:
+        while images is not None and i < num_micro_batches:
             i += 1
-            self.adjust_learning_rate(self.steps)
-            self.adjust_mm(self.steps)
-            self.steps += 1
+            micro_step = (i - 1) % self.accumulation_steps
+            last_micro_step = micro_step == self.accumulation_steps - 1
+            if micro_step == 0:
+                self.adjust_learning_rate(self.steps)
+                self.adjust_mm(self.steps)
+                self.steps += 1
             #import ipdb;ipdb.set_trace()
-            assert images.dim() == 5, f"Input must have 5 dims, got: {images.dim()}"
-            view1 = images[:, 0, ...].contiguous()
-            view2 = images[:, 1, ...].contiguous()
+            # view-major batch from collate_views: (2B, C, H, W), view1 of every sample then view2
+            assert images.dim() == 4, f"Input must have 4 dims, got: {images.dim()}"
+            # (LB, C, h, w) low-resolution local crops and their masks, online branch only
+            local_images, local_masks = local_crops or (None, None)
             
             # measure data loading time
             data_time.update(time.time() - end)
@@ -227,26 +335,41 @@ class BYOLTrainer():
                     wandb_id = torch.randint(0,self.train_batch_size,(1,1)).item()
                 self.epoch_count = epoch     
                 
-            # forward
-            tflag = time.time()
-            q, target_z,pinds, tinds = self.model(view1, view2, self.mm, masks.to('cuda'),wandb_id)
-            forward_time.update(time.time() - tflag)
-
-            tflag = time.time()
-            loss = self.forward_loss(target_z, q, tinds.to('cuda'), pinds.to('cuda'))
-
-            self.optimizer.zero_grad()
-            if self.opt_level == 'O0':
-                loss.backward()
-            else:
-                with amp.scale_loss(loss, self.optimizer) as scaled_loss:
-                    scaled_loss.backward()
-            self.optimizer.step()
+            with self.grad_sync(last_micro_step):
+                # forward, the target network EMA is updated once per optimizer step
+                tflag = time.time()
+                with self.autocast():
+                    q, target_z,pinds, tinds = self.model(images, self.mm, masks.to(self.device),wandb_id,
+                                                          update_target=(micro_step == 0),
+                                                          local_images=local_images, local_masks=local_masks)
+                forward_time.update(time.time() - tflag)
+
+                # the loss and its softmax are computed in fp32
+                tflag = time.time()
+                loss = self.forward_loss(target_z.float(), q.float(), tinds.to(self.device), pinds.to(self.device))
+
+                if micro_step == 0:
+                    self.optimizer.zero_grad()
+                if self.amp_backend == 'native':
+                    self.scaler.scale(loss / self.accumulation_steps).backward()
+                elif self.opt_level == 'O0':
+                    (loss / self.accumulation_steps).backward()
+                else:
+                    with amp.scale_loss(loss / self.accumulation_steps, self.optimizer,
+                                        delay_unscale=not last_micro_step) as scaled_loss:
+                        scaled_loss.backward()
+            if last_micro_step and self.amp_backend == 'native':
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+            elif last_micro_step:
+                self.optimizer.step()
             backward_time.update(time.time() - tflag)
-            loss_meter.update(loss.item(), view1.size(0))
+            loss_meter.update(loss.item(), images.size(0) // 2)
+
+            log_step = last_micro_step and self.steps % self.log_step == 0
 
             tflag = time.time()
-            if self.steps % self.log_step == 0 and self.rank == 0:
+            if log_step and self.rank == 0:
                 self.writer.add_scalar('lr', round(self.optimizer.param_groups[0]['lr'], 5), self.steps)
                 self.writer.add_scalar('mm', round(self.mm, 5), self.steps)
                 self.writer.add_scalar('loss', loss_meter.val, self.steps)
@@ -257,7 +380,7 @@ class BYOLTrainer():
             #import ipdb;ipdb.set_trace()
             
             # Print log info
-            if (self.gpu==0 or self.log_all) and self.steps % self.log_step == 0:
+            if (self.gpu==0 or self.log_all) and log_step:
                 
                 if self.wandb_enable:
                     # Log per batch stats to wandb (average per epoch is also logged at the end of function)
@@ -282,8 +405,23 @@ class BYOLTrainer():
                         f'Backward Time {backward_time.val:.4f} ({backward_time.avg:.4f})\t'
                         f'Log Time {log_time.val:.4f} ({log_time.avg:.4f})\t')
 
-            images, masks = prefetcher.next()
+            images, masks, *local_crops = prefetcher.next()
             
+        prefetcher.close()
+        if self.gpu==0:
+            printer(f'Epoch: [{epoch}] waited on data for {prefetcher.waits}/{prefetcher.batches} batches, '
+                    f'{prefetcher.wait_time:.2f} s')
+        if self.gpu==0 and self.data_ins.cache is not None:
+            stats = self.data_ins.cache.stats()
+            printer(f'Epoch: [{epoch}] staging cache hits {stats["hits"]} misses {stats["misses"]} '
+                    f'hit rate {stats["hit_rate"]:.3f} staged {stats["bytes"] / 2**30:.2f} GB evictions {stats["evictions"]}')
+        if self.gpu==0 and self.data_ins.fh_masks is not None:
+            stats, last = self.data_ins.fh_masks.stats(), self.fh_mask_stats
+            self.fh_mask_stats = stats
+            misses, compute_time = stats['misses'] - last['misses'], stats['compute_time'] - last['compute_time']
+            printer(f'Epoch: [{epoch}] FH masks computed {misses} ({compute_time:.1f} s in the workers, '
+                    f'{compute_time / max(misses, 1) * 1e3:.1f} ms each) read from cache {stats["hits"] - last["hits"]}')
+
         if (self.gpu==0 or self.log_all) and self.wandb_enable:
             # Log averages at end of Epoch
             wandb.log({
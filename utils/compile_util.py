@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+import time
+import contextlib
+
+import torch
+
+def compile_targets(model):
+    """
+    (parent, attribute) of the BYOLModel submodules compiled as a unit:
+    backbone stages, FPN, projection, Masknet and predictor MLPs.
+    Mask sampling and wandb logging stay eager
+    """
+    targets = []
+    for net in (model.online_network, model.target_network):
+        if net.pool_size == 7:
+            targets.append((net, 'encoder'))
+        else:
+            targets += [(net, name) for name in ('C1', 'C2', 'C3', 'C4', 'C5', 'fpn')]
+        targets.append((net, 'projetion'))
+    if model.masknet is not None:
+        targets.append((model, 'masknet'))
+    targets.append((model.predictor, 'predictor'))
+    return targets
+
+
+def example_inputs(config, device, channels_last=False, crop_size=None, num_views=2):
+    """Static-shape view-major example batch built from train_batch_size, the crop size and the mask grid"""
+    batch_size = num_views * config['data']['train_batch_size']
+    crop_size = crop_size or config['data']['resize_size']
+    mask_size = crop_size // config['data'].get('mask_stride', 1)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    images = torch.randn(batch_size, 3, crop_size, crop_size, device=device).contiguous(memory_format=memory_format)
+    masks = torch.randint(0, 4, (batch_size, 1, mask_size, mask_size), device=device)
+    return images, masks
+
+
+def training_inputs(config, device, channels_last=False):
+    """
+    One example batch per global crop size of data.resolution_schedule (resize_size before
+    its first entry), each followed by the local crops (local_crops per image) if enabled
+    """
+    data = config['data']
+    schedule = data.get('resolution_schedule') or {}
+    crop_sizes = set(schedule.values())
+    if not schedule or min(schedule) > 1:
+        crop_sizes.add(data['resize_size'])
+    local_crops = example_inputs(config, device, channels_last, data.get('local_crop_size', 96),
+                                 data['local_crops']) if data.get('local_crops') else ()
+    return [(*example_inputs(config, device, channels_last, size), *local_crops) for size in sorted(crop_sizes)]
+
+
+def warmup(model, inputs, autocast):
+    """One forward/backward pass that leaves parameters, gradients and buffers untouched"""
+    buffers = [(b, b.clone()) for b in model.buffers()]
+    images, masks, *local_crops = inputs
+    local_images, local_masks = local_crops or (None, None)
+    with autocast():
+        q, target_z, _, _ = model(images, 0., masks, None, update_target=False,
+                                  local_images=local_images, local_masks=local_masks)
+    (q.float().mean() + target_z.float().mean()).backward()
+    for p in model.parameters():
+        p.grad = None
+    with torch.no_grad():
+        for b, saved in buffers:
+            b.copy_(saved)
+
+
+def trace_targets(model, targets, inputs, autocast):
+    """
+    Replace every target by a TorchScript trace on the inputs it sees in one forward of
+    the first batch, then run the other batches to check the traces are not shape specific
+    """
+    captured = {}
+    hooks = [getattr(parent, name).register_forward_pre_hook(
+                 lambda m, args: captured.setdefault(m, args)) for parent, name in targets]
+    try:
+        warmup(model, inputs[0], autocast)
+    finally:
+        for hook in hooks:
+            hook.remove()
+    with autocast():
+        for parent, name in targets:
+            module = getattr(parent, name)
+            setattr(parent, name, torch.jit.trace(module, captured[module], check_trace=False))
+    for batch in inputs[1:]:
+        warmup(model, batch, autocast)
+
+
+def compile_model(model, config, device, channels_last=False, autocast=contextlib.nullcontext):
+    """
+    Compile the submodules of `model` in place according to config['model']['compile']:
+    "inductor" uses torch.compile (falling back to TorchScript), "script" uses a
+    TorchScript trace. Parameter names are unchanged. Every crop size of the resolution
+    schedule and the local crops are warmed up, so no step recompiles (inductor keeps one
+    static graph per shape).
+    Returns the backend actually used and the compile (warmup) time in seconds
+    """
+    mode = config['model'].get('compile')
+    if not mode:
+        return 'eager', 0.
+    assert mode in ('inductor', 'script'), ValueError(f'Invalid compile mode: {mode}')
+    backends = ['inductor', 'script'] if mode == 'inductor' else ['script']
+    targets = compile_targets(model)
+    originals = [getattr(parent, name) for parent, name in targets]
+    inputs = training_inputs(config, device, channels_last)
+    # a warmup that fails partway leaves the batch norm statistics of its forward behind
+    buffers = [(b, b.clone()) for b in model.buffers()]
+
+    for backend in backends:
+        start = time.time()
+        try:
+            if backend == 'inductor':
+                assert hasattr(torch, 'compile'), 'torch.compile is not available'
+                # the compiled forward is an instance attribute of the original module
+                for module in originals:
+                    module.forward = torch.compile(module.forward, backend='inductor', dynamic=False)
+                for batch in inputs:
+                    warmup(model, batch, autocast)
+            else:
+                trace_targets(model, targets, inputs, autocast)
+            return backend, time.time() - start
+        except Exception as e:
+            print(f"compile with {backend} failed: {e!r}")
+            for (parent, name), module in zip(targets, originals):
+                module.__dict__.pop('forward', None)
+                setattr(parent, name, module)
+            with torch.no_grad():
+                for b, saved in buffers:
+                    b.copy_(saved)
+            model.zero_grad(set_to_none=True)
+    return 'eager', 0.
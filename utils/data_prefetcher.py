@@ -1,24 +1,116 @@
 # -*- coding: utf-8 -*-
+import time
+import queue
+import threading
+from collections import deque
+
 import torch
 
 class data_prefetcher():
-    def __init__(self, loader):
+    """
+    Keeps `depth` batches of `loader` ahead of the training loop on `device`. On CUDA
+    each batch is copied on a side stream and the loop only waits for that batch's
+    copy. With `background` (always on for CPU runs) a thread pulls the batches from
+    the loader and pins them, or on CPU also normalizes and converts them, off the
+    main thread. With `normalize` the loader yields uint8 images (data.normalize_on_device)
+    that are converted to normalized floats here. wait_time and waits count how long
+    and how often next() blocked, i.e. the training loop waited on the data.
+    Batches of a RingDataLoader are handed back to its ring once copied to the device
+    (or, on CPU, once the step that used them is over).
+    """
+    WAIT_THRESHOLD = 1e-3 # seconds
+
+    def __init__(self, loader, channels_last=False, depth=1, device=None, normalize=False, background=False):
         self.loader = iter(loader)
-        self.stream = torch.cuda.Stream()
-        # self.mean = torch.tensor([0.485 * 255, 0.456 * 255, 0.406 * 255]).cuda().view(1,3,1,1)
-        # self.std = torch.tensor([0.229 * 255, 0.224 * 255, 0.225 * 255]).cuda().view(1,3,1,1)
-        # With Amp, it isn't necessary to manually convert data to half.
-        # if args.fp16:
-        #     self.mean = self.mean.half()
-        #     self.std = self.std.half()
-        self.preload()
+        self.release = getattr(self.loader, 'release', None)
+        self.channels_last = channels_last
+        self.depth = depth
+        self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.normalize = normalize
+        self.stream = torch.cuda.Stream() if self.device.type == 'cuda' else None
+        self.mean = torch.tensor([0.485 * 255, 0.456 * 255, 0.406 * 255], device=self.device).view(1,3,1,1)
+        self.std = torch.tensor([0.229 * 255, 0.224 * 255, 0.225 * 255], device=self.device).view(1,3,1,1)
+        self.batches, self.waits, self.wait_time = 0, 0, 0.
+        # ([images, masks, *local crops and their masks], copy event, ring slot), None once the loader is exhausted
+        self.pending = deque()
+        # (copy event, ring slot) of the batches returned by next()
+        self.in_use = deque()
 
-    def preload(self):
+        self.queue, self.thread = None, None
+        if background or self.stream is None:
+            self.stop = threading.Event()
+            self.queue = queue.Queue(maxsize=depth)
+            self.thread = threading.Thread(target=self._fetch_loop, daemon=True)
+            self.thread.start()
+        for _ in range(depth):
+            self.preload()
+
+    def _put(self, item):
+        """Queue `item` unless close() is called while the queue is full"""
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fetch_loop(self):
         try:
-            self.next_input, self.next_mask = next(self.loader)
-        except StopIteration:
-            self.next_input = None
-            self.next_mask = None
+            for batch in self.loader:
+                slot = getattr(batch, 'slot', None)
+                if self.stream is None:
+                    batch = self._prepare(list(batch))
+                else:
+                    batch = [t if t.is_pinned() else t.pin_memory() for t in batch]
+                if not self._put((batch, slot)):
+                    self._release(None, slot)
+                    return
+        except Exception as e:
+            self._put(e)
+        self._put(None)
+
+    def _fetch(self):
+        """(next loader batch, its ring slot), None at the end of the loader"""
+        if self.queue is None:
+            try:
+                # images, masks, then the local crops and their masks if any
+                batch = next(self.loader)
+            except StopIteration:
+                return None
+            return list(batch), getattr(batch, 'slot', None)
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        if item is None:
+            # seen once, later fetches keep returning None
+            self.queue.put(None)
+        return item
+
+    def _release(self, event, slot):
+        if slot is None:
+            return
+        if event is not None:
+            event.synchronize()
+        self.release(slot)
+
+    def _prepare(self, batch):
+        """uint8 to normalized float and channels-last for the images and the local crops"""
+        for f in range(0, len(batch), 2):
+            if self.normalize:
+                batch[f] = batch[f].float().sub_(self.mean).div_(self.std)
+            if self.channels_last:
+                batch[f] = batch[f].contiguous(memory_format=torch.channels_last)
+        return batch
+
+    def preload(self):
+        item = self._fetch()
+        if item is None:
+            self.pending.append((None, None, None))
+            return
+        batch, slot = item
+        if self.stream is None:
+            self.pending.append((batch, None, slot))
             return
         # if record_stream() doesn't work, another option is to make sure device inputs are created
         # on the main stream.
@@ -28,29 +120,43 @@ class data_prefetcher():
         # at the time we start copying to next_*:
         # self.stream.wait_stream(torch.cuda.current_stream())
         with torch.cuda.stream(self.stream):
-            self.next_input = self.next_input.cuda(non_blocking=True)
-            self.next_mask = self.next_mask.cuda(non_blocking=True)
-            # more code for the alternative if record_stream() doesn't work:
-            # copy_ will record the use of the pinned source tensor in this side stream.
-            # self.next_input_gpu.copy_(self.next_input, non_blocking=True)
-            # self.next_target_gpu.copy_(self.next_target, non_blocking=True)
-            # self.next_input = self.next_input_gpu
-            # self.next_target = self.next_target_gpu
-
-            # With Amp, it isn't necessary to manually convert data to half.
-            # if args.fp16:
-            #     self.next_input = self.next_input.half()
-            # else:
-            # self.next_input = self.next_input.float()
-            # self.next_input = self.next_input.sub_(self.mean).div_(self.std)
+            batch = self._prepare([t.to(self.device, non_blocking=True) for t in batch])
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.pending.append((batch, event, slot))
 
     def next(self):
-        torch.cuda.current_stream().wait_stream(self.stream)
-        input = self.next_input
-        mask = self.next_mask
-        if input is not None:
-            input.record_stream(torch.cuda.current_stream())
-        if mask is not None:
-            mask.record_stream(torch.cuda.current_stream())
+        start = time.time()
+        # the step that used the previous batches is over
+        while self.in_use:
+            self._release(*self.in_use.popleft())
+        batch, event, slot = self.pending.popleft()
+        if batch is None:
+            self.pending.appendleft((None, None, None))
+            return None, None
+        self.in_use.append((event, slot))
+        if event is not None:
+            torch.cuda.current_stream().wait_event(event)
+            for t in batch:
+                t.record_stream(torch.cuda.current_stream())
         self.preload()
-        return input, mask
+        wait = time.time() - start
+        self.batches += 1
+        self.waits += wait > self.WAIT_THRESHOLD
+        self.wait_time += wait
+        return tuple(batch)
+
+    def close(self):
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
+            while not self.queue.empty():
+                item = self.queue.get()
+                if isinstance(item, tuple):
+                    self._release(None, item[1])
+        for event, slot in self.in_use:
+            self._release(event, slot)
+        for batch, event, slot in self.pending:
+            self._release(event, slot)
+        self.in_use.clear()
+        self.pending.clear()
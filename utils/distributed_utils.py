@@ -33,22 +33,24 @@ class GatherLayer(torch.autograd.Function):
     """
 
     @staticmethod
-    def forward(ctx, x):
-        output = [torch.zeros_like(x) for _ in range(dist.get_world_size())]
-        dist.all_gather(output, x)
+    def forward(ctx, x, group=None):
+        ctx.group = group
+        output = [torch.zeros_like(x) for _ in range(dist.get_world_size(group))]
+        dist.all_gather(output, x, group=group)
         return tuple(output)
 
     @staticmethod
     def backward(ctx, *grads):
         all_gradients = torch.stack(grads)
-        dist.all_reduce(all_gradients)
-        return all_gradients[dist.get_rank()]
+        dist.all_reduce(all_gradients, group=ctx.group)
+        return all_gradients[dist.get_rank(ctx.group)], None
 
 
-def gather_from_all(tensor: torch.Tensor) -> torch.Tensor:
+def gather_from_all(tensor: torch.Tensor, group=None) -> torch.Tensor:
     """
     Similar to classy_vision.generic.distributed_util.gather_from_all
-    except that it does not cut the gradients
+    except that it does not cut the gradients.
+    If `group` is given, only the ranks of that process group are gathered
     """
     if tensor.ndim == 0:
         # 0 dim tensors cannot be gathered. so unsqueeze
@@ -56,7 +58,7 @@ def gather_from_all(tensor: torch.Tensor) -> torch.Tensor:
 
     if is_distributed_training_run():
         tensor, orig_device = convert_to_distributed_tensor(tensor)
-        gathered_tensors = GatherLayer.apply(tensor)
+        gathered_tensors = GatherLayer.apply(tensor, group)
         gathered_tensors = [
             convert_to_normal_tensor(_tensor, orig_device)
             for _tensor in gathered_tensors
@@ -67,6 +69,56 @@ def gather_from_all(tensor: torch.Tensor) -> torch.Tensor:
     return gathered_tensor
 
 
+def hierarchical_gather_from_all(tensor: torch.Tensor, intra_group, inter_group) -> torch.Tensor:
+    """
+    Gather from the whole world in two stages: first inside `intra_group` (the
+    ranks of one node), then across `inter_group` (the ranks with the same local
+    rank on every node). Node blocks are concatenated in node order, so the
+    result matches gather_from_all when ranks are numbered node by node
+    """
+    node_tensor = gather_from_all(tensor, group=intra_group)
+    return gather_from_all(node_tensor, group=inter_group)
+
+
+def new_subgroups(group_size: int):
+    """
+    Split the world into consecutive blocks of `group_size` ranks and return
+    the process group containing this rank. Must be called by every rank, in the same order
+    """
+    world_size = dist.get_world_size()
+    rank = dist.get_rank()
+    assert world_size % group_size == 0, \
+        f"World size {world_size} is not divisible by group size {group_size}"
+
+    own_group = None
+    for start in range(0, world_size, group_size):
+        ranks = list(range(start, start + group_size))
+        group = dist.new_group(ranks)
+        if rank in ranks:
+            own_group = group
+    return own_group
+
+
+def new_cross_subgroups(group_size: int):
+    """
+    Counterpart of new_subgroups: return the process group made of the ranks
+    that hold the same position as this rank in their own block of `group_size`
+    ranks (e.g. the same local rank on every node)
+    """
+    world_size = dist.get_world_size()
+    rank = dist.get_rank()
+    assert world_size % group_size == 0, \
+        f"World size {world_size} is not divisible by group size {group_size}"
+
+    own_group = None
+    for offset in range(group_size):
+        ranks = list(range(offset, world_size, group_size))
+        group = dist.new_group(ranks)
+        if rank in ranks:
+            own_group = group
+    return own_group
+
+
 def all_gather_sizes(x: torch.Tensor) -> List[int]:
     """
     Get the first dimension sizes of the the tensor to gather on each
@@ -3,9 +3,19 @@ import torch
 import skimage
 import pickle
 import torchvision
+import functools
+
+@functools.lru_cache(maxsize=64)
+def patch_mask(height,width,segments=(3,2)):
+    """
+    (height, width) int16 grid of segments[0] x segments[1] cells numbered row + col * segments[0],
+    the remainder rows and columns joined to the last cell. Cached per shape, do not modify in place.
+    """
+    rows = torch.clamp(torch.arange(height) // max(height // segments[0], 1), max=segments[0] - 1)
+    cols = torch.clamp(torch.arange(width) // max(width // segments[1], 1), max=segments[1] - 1)
+    return (rows[:, None] + cols[None, :] * segments[0]).to(torch.int16)
 
 def create_patch_mask(image,segments=[3,2]):
-    totensor = torchvision.transforms.ToTensor()
     """
     Input is a PIL Image or Tensor with [CxWxH]
     """
@@ -13,27 +23,27 @@ def create_patch_mask(image,segments=[3,2]):
         image = torchvision.transforms.ToTensor()(image)
     except:
         pass
-    dims=list(np.floor_divide(image.shape[1:],segments))
-    
-    mask=torch.hstack([torch.cat([torch.zeros(dims[0],dims[1])+i+(j*(segments[0])) 
-                                  for i in range(segments[0])]) for j in range(segments[1])])
-    
-    mods = list(np.mod(image.shape[1:],segments))
-    if mods[0]!=0:
-        mask = torch.cat([mask,torch.stack([mask[-1,:] for i in range(mods[0])])])
-    if mods[1]!=0:
-        mask = torch.hstack([mask,torch.stack([mask[:,-1] for i in range(mods[1])]).T])
-        
-    return mask.int()
+    return patch_mask(*image.shape[1:], tuple(segments)).int()
+
+def downsample_mask(mask,factor):
+    """
+    (H, W) mask to (ceil(H/factor), ceil(W/factor)), the pixel at the center of each
+    factor x factor cell. MaskRandomResizedCrop maps crops into its coordinates.
+    """
+    if factor == 1:
+        return mask
+    rows = np.minimum(np.arange(0, mask.shape[0], factor) + factor // 2, mask.shape[0] - 1)
+    cols = np.minimum(np.arange(0, mask.shape[1], factor) + factor // 2, mask.shape[1] - 1)
+    return mask[rows[:, None], cols]
 
 def convert_binary_mask(mask,max_mask_id=256,pool_size=7):
     batch_size = mask.shape[0]
-    mask_ids = torch.arange(max_mask_id).reshape(1,max_mask_id, 1, 1).float().to('cuda')
+    mask_ids = torch.arange(max_mask_id).reshape(1,max_mask_id, 1, 1).float().to(mask.device)
     binary_mask = torch.eq(mask_ids, mask).float()
     binary_mask = torch.nn.AdaptiveAvgPool2d((pool_size,pool_size))(binary_mask)
     binary_mask = torch.reshape(binary_mask,(batch_size,max_mask_id,pool_size*pool_size)).permute(0,2,1)
     binary_mask = torch.argmax(binary_mask, axis=-1)
-    binary_mask = torch.eye(max_mask_id)[binary_mask]
+    binary_mask = torch.eye(max_mask_id, device=mask.device)[binary_mask]
     binary_mask = binary_mask.permute(0, 2, 1)
     return binary_mask
 
@@ -47,6 +57,6 @@ def sample_masks(binary_mask,n_masks=16):
     dist = torch.distributions.categorical.Categorical(logits=sel_masks)
     mask_ids = dist.sample([n_masks]).T
     
-    sample_mask = torch.stack([binary_mask[b][mask_ids[b]] for b in range(batch_size)])
+    sample_mask = binary_mask[torch.arange(batch_size, device=binary_mask.device)[:, None], mask_ids]
     
     return sample_mask,mask_ids
\ No newline at end of file